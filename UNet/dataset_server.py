@@ -0,0 +1,234 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import collections
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+import lmdb
+import numpy as np
+from multiprocessing import shared_memory
+from isg_ai_pb2 import ImageMaskPair
+
+
+# Serves the decoded records of one lmdb database to any number of local ImageReaders (e.g. a hyperparameter sweep of
+# train_unet processes on one node). Each record is decoded once into its own shared memory segment, the cache is
+# limited in size with least recently used eviction. Clients request records over a unix socket and copy them out of
+# shared memory, each trainer keeps its own sampling and augmentation.
+
+
+def _attach_shared_memory(name):
+    # attach to a segment owned by the server, without registering it with this process' resource tracker (which
+    # would unlink it when the client exits)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class DatasetServer():
+
+    def __init__(self, database_filepath, address, cache_size_bytes):
+        if not os.path.exists(database_filepath):
+            raise IOError('Missing Database: {}'.format(database_filepath))
+        self.database_filepath = database_filepath
+        self.address = address
+        self.cache_size_bytes = cache_size_bytes
+
+        self.lmdb_env = lmdb.open(database_filepath, map_size=int(2e10), readonly=True, lock=False)
+        datum = ImageMaskPair()
+        with self.lmdb_env.begin(write=False) as lmdb_txn:
+            cursor = lmdb_txn.cursor()
+            cursor.first()
+            datum.ParseFromString(cursor.value())
+            self.image_size = [datum.img_height, datum.img_width, datum.channels]
+            self.keys = [key for key in lmdb_txn.cursor().iternext(keys=True, values=False)]
+        print('Dataset server for {} with {} records'.format(database_filepath, len(self.keys)))
+
+        # key -> (shared memory segment, record metadata), in least to most recently used order
+        self.cache = collections.OrderedDict()
+        self.cache_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.done = False
+
+    def _decode(self, key):
+        # decode the record into a new shared memory segment, image followed by mask, in their stored dtypes
+        datum = ImageMaskPair()
+        with self.lmdb_env.begin(write=False) as lmdb_txn:
+            value = lmdb_txn.get(key)
+        if value is None:
+            raise KeyError('Key not found in database: {}'.format(key))
+        datum.ParseFromString(value)
+        img = np.frombuffer(datum.image, dtype=datum.img_type).reshape((datum.img_height, datum.img_width, datum.channels))
+        msk = np.frombuffer(datum.mask, dtype=datum.mask_type).reshape((datum.img_height, datum.img_width))
+
+        shm = shared_memory.SharedMemory(create=True, size=img.nbytes + msk.nbytes)
+        np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[:] = img
+        np.ndarray(msk.shape, dtype=msk.dtype, buffer=shm.buf, offset=img.nbytes)[:] = msk
+        record = {'name': shm.name, 'image_shape': img.shape, 'image_dtype': img.dtype.str, 'mask_shape': msk.shape, 'mask_dtype': msk.dtype.str, 'mask_offset': img.nbytes}
+        return shm, record
+
+    def get_record(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return self.cache[key][1]
+            self.misses += 1
+
+        # decode outside of the lock, so concurrent clients are not serialized behind a slow read
+        shm, record = self._decode(key)
+
+        with self.lock:
+            if key in self.cache:
+                # decoded concurrently by another client, keep the cached copy
+                shm.close()
+                shm.unlink()
+                self.cache.move_to_end(key)
+                return self.cache[key][1]
+            self.cache[key] = (shm, record)
+            self.cache_bytes += shm.size
+            while self.cache_bytes > self.cache_size_bytes and len(self.cache) > 1:
+                _, (old_shm, _) = self.cache.popitem(last=False)
+                self.cache_bytes -= old_shm.size
+                # clients which already attached keep a valid mapping, later requests re-decode the record
+                old_shm.close()
+                old_shm.unlink()
+                self.evictions += 1
+        return record
+
+    def get_stats(self):
+        with self.lock:
+            return {'records': len(self.cache), 'cache_bytes': self.cache_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def _serve_connection(self, connection):
+        try:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    break  # client disconnected
+                command = request[0]
+                try:
+                    if command == 'info':
+                        connection.send(('ok', {'keys': self.keys, 'image_size': self.image_size}))
+                    elif command == 'get':
+                        connection.send(('ok', self.get_record(request[1])))
+                    elif command == 'stats':
+                        connection.send(('ok', self.get_stats()))
+                    else:
+                        connection.send(('error', 'unknown command: {}'.format(command)))
+                except (KeyError, lmdb.Error) as e:
+                    connection.send(('error', str(e)))
+        finally:
+            connection.close()
+
+    def _report_stats(self, interval):
+        while not self.done:
+            time.sleep(interval)
+            stats = self.get_stats()
+            print('Cache: {} records, {:.1f} MB, hits {}, misses {}, evictions {}'.format(stats['records'], stats['cache_bytes'] / 2**20, stats['hits'], stats['misses'], stats['evictions']))
+
+    def serve_forever(self, stats_interval=60):
+        if os.path.exists(self.address):
+            os.remove(self.address)  # left over from a server which did not shut down cleanly
+        listener = multiprocessing.connection.Listener(self.address, family='AF_UNIX')
+        print('Serving on {}'.format(self.address))
+        threading.Thread(target=self._report_stats, args=(stats_interval,), daemon=True).start()
+        try:
+            while True:
+                connection = listener.accept()
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+        finally:
+            self.done = True
+            listener.close()
+            self.shutdown()
+
+    def shutdown(self):
+        # release every cached segment
+        with self.lock:
+            for shm, _ in self.cache.values():
+                shm.close()
+                shm.unlink()
+            self.cache.clear()
+            self.cache_bytes = 0
+        self.lmdb_env.close()
+
+
+def connect(address):
+    return multiprocessing.connection.Client(address, family='AF_UNIX')
+
+
+def _request(connection, request):
+    connection.send(request)
+    status, value = connection.recv()
+    if status != 'ok':
+        raise IOError('Dataset server error: {}'.format(value))
+    return value
+
+
+def get_info(connection):
+    # {'keys': list of record keys, 'image_size': [H, W, C]}
+    return _request(connection, ('info',))
+
+
+def get_stats(connection):
+    return _request(connection, ('stats',))
+
+
+def fetch_record(connection, key):
+    # returns private copies of the (image HWC, mask HW) arrays of the record
+    while True:
+        record = _request(connection, ('get', key))
+        try:
+            shm = _attach_shared_memory(record['name'])
+        except FileNotFoundError:
+            continue  # evicted between the reply and the attach, the retry decodes it again
+        try:
+            img = np.ndarray(record['image_shape'], dtype=record['image_dtype'], buffer=shm.buf).copy()
+            msk = np.ndarray(record['mask_shape'], dtype=record['mask_dtype'], buffer=shm.buf, offset=record['mask_offset']).copy()
+        finally:
+            shm.close()
+        return img, msk
+
+
+def main(database_filepath, address, cache_size_mb, stats_interval):
+    print('database = {}'.format(database_filepath))
+    print('address = {}'.format(address))
+    print('cache_size_mb = {}'.format(cache_size_mb))
+    print('stats_interval = {}'.format(stats_interval))
+
+    server = DatasetServer(database_filepath, address, cache_size_mb * 2**20)
+    # scheduler and kill terminations also go through the cleanup of the shared memory segments
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever(stats_interval)
+    except KeyboardInterrupt:
+        print('Shutting down')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='dataset_server', description='Serves decoded records of an lmdb database from a shared memory cache to the ImageReaders of several local train_unet processes')
+
+    parser.add_argument('--database', dest='database_filepath', type=str, help='lmdb database to serve (Required)', required=True)
+    parser.add_argument('--address', dest='address', type=str, help='filepath of the unix socket to serve on (Required)', required=True)
+    parser.add_argument('--cache_size_mb', dest='cache_size_mb', type=int, help='maximum size of the decoded record cache in MB (shared memory, /dev/shm)', default=8192)
+    parser.add_argument('--stats_interval', dest='stats_interval', type=float, help='seconds between cache statistics reports', default=60)
+
+    args = parser.parse_args()
+
+    main(args.database_filepath, args.address, args.cache_size_mb, args.stats_interval)
@@ -0,0 +1,206 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+
+
+# Stages an lmdb database from network storage into a node local cache folder in the background, so training starts
+# immediately on remote reads and the ImageReader workers switch to the local copy once it is complete. Staged copies
+# are kept in <cache_folder>/<fingerprint>/ and reused by later jobs on the same node. The fingerprint hashes the
+# source path and the size and modification time of its files (cheap to compute on network storage), every staged
+# file is verified against the sha256 of the source data before the copy is published.
+
+MANIFEST_FILENAME = 'staging_manifest.json'
+_copy_chunk_size = 16 * 2**20
+
+
+def _database_files(database_filepath):
+    # lmdb databases are folders, the lock file is per host state and is not staged
+    if os.path.isdir(database_filepath):
+        return sorted(fn for fn in os.listdir(database_filepath) if fn != 'lock.mdb' and os.path.isfile(os.path.join(database_filepath, fn)))
+    return [os.path.basename(database_filepath)]
+
+
+def _source_path(database_filepath, fn):
+    if os.path.isdir(database_filepath):
+        return os.path.join(database_filepath, fn)
+    return database_filepath
+
+
+def get_fingerprint(database_filepath):
+    h = hashlib.sha256()
+    h.update(os.path.realpath(database_filepath).encode('utf-8'))
+    for fn in _database_files(database_filepath):
+        st = os.stat(_source_path(database_filepath, fn))
+        h.update('{}:{}:{}'.format(fn, st.st_size, st.st_mtime_ns).encode('utf-8'))
+    return h.hexdigest()[:32]
+
+
+def _sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_copy_chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _copy_with_sha256(src, dst):
+    # hash the data as it is read from the source, so the source is read only once
+    h = hashlib.sha256()
+    with open(src, 'rb') as src_fh, open(dst, 'wb') as dst_fh:
+        for chunk in iter(lambda: src_fh.read(_copy_chunk_size), b''):
+            h.update(chunk)
+            dst_fh.write(chunk)
+        dst_fh.flush()
+        os.fsync(dst_fh.fileno())
+    return h.hexdigest()
+
+
+def read_manifest(staged_folder):
+    manifest_filepath = os.path.join(staged_folder, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_filepath):
+        return None
+    try:
+        with open(manifest_filepath, 'r') as fh:
+            return json.load(fh)
+    except ValueError:
+        return None
+
+
+def is_staged(staged_folder, verify_checksums=False):
+    manifest = read_manifest(staged_folder)
+    if manifest is None:
+        return False
+    for fn, entry in manifest['files'].items():
+        filepath = os.path.join(staged_folder, 'database', fn)
+        if not os.path.exists(filepath) or os.path.getsize(filepath) != entry['size']:
+            return False
+        if verify_checksums and _sha256(filepath) != entry['sha256']:
+            return False
+    return True
+
+
+class DatasetStager():
+
+    def __init__(self, database_filepath, cache_folder, verify_checksums=False):
+        self.database_filepath = database_filepath
+        self.cache_folder = cache_folder
+        self.verify_checksums = verify_checksums
+        self.fingerprint = get_fingerprint(database_filepath)
+        self.staged_folder = os.path.join(cache_folder, self.fingerprint)
+        # the database as it is opened by lmdb within the staged folder
+        if os.path.isdir(database_filepath):
+            self.staged_filepath = os.path.join(self.staged_folder, 'database')
+        else:
+            self.staged_filepath = os.path.join(self.staged_folder, 'database', os.path.basename(database_filepath))
+        # set once the staged copy is complete and verified, shared with the (forked) ImageReader workers
+        self.ready = multiprocessing.Event()
+        self.thread = None
+
+        if is_staged(self.staged_folder, verify_checksums):
+            print('Using staged copy of {} in {}'.format(database_filepath, self.staged_folder))
+            self.ready.set()
+
+    def start(self):
+        if self.ready.is_set() or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def wait(self, timeout=None):
+        return self.ready.wait(timeout)
+
+    def _run(self):
+        try:
+            self._stage()
+        except Exception as e:
+            # the readers keep using the source database
+            print('Staging of {} failed: {}'.format(self.database_filepath, e))
+
+    def _stage(self):
+        os.makedirs(self.cache_folder, exist_ok=True)
+        # jobs on the same node staging the same database wait on each other instead of copying it twice
+        with open(os.path.join(self.cache_folder, self.fingerprint + '.lock'), 'w') as lock_fh:
+            fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                if is_staged(self.staged_folder, self.verify_checksums):
+                    print('Staged copy of {} completed by another job'.format(self.database_filepath))
+                    self.ready.set()
+                    return
+
+                start_time = time.time()
+                print('Staging {} into {}'.format(self.database_filepath, self.staged_folder))
+                # holding the lock, any temporary copies were left behind by killed jobs
+                for fp in glob.glob(self.staged_folder + '.tmp-*'):
+                    shutil.rmtree(fp, ignore_errors=True)
+                tmp_folder = '{}.tmp-{}'.format(self.staged_folder, os.getpid())
+                shutil.rmtree(self.staged_folder, ignore_errors=True)  # incomplete or corrupt copy
+                os.makedirs(os.path.join(tmp_folder, 'database'))
+
+                files = dict()
+                total_bytes = 0
+                try:
+                    for fn in _database_files(self.database_filepath):
+                        staged_fp = os.path.join(tmp_folder, 'database', fn)
+                        source_sha256 = _copy_with_sha256(_source_path(self.database_filepath, fn), staged_fp)
+                        # re-read the local copy to catch corruption on the way to (or on) the local disk
+                        if _sha256(staged_fp) != source_sha256:
+                            raise IOError('Checksum mismatch staging {}'.format(fn))
+                        files[fn] = {'size': os.path.getsize(staged_fp), 'sha256': source_sha256}
+                        total_bytes += files[fn]['size']
+
+                    manifest = {'source': os.path.realpath(self.database_filepath), 'fingerprint': self.fingerprint, 'files': files, 'staged_time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                    with open(os.path.join(tmp_folder, MANIFEST_FILENAME), 'w') as fh:
+                        json.dump(manifest, fh, indent=2)
+                    # publish the complete copy atomically
+                    os.rename(tmp_folder, self.staged_folder)
+                except BaseException:
+                    shutil.rmtree(tmp_folder, ignore_errors=True)
+                    raise
+
+                elapsed = time.time() - start_time
+                print('Staged {} ({:.1f} MB) in {:.1f}s ({:.1f} MB/s)'.format(self.database_filepath, total_bytes / 2**20, elapsed, total_bytes / 2**20 / max(elapsed, 1e-6)))
+                self.ready.set()
+            finally:
+                fcntl.flock(lock_fh, fcntl.LOCK_UN)
+
+
+def main(database_filepaths, cache_folder, verify_checksums):
+    print('databases = {}'.format(database_filepaths))
+    print('cache_folder = {}'.format(cache_folder))
+    print('verify_checksums = {}'.format(verify_checksums))
+
+    for database_filepath in database_filepaths:
+        stager = DatasetStager(database_filepath, cache_folder, verify_checksums)
+        stager.start()
+        if stager.thread is not None:
+            stager.thread.join()
+        if not stager.ready.is_set():
+            raise IOError('Failed to stage {}'.format(database_filepath))
+        print('{} -> {}'.format(database_filepath, stager.staged_filepath))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='dataset_staging', description='Stages lmdb databases into a node local cache folder ahead of training (train_unet does this in the background with --staging_cache)')
+
+    parser.add_argument('--database', dest='database_filepaths', type=str, nargs='+', help='lmdb database(s) to stage (Required)', required=True)
+    parser.add_argument('--cache_folder', dest='cache_folder', type=str, help='node local folder holding the staged databases (Required)', required=True)
+    parser.add_argument('--verify_checksums', dest='verify_checksums', type=int, help='whether to verify the checksums of an existing staged copy before reusing it [0 = false, 1 = true]', default=0)
+
+    args = parser.parse_args()
+
+    main(args.database_filepaths, args.cache_folder, bool(args.verify_checksums))
@@ -0,0 +1,164 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import collections
+import multiprocessing
+import os
+import time
+import lmdb
+import numpy as np
+from isg_ai_pb2 import ImageMaskPair
+import imagereader
+import inference_backends
+import segmentation_metrics
+
+
+# Evaluates a trained model on every record of a test database, exactly once each. The records are decoded and
+# normalized (like the ImageReader, without augmentation) by a pool of processes, one batch per task, while the model
+# runs the previous batches. Unlike evaluator.py, which follows the checkpoints of a running training job, this
+# evaluates a finished model (a SavedModel or any of the exported inference backend models).
+
+# the lmdb environment of each decode process, opened once by the pool initializer
+_lmdb_env = None
+
+
+def _init_decoder(lmdb_filepath):
+    global _lmdb_env
+    _lmdb_env = lmdb.open(lmdb_filepath, map_size=int(2e10), readonly=True, lock=False)
+
+
+def _decode_batch(keys):
+    # returns the NCHW normalized images and the NHW masks of the records
+    datum = ImageMaskPair()
+    images = list()
+    masks = list()
+    with _lmdb_env.begin(write=False) as lmdb_txn:
+        for key in keys:
+            datum.ParseFromString(lmdb_txn.get(key))
+            img = np.frombuffer(datum.image, dtype=datum.img_type).reshape((datum.img_height, datum.img_width, datum.channels))
+            msk = np.frombuffer(datum.mask, dtype=datum.mask_type).reshape((datum.img_height, datum.img_width))
+            images.append(imagereader.zscore_normalize(img.transpose((2, 0, 1))))
+            masks.append(msk.astype(np.int64))
+    return np.stack(images), np.stack(masks)
+
+
+def _get_keys(lmdb_filepath):
+    lmdb_env = lmdb.open(lmdb_filepath, map_size=int(2e10), readonly=True, lock=False)
+    with lmdb_env.begin(write=False) as lmdb_txn:
+        keys = [key for key in lmdb_txn.cursor().iternext(keys=True, values=False)]
+    lmdb_env.close()
+    return keys
+
+
+def evaluate(model_filepath, test_lmdb_filepath, number_classes, batch_size=4, reader_count=2, backend='auto', backend_threads=0, image_count=0):
+    # returns the confusion matrix (rows are the target class, columns the predicted class) and the timing of the run
+    if not os.path.exists(test_lmdb_filepath):
+        raise IOError('Missing Database: {}'.format(test_lmdb_filepath))
+    keys = _get_keys(test_lmdb_filepath)
+    if image_count > 0:
+        keys = keys[0:image_count]
+    batches = [keys[i:i + batch_size] for i in range(0, len(keys), batch_size)]
+    print('Evaluating {} images in {} batches'.format(len(keys), len(batches)))
+
+    # the decode processes are forked before the model starts the runtime threads
+    pool = multiprocessing.Pool(reader_count, initializer=_init_decoder, initargs=(test_lmdb_filepath,))
+    try:
+        model = inference_backends.load_backend(model_filepath, backend, backend_threads)
+        print('Running the {} backend'.format(model.name))
+
+        cm = np.zeros((number_classes, number_classes), dtype=np.int64)
+        pixel_count = 0
+        wait_elapsed = 0.0
+        model_elapsed = 0.0
+        # at most 2 batches per decode process are in flight, which bounds the memory held by decoded batches
+        pending = collections.deque()
+        next_batch = 0
+        start_time = time.time()
+        while next_batch < len(batches) or len(pending) > 0:
+            while next_batch < len(batches) and len(pending) < 2 * reader_count:
+                pending.append(pool.apply_async(_decode_batch, (batches[next_batch],)))
+                next_batch += 1
+
+            wait_start = time.time()
+            images, masks = pending.popleft().get()
+            wait_elapsed += time.time() - wait_start
+
+            model_start = time.time()
+            prediction = np.argmax(model(images), axis=-1)
+            model_elapsed += time.time() - model_start
+
+            if masks.max() >= number_classes:
+                raise ValueError('Mask class {} is not in [0, {}), check --number_classes'.format(int(masks.max()), number_classes))
+            cm += segmentation_metrics.confusion_matrix(masks, prediction, number_classes)
+            pixel_count += masks.size
+        elapsed = time.time() - start_time
+    finally:
+        pool.terminate()
+        pool.join()
+
+    timing = {'image_count': len(keys), 'pixel_count': pixel_count, 'elapsed': elapsed, 'wait_elapsed': wait_elapsed, 'model_elapsed': model_elapsed}
+    return cm, timing
+
+
+def report(cm, timing, output_filepath=None):
+    iou = segmentation_metrics.iou(cm)
+    dice = segmentation_metrics.dice(cm)
+    precision = segmentation_metrics.precision(cm)
+    recall = segmentation_metrics.recall(cm)
+    support = np.sum(cm, axis=1)
+
+    elapsed = timing['elapsed']
+    print('Evaluated {} images in {:.2f} s: {:.2f} images/s, {:.2f} Mpixels/s'.format(timing['image_count'], elapsed, timing['image_count'] / elapsed, timing['pixel_count'] / elapsed / 1e6))
+    print('  model: {:.2f} s ({:.1%}), waiting for decoded batches: {:.2f} s ({:.1%})'.format(timing['model_elapsed'], timing['model_elapsed'] / elapsed, timing['wait_elapsed'], timing['wait_elapsed'] / elapsed))
+    print('Pixel accuracy = {:.4%}'.format(float(np.trace(cm) / np.sum(cm))))
+    print('{:>6} {:>8} {:>8} {:>10} {:>8} {:>12}'.format('class', 'IoU', 'Dice', 'precision', 'recall', 'pixels'))
+    for c in range(cm.shape[0]):
+        print('{:>6} {:>8.4f} {:>8.4f} {:>10.4f} {:>8.4f} {:>12}'.format(c, iou[c], dice[c], precision[c], recall[c], int(support[c])))
+    # classes absent from both the targets and the predictions (nan) are left out of the means
+    print('{:>6} {:>8.4f} {:>8.4f} {:>10.4f} {:>8.4f}'.format('mean', np.nanmean(iou), np.nanmean(dice), np.nanmean(precision), np.nanmean(recall)))
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            fh.write('class,iou,dice,precision,recall,pixels\n')
+            for c in range(cm.shape[0]):
+                fh.write('{},{},{},{},{},{}\n'.format(c, iou[c], dice[c], precision[c], recall[c], int(support[c])))
+        np.savetxt(os.path.splitext(output_filepath)[0] + '_confusion_matrix.csv', cm, fmt='%d', delimiter=',')
+
+
+def main(model_filepath, test_lmdb_filepath, number_classes, batch_size, reader_count, backend, backend_threads, image_count, output_filepath):
+    print('model = {}'.format(model_filepath))
+    print('test_database = {}'.format(test_lmdb_filepath))
+    print('number_classes = {}'.format(number_classes))
+    print('batch_size = {}'.format(batch_size))
+    print('reader_count = {}'.format(reader_count))
+    print('backend = {}'.format(backend))
+    print('backend_threads = {}'.format(backend_threads))
+    print('image_count = {}'.format(image_count))
+    print('output_filepath = {}'.format(output_filepath))
+
+    cm, timing = evaluate(model_filepath, test_lmdb_filepath, number_classes, batch_size, reader_count, backend, backend_threads, image_count)
+    report(cm, timing, output_filepath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='evaluate', description='Script which evaluates a trained model against a test lmdb database')
+
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel filepath to the model to evaluate, or a model exported with export_model.py or quantize_model.py (Required)', required=True)
+    parser.add_argument('--test_database', dest='test_database_filepath', type=str, help='lmdb database to evaluate on (Required)', required=True)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, help='number of images run through the model at once', default=4)
+    parser.add_argument('--reader_count', dest='reader_count', type=int, help='number of processes decoding the database records', default=2)
+    parser.add_argument('--backend', dest='backend', type=str, help='runtime to run the model with [auto, saved_model, tflite, onnx], auto picks it from the model filepath', default='auto')
+    parser.add_argument('--backend_threads', dest='backend_threads', type=int, help='intra op threads of the tflite and onnx backends (0 = runtime default)', default=0)
+    parser.add_argument('--image_count', dest='image_count', type=int, help='only evaluate the first N records (0 = all)', default=0)
+    parser.add_argument('--output_filepath', dest='output_filepath', type=str, help='csv file to write the per class metrics to, the confusion matrix is written next to it [default: not written]', default=None)
+
+    args = parser.parse_args()
+
+    main(args.saved_model_filepath, args.test_database_filepath, args.number_classes, args.batch_size, args.reader_count, args.backend, args.backend_threads, args.image_count, args.output_filepath)
@@ -0,0 +1,252 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise RuntimeError('Python3 required')
+
+import os
+# set the system environment so that the PCIe GPU ids match the Nvidia ids in nvidia-smi
+os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # so the IDs match nvidia-smi
+
+import argparse
+import glob
+import math
+import time
+import numpy as np
+
+import tensorflow as tf
+tf_version = tf.__version__.split('.')
+if int(tf_version[0]) != 2:
+    raise Exception('Tensorflow 2.x.x required')
+
+import unet_model
+import imagereader
+import segmentation_metrics
+
+
+# files shared between the trainer and the evaluator, all relative to the training output folder
+EVAL_RESULTS_FILENAME = 'eval_test_loss.csv'
+TRAINING_COMPLETE_FILENAME = 'training_complete'
+TRAINER_HEARTBEAT_FILENAME = 'trainer_heartbeat'
+# the model weights at the end of each epoch, written by the trainer and deleted by the evaluator once scored
+EVAL_CHECKPOINT_FOLDER = 'eval_checkpoints'
+
+
+def read_eval_results(output_folder):
+    # returns the list of (epoch, test_loss, mean_iou) evaluated so far, ordered by epoch
+    results = list()
+    filepath = os.path.join(output_folder, EVAL_RESULTS_FILENAME)
+    if not os.path.exists(filepath):
+        return results
+    with open(filepath, 'r') as fh:
+        for line in fh:
+            toks = line.strip().split(',')
+            if len(toks) != 3 or toks[0] == 'epoch':
+                continue  # skip the header
+            results.append((int(toks[0]), float(toks[1]), float(toks[2])))
+    results.sort(key=lambda r: r[0])
+    return results
+
+
+def write_eval_results(output_folder, results):
+    # write to a temporary file and rename it, so the polling trainer never reads a partially written file
+    filepath = os.path.join(output_folder, EVAL_RESULTS_FILENAME)
+    with open(filepath + '.tmp', 'w') as fh:
+        fh.write('epoch,test_loss,mean_iou\n')
+        for (epoch, loss, miou) in results:
+            fh.write('{},{},{}\n'.format(epoch, loss, miou))
+    os.replace(filepath + '.tmp', filepath)
+
+
+def get_eval_checkpoint_filepath(output_folder, epoch):
+    return os.path.join(output_folder, EVAL_CHECKPOINT_FOLDER, 'epoch-{}'.format(epoch))
+
+
+def get_epoch_checkpoints(output_folder):
+    # returns the (epoch, filepath) of every epoch checkpoint waiting to be evaluated, ordered by epoch. The index file
+    # is written last, so checkpoints still being written are not listed.
+    checkpoints = list()
+    for index_filepath in glob.glob(os.path.join(output_folder, EVAL_CHECKPOINT_FOLDER, 'epoch-*.index')):
+        filepath = index_filepath[0:-len('.index')]
+        try:
+            epoch = int(os.path.basename(filepath).split('-')[1])
+        except ValueError:
+            continue
+        checkpoints.append((epoch, filepath))
+    checkpoints.sort(key=lambda c: c[0])
+    return checkpoints
+
+
+def delete_checkpoint(filepath):
+    for fp in glob.glob(filepath + '.*'):
+        os.remove(fp)
+
+
+def touch_trainer_heartbeat(output_folder):
+    # called by the trainer while it runs, so the evaluator can tell a crashed trainer from a slow epoch
+    with open(os.path.join(output_folder, TRAINER_HEARTBEAT_FILENAME), 'a'):
+        pass
+    os.utime(os.path.join(output_folder, TRAINER_HEARTBEAT_FILENAME))
+
+
+def get_trainer_heartbeat(output_folder):
+    filepath = os.path.join(output_folder, TRAINER_HEARTBEAT_FILENAME)
+    return os.path.getmtime(filepath) if os.path.exists(filepath) else 0
+
+
+def evaluate(output_folder, test_lmdb_filepath, number_classes, batch_size, reader_count, test_every_n_steps, poll_interval=10, gpu_ids=None, trainer_timeout=1800):
+
+    if gpu_ids is not None:
+        # evaluate on spare devices, gpu_ids="" runs on the CPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = gpu_ids
+
+    best_checkpoint_filepath = os.path.join(output_folder, 'checkpoint', "ckpt")
+
+    # a restarted evaluator picks up where it left off
+    results = read_eval_results(output_folder)
+    evaluated_epochs = set([r[0] for r in results])
+    best_loss = min([r[1] for r in results]) if len(results) > 0 else np.inf
+
+    print('Setting up test image reader')
+    test_reader = imagereader.ImageReader(test_lmdb_filepath, use_augmentation=False, shuffle=False, num_workers=reader_count, balance_classes=False, number_classes=number_classes)
+    print('Test Reader has {} images'.format(test_reader.get_image_count()))
+
+    try:  # if any errors happen we want to catch them and shut down the multiprocess readers
+        print('Starting Readers')
+        test_reader.startup()
+        print('  test_reader online')
+
+        test_dataset = test_reader.get_tf_dataset()
+        test_dataset = test_dataset.batch(batch_size).prefetch(reader_count)
+        # the reader loops over the database, so a single iterator is kept across evaluations
+        test_iterator = iter(test_dataset)
+        test_epoch_size = int(math.ceil(test_reader.get_image_count() / batch_size))
+
+        print('Creating model')
+        model = unet_model.UNet(number_classes, batch_size, test_reader.get_image_size())
+        keras_model = model.get_keras_model()
+        checkpoint = tf.train.Checkpoint(model=keras_model)
+
+        @tf.function
+        def eval_step(images, labels):
+            softmax = keras_model(images, training=False)
+            loss_value = model.loss_fn(labels, softmax)
+            # average across the batch (N), then reduce down to a scalar (reduce H, W)
+            loss_value = tf.reduce_sum(loss_value, axis=0) / tf.cast(tf.shape(images)[0], tf.float32)
+            loss_value = tf.reduce_mean(loss_value)
+            return loss_value, tf.argmax(softmax, axis=-1), tf.argmax(labels, axis=-1)
+
+        test_log_dir = os.path.join(output_folder, 'tensorboard-eval', 'test')
+        if not os.path.exists(test_log_dir):
+            os.makedirs(test_log_dir)
+        test_summary_writer = tf.summary.create_file_writer(test_log_dir)
+
+        print('Watching for checkpoints in: {}'.format(os.path.join(output_folder, EVAL_CHECKPOINT_FOLDER)))
+        last_activity_time = time.time()
+        while True:
+            # the trainer signals completion once it has seen the evaluation of its final epoch
+            training_complete = os.path.exists(os.path.join(output_folder, TRAINING_COMPLETE_FILENAME))
+
+            pending = list()
+            for epoch, filepath in get_epoch_checkpoints(output_folder):
+                if epoch in evaluated_epochs:
+                    delete_checkpoint(filepath)  # scored before a restart of the evaluator
+                else:
+                    pending.append((epoch, filepath))
+            if len(pending) == 0:
+                if training_complete:
+                    break
+                # a trainer which crashed or was killed never writes the completion marker
+                idle_time = time.time() - max(last_activity_time, get_trainer_heartbeat(output_folder))
+                if trainer_timeout > 0 and idle_time > trainer_timeout:
+                    print('No checkpoints and no trainer heartbeat for {:.0f} s, exiting'.format(idle_time))
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            # evaluate every epoch in order (not just the latest), early stopping counts epochs without improvement
+            epoch, filepath = pending[0]
+            try:
+                checkpoint.read(filepath).expect_partial()
+            except (tf.errors.NotFoundError, tf.errors.DataLossError) as e:
+                print('Unable to read checkpoint {}: {}'.format(filepath, e))
+                time.sleep(poll_interval)
+                continue
+
+            start_time = time.time()
+            epoch_test_loss = list()
+            cm = np.zeros((number_classes, number_classes), dtype=np.int64)
+            for step in range(test_epoch_size):
+                batch_images, batch_labels = next(test_iterator)
+                loss_value, prediction, target = eval_step(batch_images, batch_labels)
+                epoch_test_loss.append(loss_value.numpy())
+                cm += segmentation_metrics.confusion_matrix(target.numpy(), prediction.numpy(), number_classes)
+            test_loss = float(np.mean(epoch_test_loss))
+            iou = segmentation_metrics.iou(cm)
+            miou = float(np.nanmean(iou))
+            accuracy = float(np.trace(cm) / np.sum(cm))
+
+            print('Eval Epoch: {}: Loss = {} Accuracy = {} mIoU = {} ({} s)'.format(epoch, test_loss, accuracy, miou, time.time() - start_time))
+            with test_summary_writer.as_default():
+                # matches the step of the in-loop test summaries written by train_unet
+                summary_step = int(epoch * test_every_n_steps)
+                tf.summary.scalar('loss', test_loss, step=summary_step)
+                tf.summary.scalar('accuracy', accuracy, step=summary_step)
+                tf.summary.scalar('mean_iou', miou, step=summary_step)
+                for c in range(number_classes):
+                    if not np.isnan(iou[c]):
+                        tf.summary.scalar('iou_class_{}'.format(c), iou[c], step=summary_step)
+
+            if test_loss < best_loss:
+                print('Test loss improved: {}, saving checkpoint'.format(test_loss))
+                best_loss = test_loss
+                checkpoint.write(best_checkpoint_filepath)
+
+            # the results are written last, once the trainer sees an epoch its best checkpoint is in place
+            results.append((epoch, test_loss, miou))
+            evaluated_epochs.add(epoch)
+            write_eval_results(output_folder, results)
+            # scored, the trainer does not read the epoch checkpoints
+            delete_checkpoint(filepath)
+            last_activity_time = time.time()
+
+    finally:  # if any erros happened during evaluation, shut down the disk readers
+        print('Shutting down test_reader')
+        test_reader.shutdown()
+
+
+def main(output_folder, test_lmdb_filepath, number_classes, batch_size, reader_count, test_every_n_steps, poll_interval, gpu_ids, trainer_timeout):
+    print('output folder = {}'.format(output_folder))
+    print('test_database = {}'.format(test_lmdb_filepath))
+    print('number_classes = {}'.format(number_classes))
+    print('batch_size = {}'.format(batch_size))
+    print('reader_count = {}'.format(reader_count))
+    print('test_every_n_steps = {}'.format(test_every_n_steps))
+    print('poll_interval = {}'.format(poll_interval))
+    print('gpu_ids = {}'.format(gpu_ids))
+    print('trainer_timeout = {}'.format(trainer_timeout))
+
+    evaluate(output_folder, test_lmdb_filepath, number_classes, batch_size, reader_count, test_every_n_steps, poll_interval, gpu_ids, trainer_timeout)
+
+
+if __name__ == "__main__":
+    # Setup the Argument parsing
+    parser = argparse.ArgumentParser(prog='evaluator', description='Script which evaluates the checkpoints written by a train_unet run launched with --async_eval=1')
+
+    parser.add_argument('--output_dir', dest='output_folder', type=str, help='output folder of the training run to evaluate (Required)', required=True)
+    parser.add_argument('--test_database', dest='test_database_filepath', type=str, help='lmdb database to use for testing (Required)', required=True)
+
+    parser.add_argument('--batch_size', dest='batch_size', type=int, help='evaluation batch size', default=4)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--reader_count', dest='reader_count', type=int, help='how many threads to use for disk I/O', default=1)
+    parser.add_argument('--test_every_n_steps', dest='test_every_n_steps', type=int, help='test_every_n_steps of the training run, used to align the tensorboard steps', default=1000)
+    parser.add_argument('--poll_interval', dest='poll_interval', type=float, help='seconds to wait between checks for new checkpoints', default=10)
+    parser.add_argument('--gpu_ids', dest='gpu_ids', type=str, help='comma separated list of the gpu ids to evaluate on, e.g. "3". Use "" to evaluate on the CPU. Defaults to all visible devices', default=None)
+
+    parser.add_argument('--trainer_timeout', dest='trainer_timeout', type=float, help='exit once there are no checkpoints to evaluate and the trainer heartbeat is older than this many seconds, e.g. after the trainer crashed (0 = wait for the training_complete marker only)', default=1800)
+
+    args = parser.parse_args()
+
+    main(args.output_folder, args.test_database_filepath, args.number_classes, args.batch_size, args.reader_count, args.test_every_n_steps, args.poll_interval, args.gpu_ids, args.trainer_timeout)
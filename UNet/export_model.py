@@ -0,0 +1,147 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import tensorflow as tf
+tf_version = tf.__version__.split('.')
+if int(tf_version[0]) != 2:
+    raise Exception('Tensorflow 2.x.x required')
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+import numpy as np
+import inference_backends
+
+
+# Exports the SavedModel of a training run into the artifacts of the other inference backends:
+#   <output_folder>/model.tflite                       dynamic input shape, runs any image or tile size
+#   <output_folder>/model.static-NxCxHxW.tflite        fixed input shapes, which XNNPACK can fully accelerate
+#   <output_folder>/model.onnx                         dynamic input shape (requires tf2onnx, run by onnxruntime)
+
+
+def find_saved_model(model_folder):
+    # the output_dir of a training run, or the SavedModel folder itself
+    if os.path.exists(os.path.join(model_folder, 'saved_model.pb')):
+        return model_folder
+    saved_model_filepath = os.path.join(model_folder, 'saved_model')
+    if os.path.exists(os.path.join(saved_model_filepath, 'saved_model.pb')):
+        return saved_model_filepath
+    raise IOError('No SavedModel in {}'.format(model_folder))
+
+
+def export_tflite(saved_model_filepath, output_filepath, static_shape=None):
+    model = tf.saved_model.load(saved_model_filepath)
+    if static_shape is None:
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_filepath)
+    else:
+        # trace the model for a single input shape, all the intermediate shapes become static
+        concrete_function = tf.function(lambda x: model(x)).get_concrete_function(tf.TensorSpec(static_shape, tf.float32))
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], model)
+    tflite_model = converter.convert()
+    with open(output_filepath, 'wb') as fh:
+        fh.write(tflite_model)
+
+
+def export_onnx(saved_model_filepath, output_filepath, opset=13):
+    try:
+        import onnx
+        import tf2onnx  # noqa: F401, the conversion runs in a subprocess through its command line
+    except ImportError:
+        raise ImportError('The onnx export requires tf2onnx and onnx (pip install tf2onnx onnx)')
+    tmp_folder = tempfile.mkdtemp(prefix='export_onnx_')
+    try:
+        # --large_model keeps the weights out of the graph protobuf during the conversion, which otherwise takes several
+        # GB of memory for the UNet. The result is a zip of the graph and its external weights, merged back into a
+        # single .onnx file below.
+        zip_filepath = os.path.join(tmp_folder, 'model.zip')
+        subprocess.check_call([sys.executable, '-m', 'tf2onnx.convert', '--saved-model', saved_model_filepath, '--output', zip_filepath, '--opset', str(opset), '--large_model'])
+        with zipfile.ZipFile(zip_filepath) as zf:
+            zf.extractall(tmp_folder)
+        onnx_model = onnx.load(os.path.join(tmp_folder, '__MODEL_PROTO.onnx'), load_external_data=True)
+        onnx.save(onnx_model, output_filepath)
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def _check_export(saved_model_filepath, exported_filepath, batch_shape):
+    # agreement of the exported model with the SavedModel on a random input
+    batch_data = np.random.default_rng(0).standard_normal(batch_shape).astype(np.float32)
+    reference = inference_backends.SavedModelBackend(saved_model_filepath)(batch_data)
+    if inference_backends.detect_backend(exported_filepath) == 'tflite':
+        # the dynamic model itself, not the static variant of the same shape
+        backend = inference_backends.TFLiteBackend(exported_filepath, use_static_models=False)
+    else:
+        backend = inference_backends.load_backend(exported_filepath)
+    output = backend(batch_data)
+    max_difference = float(np.max(np.abs(output - reference)))
+    agreement = float(np.mean(np.argmax(output, axis=-1) == np.argmax(reference, axis=-1)))
+    print('  {} on {}: max softmax difference {:.2e}, argmax agreement {:.4%}'.format(os.path.basename(exported_filepath), 'x'.join(str(d) for d in batch_shape), max_difference, agreement))
+
+
+def main(model_folder, output_folder, formats, tflite_static_shapes, onnx_opset, check_size):
+    print('model_folder = {}'.format(model_folder))
+    print('output_folder = {}'.format(output_folder))
+    print('formats = {}'.format(formats))
+    print('tflite_static_shapes = {}'.format(tflite_static_shapes))
+    print('onnx_opset = {}'.format(onnx_opset))
+    print('check_size = {}'.format(check_size))
+
+    saved_model_filepath = find_saved_model(model_folder)
+    if output_folder is None:
+        output_folder = os.path.join(os.path.dirname(os.path.abspath(saved_model_filepath)), 'exported')
+    os.makedirs(output_folder, exist_ok=True)
+
+    # the number of channels is part of the SavedModel input signature (NCHW)
+    signature = tf.saved_model.load(saved_model_filepath).signatures['serving_default']
+    number_channels = int(list(signature.structured_input_signature[1].values())[0].shape[1])
+    check_shape = [1, number_channels, check_size, check_size]
+
+    exported = list()
+    for fmt in formats:
+        start_time = time.time()
+        if fmt == 'tflite':
+            output_filepath = os.path.join(output_folder, 'model.tflite')
+            export_tflite(saved_model_filepath, output_filepath)
+            exported.append((output_filepath, check_shape))
+            for batch_size, height, width in tflite_static_shapes:
+                batch_shape = [batch_size, number_channels, height, width]
+                static_filepath = inference_backends.get_static_tflite_filepath(output_filepath, batch_shape)
+                export_tflite(saved_model_filepath, static_filepath, batch_shape)
+                exported.append((static_filepath, batch_shape))
+        elif fmt == 'onnx':
+            output_filepath = os.path.join(output_folder, 'model.onnx')
+            export_onnx(saved_model_filepath, output_filepath, onnx_opset)
+            exported.append((output_filepath, check_shape))
+        else:
+            raise ValueError('Unknown export format: {}, expecting tflite or onnx'.format(fmt))
+        print('Exported {} in {:.1f} s'.format(fmt, time.time() - start_time))
+
+    print('Checking the exported models against {}'.format(saved_model_filepath))
+    for exported_filepath, batch_shape in exported:
+        _check_export(saved_model_filepath, exported_filepath, batch_shape)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='export_model', description='Export the SavedModel of a training run for the tflite and onnx inference backends')
+
+    parser.add_argument('--model_folder', dest='model_folder', type=str, help='output_dir of a training run, or a SavedModel folder (Required)', required=True)
+    parser.add_argument('--output_folder', dest='output_folder', type=str, help='folder to write the exported models into [default: exported/ next to the SavedModel]', default=None)
+    parser.add_argument('--formats', dest='formats', type=str, help='comma separated list of formats to export [tflite, onnx]', default='tflite,onnx')
+    parser.add_argument('--tflite_static_shapes', dest='tflite_static_shapes', type=str, help='comma separated list of BxHxW input shapes to also export fixed shape tflite models for, e.g. the tile_batch_size x tile_size x tile_size of the interior tiles, or the size of whole images', default='')
+    parser.add_argument('--onnx_opset', dest='onnx_opset', type=int, default=13)
+    parser.add_argument('--check_size', dest='check_size', type=int, help='size of the random image the exported models are checked against the SavedModel with (a multiple of 16)', default=256)
+
+    args = parser.parse_args()
+    formats = [f.strip() for f in args.formats.split(',') if len(f.strip()) > 0]
+    tflite_static_shapes = [[int(v) for v in s.split('x')] for s in args.tflite_static_shapes.split(',') if len(s.strip()) > 0]
+
+    main(args.model_folder, args.output_folder, formats, tflite_static_shapes, args.onnx_opset, args.check_size)
@@ -24,6 +24,8 @@ import skimage.io
 import skimage.transform
 from isg_ai_pb2 import ImageMaskPair
 import unet_model
+import dataset_server
+import dataset_staging
 
 
 def zscore_normalize(image_data):
@@ -64,6 +66,18 @@ def imwrite(img, fp):
     skimage.io.imsave(fp, img)
 
 
+def get_database_image_size(img_db):
+    # [H, W, C] of the records in the database (all records share the size of the first one)
+    datum = ImageMaskPair()
+    lmdb_env = lmdb.open(img_db, map_size=int(2e10), readonly=True)
+    with lmdb_env.begin(write=False) as lmdb_txn:
+        cursor = lmdb_txn.cursor()
+        cursor.first()
+        datum.ParseFromString(cursor.value())
+    lmdb_env.close()
+    return [datum.img_height, datum.img_width, datum.channels]
+
+
 class ImageReader:
     # setup the image data augmentation parameters
     _reflection_flag = True
@@ -74,7 +88,14 @@ class ImageReader:
     _blur_max_sigma = 2  # pixels
     _intensity_augmentation_severity = None # vary intensity by x% of the dynamic range present in the image
 
-    def __init__(self, img_db, use_augmentation=True, balance_classes=False, shuffle=True, num_workers=1, number_classes=2):
+    # loss driven sampling parameters
+    _loss_sampling_momentum = 0.5  # weight of the previous loss of a record when a new one is reported
+    _loss_sampling_refresh = 100  # number of samples each worker draws before rebuilding its sampling distribution
+
+    # number of decoded records each worker holds when producing several samples per decode
+    _decode_pool_size = 32
+
+    def __init__(self, img_db, use_augmentation=True, balance_classes=False, shuffle=True, num_workers=1, number_classes=2, shard_index=0, shard_count=1, dynamic_crop=False, loss_sampling=False, loss_sampling_floor=0.2, samples_per_decode=1, dataset_server_address=None, staging_cache=None):
         random.seed()
 
         # copy inputs to class variables
@@ -84,6 +105,45 @@ class ImageReader:
         self.shuffle = shuffle
         self.nb_workers = num_workers
         self.nb_classes = number_classes
+        # when training across several workers each reader only serves its own (disjoint) shard of the database keys
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.total_image_count = 0
+        # with dynamic_crop the workers cut random crops of crop_size out of each record (before augmentation) and the
+        # dataset has variable spatial dimensions. The crop size is shared with the workers, so it can be changed
+        # while they run [0 = full size records]
+        self.dynamic_crop = dynamic_crop
+        self.crop_size = multiprocessing.Value('i', 0)
+        # with loss_sampling records are drawn with a probability proportional to their recent training loss (as
+        # reported back by the training loop), plus a uniform floor so every record keeps being seen. The dataset
+        # carries the key id of each record so its loss can be attributed.
+        self.loss_sampling = loss_sampling
+        self.loss_sampling_floor = loss_sampling_floor
+        if loss_sampling and (balance_classes or not shuffle):
+            raise ValueError('loss_sampling cannot be combined with balance_classes, and requires shuffle')
+        if not 0 <= loss_sampling_floor <= 1:
+            raise ValueError('loss_sampling_floor must be in [0, 1]')
+        self.sample_losses = None
+        self.sampling_cdf = None
+        self.sampling_draws = 0
+        # each decoded record produces samples_per_decode independently augmented samples, which amortizes the lmdb
+        # fetch and decode when I/O dominates. The samples are drawn at random from a pool of decoded records, so
+        # samples of the same record are spread out instead of landing in the same batch.
+        if samples_per_decode < 1:
+            raise ValueError('samples_per_decode must be >= 1')
+        if samples_per_decode > 1 and not shuffle:
+            raise ValueError('samples_per_decode > 1 requires shuffle')
+        self.samples_per_decode = samples_per_decode
+        # with a dataset_server_address the workers fetch records already decoded by a local dataset_server process
+        # (shared between several trainers) instead of reading the lmdb themselves
+        self.dataset_server_address = dataset_server_address
+        if dataset_server_address is not None and staging_cache is not None:
+            raise ValueError('staging_cache cannot be combined with dataset_server_address')
+        # with a staging_cache folder the database is copied to node local storage in the background, the workers
+        # switch from the source database to the staged copy once it is complete
+        self.staging_cache = staging_cache
+        self.stager = None
+        self.using_staged_copy = False
 
         # init class state
         self.queue_starvation = False
@@ -96,53 +156,84 @@ class ImageReader:
         self.outQ = multiprocessing.Queue(maxsize=self.maxOutQSize)  # limit output queue size
         self.idQ = multiprocessing.Queue(maxsize=self.nb_workers)
 
-        # confirm that the input database exists
-        if not os.path.exists(self.image_db):
-            print('Could not load database file: ')
-            print(self.image_db)
-            raise IOError("Missing Database")
-
         # get a list of keys from the lmdb
         self.keys_flat = list()
         self.keys = list()
         self.keys.append(list())  # there will always be at least one class
 
-        self.lmdb_env = lmdb.open(self.image_db, map_size=int(2e10), readonly=True) # 20 GB
+        self.lmdb_env = None
         self.lmdb_txns = list()
 
-        datum = ImageMaskPair()  # create a datum for decoding serialized protobuf objects
         print('Initializing image database')
 
-        with self.lmdb_env.begin(write=False) as lmdb_txn:
-            cursor = lmdb_txn.cursor()
-
-            # move cursor to the first element
-            cursor.first()
-            # get the first serialized value from the database and convert from serialized representation
-            datum.ParseFromString(cursor.value())
-            # record the image size
-            self.image_size = [datum.img_height, datum.img_width, datum.channels]
-
-            if self.image_size[0] % unet_model.UNet.SIZE_FACTOR != 0:
-                raise IOError('Input Image tile height needs to be a multiple of 16 to allow integer sized downscaled feature maps. Input images should be either HW or HWC dimension ordering')
-            if self.image_size[1] % unet_model.UNet.SIZE_FACTOR != 0:
-                raise IOError('Input Image tile height needs to be a multiple of 16 to allow integer sized downscaled feature maps. Input images should be either HW or HWC dimension ordering')
-
-            cursor = lmdb_txn.cursor().iternext(keys=True, values=False)
-            # iterate over the database getting the keys
-            for key in cursor:
-                self.keys_flat.append(key)
-
-                if self.balance_classes:
-                    present_classes_str = key.decode('ascii').split(':')[1]
-                    present_classes_str = present_classes_str.split(',')
-                    for k in present_classes_str:
-                        k = int(k)
-                        while len(self.keys) <= k:
-                            self.keys.append(list())
-                        self.keys[k].append(key)
-
-        print('Dataset has {} examples'.format(len(self.keys_flat)))
+        if self.dataset_server_address is None:
+            # confirm that the input database exists
+            if not os.path.exists(self.image_db):
+                print('Could not load database file: ')
+                print(self.image_db)
+                raise IOError("Missing Database")
+
+            lmdb_filepath = self.image_db
+            if self.staging_cache is not None:
+                self.stager = dataset_staging.DatasetStager(self.image_db, self.staging_cache)
+                if self.stager.ready.is_set():
+                    # staged by an earlier job on this node
+                    lmdb_filepath = self.stager.staged_filepath
+                    self.using_staged_copy = True
+
+            self.lmdb_env = lmdb.open(lmdb_filepath, map_size=int(2e10), readonly=True) # 20 GB
+
+            datum = ImageMaskPair()  # create a datum for decoding serialized protobuf objects
+
+            with self.lmdb_env.begin(write=False) as lmdb_txn:
+                cursor = lmdb_txn.cursor()
+
+                # move cursor to the first element
+                cursor.first()
+                # get the first serialized value from the database and convert from serialized representation
+                datum.ParseFromString(cursor.value())
+                # record the image size
+                self.image_size = [datum.img_height, datum.img_width, datum.channels]
+
+                database_keys = [key for key in lmdb_txn.cursor().iternext(keys=True, values=False)]
+        else:
+            print('Using dataset server at {}'.format(self.dataset_server_address))
+            connection = dataset_server.connect(self.dataset_server_address)
+            info = dataset_server.get_info(connection)
+            connection.close()
+            self.image_size = list(info['image_size'])
+            database_keys = info['keys']
+
+        if self.image_size[0] % unet_model.UNet.SIZE_FACTOR != 0:
+            raise IOError('Input Image tile height needs to be a multiple of 16 to allow integer sized downscaled feature maps. Input images should be either HW or HWC dimension ordering')
+        if self.image_size[1] % unet_model.UNet.SIZE_FACTOR != 0:
+            raise IOError('Input Image tile height needs to be a multiple of 16 to allow integer sized downscaled feature maps. Input images should be either HW or HWC dimension ordering')
+
+        # iterate over the database getting the keys
+        for key in database_keys:
+            self.total_image_count += 1
+            if (self.total_image_count - 1) % self.shard_count != self.shard_index:
+                continue  # key belongs to a different shard
+            self.keys_flat.append(key)
+
+            if self.balance_classes:
+                present_classes_str = key.decode('ascii').split(':')[1]
+                present_classes_str = present_classes_str.split(',')
+                for k in present_classes_str:
+                    k = int(k)
+                    while len(self.keys) <= k:
+                        self.keys.append(list())
+                    self.keys[k].append(key)
+
+        if self.shard_count > 1:
+            print('Dataset shard {}/{} has {} of {} examples'.format(self.shard_index, self.shard_count, len(self.keys_flat), self.total_image_count))
+        else:
+            print('Dataset has {} examples'.format(len(self.keys_flat)))
+        if self.loss_sampling:
+            # one float32 per record in shared memory, written by the training process and read by the workers
+            # nan marks records without a reported loss yet, they are sampled like the hardest record seen so far
+            self.sample_losses = multiprocessing.Array('f', len(self.keys_flat), lock=False)
+            np.ctypeslib.as_array(self.sample_losses)[:] = np.nan
         if self.balance_classes:
             print('Dataset Example Count by Class:')
             for i in range(len(self.keys)):
@@ -152,9 +243,28 @@ class ImageReader:
         # tie epoch size to the number of images
         return int(len(self.keys_flat))
 
+    def get_total_image_count(self):
+        # number of images in the database, across all shards
+        return int(self.total_image_count)
+
     def get_image_size(self):
         return self.image_size
 
+    def set_crop_size(self, crop_size):
+        # 0 returns to full size records
+        if not self.dynamic_crop:
+            raise RuntimeError('ImageReader was not created with dynamic_crop enabled')
+        if crop_size < 0 or crop_size % unet_model.UNet.SIZE_FACTOR != 0:
+            raise ValueError('crop size must be a multiple of {}'.format(unet_model.UNet.SIZE_FACTOR))
+        self.crop_size.value = crop_size
+
+    def get_crop_shape(self):
+        # [H, W] of the images currently being produced
+        crop_size = self.crop_size.value
+        if crop_size <= 0:
+            return [self.image_size[0], self.image_size[1]]
+        return [min(crop_size, self.image_size[0]), min(crop_size, self.image_size[1])]
+
     def get_image_tensor_shape(self):
         # HWC to CHW
         return [self.image_size[2], self.image_size[0], self.image_size[1]]
@@ -167,7 +277,8 @@ class ImageReader:
         self.done = False
 
         [self.idQ.put(i) for i in range(self.nb_workers)]
-        [self.lmdb_txns.append(self.lmdb_env.begin(write=False)) for i in range(self.nb_workers)]
+        if self.lmdb_env is not None:
+            [self.lmdb_txns.append(self.lmdb_env.begin(write=False)) for i in range(self.nb_workers)]
         # launch workers
         self.workers = [Process(target=self.__image_loader) for i in range(self.nb_workers)]
         
@@ -175,6 +286,9 @@ class ImageReader:
         for w in self.workers:
             w.start()
 
+        if self.stager is not None:
+            self.stager.start()
+
     def shutdown(self):
         # tell workers to shutdown
         for w in self.workers:
@@ -224,13 +338,52 @@ class ImageReader:
 
         return fn
 
+    def report_sample_losses(self, key_ids, losses):
+        # record the training loss of the records with the given key ids (called by the training process)
+        key_ids = np.asarray(key_ids, dtype=np.int64)
+        losses = np.asarray(losses, dtype=np.float32)
+        shared_losses = np.ctypeslib.as_array(self.sample_losses)
+        previous = shared_losses[key_ids]
+        m = self._loss_sampling_momentum
+        shared_losses[key_ids] = np.where(np.isnan(previous), losses, m * previous + (1 - m) * losses)
+
+    def __get_next_loss_weighted_key_id(self):
+        # the sampling distribution is cached and only periodically rebuilt from the shared losses
+        if self.sampling_cdf is None or self.sampling_draws >= self._loss_sampling_refresh:
+            losses = np.array(np.ctypeslib.as_array(self.sample_losses), dtype=np.float64)
+            if np.all(np.isnan(losses)):
+                losses[:] = 1.0
+            else:
+                losses[np.isnan(losses)] = np.nanmax(losses)
+            losses = np.maximum(losses, 0)
+            n = len(losses)
+            total = np.sum(losses)
+            if total > 0:
+                p = (1 - self.loss_sampling_floor) * losses / total + self.loss_sampling_floor / n
+            else:
+                p = np.full(n, 1.0 / n)
+            self.sampling_cdf = np.cumsum(p)
+            self.sampling_draws = 0
+        self.sampling_draws += 1
+        key_id = int(np.searchsorted(self.sampling_cdf, random.random() * self.sampling_cdf[-1], side='right'))
+        return min(key_id, len(self.sampling_cdf) - 1)
+
     def __image_loader(self):
         termimation_flag = False  # flag to control the worker shutdown
         self.key_idx = self.idQ.get()  # setup non-shuffle index to stride across flat keys properly
         try:
             datum = ImageMaskPair()  # create a datum for decoding serialized caffe_pb2 objects
 
-            local_lmdb_txn = self.lmdb_txns[self.key_idx]
+            using_staged_copy = self.stager is None or self.using_staged_copy
+            if self.dataset_server_address is None:
+                local_lmdb_txn = self.lmdb_txns[self.key_idx]
+            else:
+                # each worker needs its own connection, they cannot be shared across processes
+                server_connection = dataset_server.connect(self.dataset_server_address)
+
+            # decoded records waiting to be turned into samples, entries are [image, mask, key id, samples remaining]
+            decoded_pool = list()
+            pool_size = self._decode_pool_size if self.samples_per_decode > 1 else 1
 
             # while the worker has not been told to terminate, loop infinitely
             while not termimation_flag:
@@ -243,28 +396,64 @@ class ImageReader:
                 except queue.Empty:
                     pass  # do nothing
 
-                # build a single image selecting the labels using round robin through the shuffled order
-
-                fn = self.__get_next_key()
-
-                # extract the serialized image from the database
-                value = local_lmdb_txn.get(fn)
-                # convert from serialized representation
-                datum.ParseFromString(value)
-
-                # convert from string to numpy array
-                I = np.fromstring(datum.image, dtype=datum.img_type)
-                # reshape the numpy array using the dimensions recorded in the datum
-                I = I.reshape((datum.img_height, datum.img_width, datum.channels))
+                if not using_staged_copy and self.stager.ready.is_set():
+                    # the background staging completed, read from node local storage from now on
+                    staged_lmdb_env = lmdb.open(self.stager.staged_filepath, map_size=int(2e10), readonly=True, lock=False)
+                    local_lmdb_txn = staged_lmdb_env.begin(write=False)
+                    using_staged_copy = True
+
+                if len(decoded_pool) < pool_size:
+                    # build a single image selecting the labels using round robin through the shuffled order
+                    key_id = None
+                    if self.loss_sampling:
+                        key_id = self.__get_next_loss_weighted_key_id()
+                        fn = self.keys_flat[key_id]
+                    else:
+                        fn = self.__get_next_key()
+
+                    if self.dataset_server_address is None:
+                        # extract the serialized image from the database
+                        value = local_lmdb_txn.get(fn)
+                        # convert from serialized representation
+                        datum.ParseFromString(value)
+
+                        # convert from string to numpy array
+                        I = np.fromstring(datum.image, dtype=datum.img_type)
+                        # reshape the numpy array using the dimensions recorded in the datum
+                        I = I.reshape((datum.img_height, datum.img_width, datum.channels))
+
+                        # convert from string to numpy array
+                        M = np.fromstring(datum.mask, dtype=datum.mask_type)
+                        # reshape the numpy array using the dimensions recorded in the datum
+                        M = M.reshape(datum.img_height, datum.img_width)
+                    else:
+                        # private copies of the record as decoded (once, for every trainer) by the dataset server
+                        I, M = dataset_server.fetch_record(server_connection, fn)
+                    # cast once per decode, the augmentation and normalization never modify the pooled arrays in place
+                    I = I.astype(np.float32)
 
-                # convert from string to numpy array
-                M = np.fromstring(datum.mask, dtype=datum.mask_type)
-                # reshape the numpy array using the dimensions recorded in the datum
-                M = M.reshape(datum.img_height, datum.img_width)
+                    decoded_pool.append([I, M, key_id, self.samples_per_decode])
+
+                # take the next sample from a random decoded record
+                pool_idx = random.randint(0, len(decoded_pool) - 1) if len(decoded_pool) > 1 else 0
+                I, M, key_id, _ = decoded_pool[pool_idx]
+                decoded_pool[pool_idx][3] -= 1
+                if decoded_pool[pool_idx][3] <= 0:
+                    # record used up, swap remove it from the pool
+                    decoded_pool[pool_idx] = decoded_pool[-1]
+                    decoded_pool.pop()
+
+                crop_size = self.crop_size.value
+                if crop_size > 0:
+                    # random crop before augmentation, so the augmentation cost shrinks with the crop
+                    crop_h = min(crop_size, I.shape[0])
+                    crop_w = min(crop_size, I.shape[1])
+                    y_st = random.randint(0, I.shape[0] - crop_h)
+                    x_st = random.randint(0, I.shape[1] - crop_w)
+                    I = I[y_st:y_st + crop_h, x_st:x_st + crop_w, :]
+                    M = M[y_st:y_st + crop_h, x_st:x_st + crop_w]
 
                 if self.use_augmentation:
-                    I = I.astype(np.float32)
-
                     # perform image data augmentation
                     I, M = augment.augment_image(I, M,
                                                  reflection_flag=self._reflection_flag,
@@ -295,7 +484,10 @@ class ImageReader:
 
                 # add the batch in the output queue
                 # this put block until there is space in the output queue (size 50)
-                self.outQ.put((I, fM))
+                if self.loss_sampling:
+                    self.outQ.put((I, fM, key_id))
+                else:
+                    self.outQ.put((I, fM))
 
         except Exception as e:
             print('***************** Reader Error *****************')
@@ -318,10 +510,14 @@ class ImageReader:
         return self.outQ.get()
 
     def generator(self):
+        # the crop size only changes between passes over the dataset
+        crop_shape = self.get_crop_shape()
         while True:
             batch = self.get_example()
             if batch is None:
                 return
+            if self.dynamic_crop and (batch[0].shape[1] != crop_shape[0] or batch[0].shape[2] != crop_shape[1]):
+                continue  # produced before the crop size changed
             yield batch
 
     def get_queue_size(self):
@@ -334,6 +530,13 @@ class ImageReader:
         # Images come in as HWC, and are converted into CHW for network
         image_shape = tf.TensorShape((self.image_size[2], self.image_size[0], self.image_size[1]))
         label_shape = tf.TensorShape((self.image_size[0], self.image_size[1], self.nb_classes))
+        if self.dynamic_crop:
+            # the model accepts any spatial size which is a multiple of 16
+            image_shape = tf.TensorShape((self.image_size[2], None, None))
+            label_shape = tf.TensorShape((None, None, self.nb_classes))
+        if self.loss_sampling:
+            # the key id of each record is passed through the dataset, so its loss can be reported back
+            return tf.data.Dataset.from_generator(self.generator, output_types=(tf.float32, tf.int32, tf.int32), output_shapes=(image_shape, label_shape, tf.TensorShape(())))
         return tf.data.Dataset.from_generator(self.generator, output_types=(tf.float32, tf.int32), output_shapes=(image_shape, label_shape))
 
 
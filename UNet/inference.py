@@ -13,14 +13,55 @@ if int(tf_version[0]) != 2:
     raise Exception('Tensorflow 2.x.x required')
 
 import argparse
+import itertools
+import json
+import multiprocessing
 import os
+import queue
+import threading
+import time
 import unet_model
 import numpy as np
 import imagereader
+import inference_backends
+import profile_window
+import memory_probe
+import result_cache
+import streaming_io
 import skimage.io
 
 
-def _inference_tiling(img, model, tile_size):
+class EmptyTileFilter():
+    # Tiles whose raw intensities are flat (standard deviation below std_threshold in every channel) or dark (maximum
+    # below max_threshold) are assigned background_class without running the model. A threshold of 0 disables its test.
+    # The statistics are taken over the whole tile including its halo, so a tile is only skipped when everything the
+    # model would see is background.
+    def __init__(self, std_threshold=0.0, max_threshold=0.0, background_class=0):
+        self.std_threshold = std_threshold
+        self.max_threshold = max_threshold
+        self.background_class = background_class
+
+    def is_empty(self, raw_tile):
+        if self.std_threshold > 0:
+            channel_std = np.std(raw_tile.reshape(-1, raw_tile.shape[-1]) if raw_tile.ndim == 3 else raw_tile.reshape(-1, 1), axis=0)
+            if np.all(channel_std < self.std_threshold):
+                return True
+        if self.max_threshold > 0 and np.max(raw_tile) < self.max_threshold:
+            return True
+        return False
+
+
+def _count_tile(tile_counts, pixels, skipped):
+    if tile_counts is None:
+        return
+    tile_counts['tiles'] = tile_counts.get('tiles', 0) + 1
+    tile_counts['pixels'] = tile_counts.get('pixels', 0) + pixels
+    if skipped:
+        tile_counts['skipped_tiles'] = tile_counts.get('skipped_tiles', 0) + 1
+        tile_counts['skipped_pixels'] = tile_counts.get('skipped_pixels', 0) + pixels
+
+
+def _inference_tiling(img, model, tile_size, batch_size=1, raw_img=None, empty_tile_filter=None, tile_counts=None):
 
     # Pad the input image in CPU memory to ensure its dimensions are multiples of the U-Net Size Factor
     pad_x = 0
@@ -41,6 +82,11 @@ def _inference_tiling(img, model, tile_size):
     if pad_x > 0 or pad_y > 0:
         img = np.pad(img, pad_width=((0, pad_y), (0, pad_x), (0, 0)), mode='reflect')
         print('Padded Image Size: {}'.format(img.shape))
+    if empty_tile_filter is not None:
+        # the empty tile statistics come from the raw image, padded the same way
+        raw_img = raw_img.reshape(img.shape[0] - pad_y, img.shape[1] - pad_x, img.shape[2])
+        if pad_x > 0 or pad_y > 0:
+            raw_img = np.pad(raw_img, pad_width=((0, pad_y), (0, pad_x), (0, 0)), mode='reflect')
 
     height = img.shape[0]
     width = img.shape[1]
@@ -51,75 +97,49 @@ def _inference_tiling(img, model, tile_size):
     assert radius % unet_model.UNet.SIZE_FACTOR == 0
     zone_of_responsibility_size = tile_size - 2 * radius
 
+    # tiles are grouped by shape, interior tiles share a single shape and the tiles clipped at the image border a few
+    # more. Each group goes through the model in batches of batch_size, so the model sees at most 9 distinct input
+    # shapes per image size. Every tile keeps exactly the pixels it would have on its own, so the output does not
+    # depend on the batch size.
+    tile_groups = dict()
     for i in range(0, height, zone_of_responsibility_size):
         for j in range(0, width, zone_of_responsibility_size):
 
             x_st_z = j
             y_st_z = i
-            x_end_z = x_st_z + zone_of_responsibility_size
-            y_end_z = y_st_z + zone_of_responsibility_size
-
-            # pad zone of responsibility by radius
-            x_st = x_st_z - radius
-            y_st = y_st_z - radius
-            x_end = x_end_z + radius
-            y_end = y_end_z + radius
-
-            radius_pre_x = radius
-            if x_st < 0:
-                x_st = 0
-                radius_pre_x = 0
-
-            radius_pre_y = radius
-            if y_st < 0:
-                radius_pre_y = 0
-                y_st = 0
-
-            radius_post_x = radius
-            if x_end > width:
-                radius_post_x = 0
-                x_end = width
-                x_end_z = width
-
-            radius_post_y = radius
-            if y_end > height:
-                radius_post_y = 0
-                y_end = height
-                y_end_z = height
-
-            # crop out the tile
-            tile = img[y_st:y_end, x_st:x_end]
-
-            # convert HWC to CHW
-            batch_data = tile.transpose((2, 0, 1))
-            # convert CHW to NCHW
-            batch_data = batch_data.reshape((1, batch_data.shape[0], batch_data.shape[1], batch_data.shape[2]))
+            x_end_z = min(x_st_z + zone_of_responsibility_size, width)
+            y_end_z = min(y_st_z + zone_of_responsibility_size, height)
+
+            # pad zone of responsibility by radius, clipped to the image
+            x_st = max(x_st_z - radius, 0)
+            y_st = max(y_st_z - radius, 0)
+            x_end = min(x_st_z + zone_of_responsibility_size + radius, width)
+            y_end = min(y_st_z + zone_of_responsibility_size + radius, height)
+
+            tile_shape = (y_end - y_st, x_end - x_st)
+            skipped = empty_tile_filter is not None and empty_tile_filter.is_empty(raw_img[y_st:y_end, x_st:x_end])
+            _count_tile(tile_counts, tile_shape[0] * tile_shape[1], skipped)
+            if skipped:
+                mask[y_st_z:y_end_z, x_st_z:x_end_z] = empty_tile_filter.background_class
+                continue
+            tile_groups.setdefault(tile_shape, list()).append((y_st, y_end, x_st, x_end, y_st_z, y_end_z, x_st_z, x_end_z))
+
+    for tile_shape, tiles in tile_groups.items():
+        for b in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[b:b + batch_size]
+
+            # crop out the tiles, converting HWC to CHW. The last batch of a group is not padded to batch_size, the
+            # border groups are small and padding them would multiply their compute
+            batch_data = np.zeros((len(batch_tiles), img.shape[2], tile_shape[0], tile_shape[1]), dtype=img.dtype)
+            for k, (y_st, y_end, x_st, x_end, _, _, _, _) in enumerate(batch_tiles):
+                batch_data[k] = img[y_st:y_end, x_st:x_end].transpose((2, 0, 1))
 
             sm = model(batch_data)  # model output defined in unet_model is softmax
-            sm = np.squeeze(sm)
-            pred = np.squeeze(np.argmax(sm, axis=-1).astype(np.int32))
-
-            # radius_pre_x
-            if radius_pre_x > 0:
-                pred = pred[:, radius_pre_x:]
-                sm = sm[:, radius_pre_x:]
-
-            # radius_pre_y
-            if radius_pre_y > 0:
-                pred = pred[radius_pre_y:, :]
-                sm = sm[radius_pre_y:, :]
+            pred = np.argmax(sm, axis=-1).astype(np.int32)
 
-            # radius_post_x
-            if radius_post_x > 0:
-                pred = pred[:, :-radius_post_x]
-                sm = sm[:, :-radius_post_x]
-
-            # radius_post_y
-            if radius_post_y > 0:
-                pred = pred[:-radius_post_y, :]
-                sm = sm[:-radius_post_y, :]
-
-            mask[y_st_z:y_end_z, x_st_z:x_end_z] = pred
+            # scatter the zone of responsibility of each tile into the mask, dropping the radius around it
+            for k, (y_st, y_end, x_st, x_end, y_st_z, y_end_z, x_st_z, x_end_z) in enumerate(batch_tiles):
+                mask[y_st_z:y_end_z, x_st_z:x_end_z] = pred[k, y_st_z - y_st:y_end_z - y_st, x_st_z - x_st:x_end_z - x_st]
 
     # undo and CPU side image padding to make the image a multiple of U-Net Size Factor
     if pad_x > 0:
@@ -129,6 +149,95 @@ def _inference_tiling(img, model, tile_size):
     return mask
 
 
+def _inference_streaming(lazy_img, mean, std, model, tile_size, batch_size, output_filepath, empty_tile_filter=None, tile_counts=None):
+    # tiled inference of an image on disk: each tile is read and normalized on its own, and the mask is written tile by
+    # tile into a tiled BigTIFF, so the memory use is bounded by a few batches of tiles whatever the image size. The
+    # tiles are the same as those of _inference_tiling.
+    height, width = lazy_img.shape[0], lazy_img.shape[1]
+    size_factor = unet_model.UNet.SIZE_FACTOR
+    # the image is (virtually) reflect padded to a multiple of the U-Net Size Factor
+    padded_height = height + (size_factor - height % size_factor) % size_factor
+    padded_width = width + (size_factor - width % size_factor) % size_factor
+
+    radius = unet_model.UNet.RADIUS
+    assert tile_size % size_factor == 0
+    assert radius % size_factor == 0
+    zone_of_responsibility_size = tile_size - 2 * radius
+
+    # the zones of responsibility, in row major order, are the tiles of the output tiff
+    zones = list()
+    for i in range(0, padded_height, zone_of_responsibility_size):
+        for j in range(0, padded_width, zone_of_responsibility_size):
+            y_end_z = min(i + zone_of_responsibility_size, padded_height)
+            x_end_z = min(j + zone_of_responsibility_size, padded_width)
+            y_st = max(i - radius, 0)
+            x_st = max(j - radius, 0)
+            y_end = min(i + zone_of_responsibility_size + radius, padded_height)
+            x_end = min(j + zone_of_responsibility_size + radius, padded_width)
+            zones.append((y_st, y_end, x_st, x_end, i, y_end_z, j, x_end_z))
+
+    def read_tile(y_st, y_end, x_st, x_end):
+        tile = lazy_img.read_region(y_st, min(y_end, height), x_st, min(x_end, width))
+        if y_end > height or x_end > width:
+            # same as reflect padding the whole image, the padding is smaller than the tile
+            tile = np.pad(tile, pad_width=((0, max(y_end - height, 0)), (0, max(x_end - width, 0)), (0, 0)), mode='reflect')
+        return tile
+
+    number_classes = list()
+
+    def output_tiles():
+        for b in range(0, len(zones), batch_size):
+            batch_zones = zones[b:b + batch_size]
+            preds = [None] * len(batch_zones)
+            # consecutive zones of the same shape (most of each row) go through the model together
+            tile_groups = dict()
+            for k, (y_st, y_end, x_st, x_end, y_st_z, y_end_z, x_st_z, x_end_z) in enumerate(batch_zones):
+                tile = read_tile(y_st, y_end, x_st, x_end)
+                skipped = empty_tile_filter is not None and empty_tile_filter.is_empty(tile)
+                _count_tile(tile_counts, tile.shape[0] * tile.shape[1], skipped)
+                if skipped:
+                    preds[k] = np.full((y_end_z - y_st_z, x_end_z - x_st_z), empty_tile_filter.background_class, dtype=np.int32)
+                    continue
+                tile_groups.setdefault(tile.shape[0:2], list()).append((k, streaming_io.normalize(tile, mean, std).transpose((2, 0, 1))))
+            for tile_shape, group in tile_groups.items():
+                ks = [k for k, _ in group]
+                batch_data = np.stack([t for _, t in group])
+                sm = model(batch_data)  # model output defined in unet_model is softmax
+                if len(number_classes) == 0:
+                    number_classes.append(int(sm.shape[-1]))
+                pred = np.argmax(sm, axis=-1)
+                for n, k in enumerate(ks):
+                    y_st, y_end, x_st, x_end, y_st_z, y_end_z, x_st_z, x_end_z = batch_zones[k]
+                    preds[k] = pred[n, y_st_z - y_st:y_end_z - y_st, x_st_z - x_st:x_end_z - x_st]
+
+            for k, (y_st, y_end, x_st, x_end, y_st_z, y_end_z, x_st_z, x_end_z) in enumerate(batch_zones):
+                # drop the padding to the size factor, and fill the tiles at the right and bottom border up to full size
+                out_tile = np.zeros((zone_of_responsibility_size, zone_of_responsibility_size), dtype=np.int32)
+                h = min(y_end_z, height) - y_st_z
+                w = min(x_end_z, width) - x_st_z
+                out_tile[:h, :w] = preds[k][:h, :w]
+                yield out_tile
+
+    tiles = output_tiles()
+    # the first tiles are computed before the tiff is created, as the number of classes determines its dtype
+    first_tile = next(tiles)
+    if len(number_classes) == 0:
+        # every tile of the first batch was empty, a minimal forward pass gives the number of classes
+        number_classes.append(int(model(np.zeros((1, lazy_img.shape[2], size_factor, size_factor), dtype=np.float32)).shape[-1]))
+    dtype = np.uint8 if number_classes[0] <= 256 else (np.uint16 if number_classes[0] <= 65536 else np.int32)
+    all_tiles = (t.astype(dtype) for t in itertools.chain([first_tile], tiles))
+
+    output_folder, output_filename = os.path.split(output_filepath)
+    tmp_filepath = os.path.join(output_folder, '.tmp-{}-{}'.format(os.getpid(), output_filename))
+    try:
+        streaming_io.write_tiled_tiff(tmp_filepath, (height, width), dtype, zone_of_responsibility_size, all_tiles)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+    os.replace(tmp_filepath, output_filepath)
+
+
 def _inference(img, model):
     pad_x = 0
     pad_y = 0
@@ -165,61 +274,540 @@ def _inference(img, model):
     return pred
 
 
-def main(saved_model_filepath, image_folder, output_folder, image_format):
+def _load_image(img_filepath, keep_raw=False):
+    raw_img = imagereader.imread(img_filepath)
+    img = raw_img.astype(np.float32)
+
+    # normalize with whole image stats
+    img = imagereader.zscore_normalize(img)
+    if keep_raw:
+        # the empty tile filter works on the raw intensities
+        return img, raw_img
+    return img
+
+
+def _open_streaming_image(img_filepath):
+    # the chunked statistics pass reads the whole image once, without holding it in memory
+    lazy_img = streaming_io.LazyImage(img_filepath)
+    mean, std = streaming_io.compute_normalization(lazy_img)
+    return lazy_img, mean, std
+
+
+def _segment_image(img, model, tile_size=1024, tile_batch_size=1, raw_img=None, empty_tile_filter=None, tile_counts=None):
+    # in theory UNet takes about 420x the amount of memory of the input image
+    # to a tile size of 1024 should require 1.7 GB of GPU memory
+    if img.shape[0] > tile_size or img.shape[1] > tile_size:
+        return _inference_tiling(img, model, tile_size, tile_batch_size, raw_img, empty_tile_filter, tile_counts)
+    # an image within the tile size is a single tile
+    skipped = empty_tile_filter is not None and empty_tile_filter.is_empty(raw_img)
+    _count_tile(tile_counts, computed_pixels(img.shape[0], img.shape[1], tile_size, tiled=False), skipped)
+    if skipped:
+        return np.full((img.shape[0], img.shape[1]), empty_tile_filter.background_class, dtype=np.int32)
+    return _inference(img, model)
+
+
+def _write_mask(segmented_mask, output_filepath):
+    max_value = np.max(segmented_mask)
+    if 0 <= max_value <= 255:
+        segmented_mask = segmented_mask.astype(np.uint8)
+    if 255 < max_value < 65536:
+        segmented_mask = segmented_mask.astype(np.uint16)
+    if max_value > 65536:
+        segmented_mask = segmented_mask.astype(np.int32)
+    # write under a temporary name (keeping the extension for the format) and rename, so an interrupted run never
+    # leaves a truncated mask behind
+    output_folder, output_filename = os.path.split(output_filepath)
+    tmp_filepath = os.path.join(output_folder, '.tmp-{}-{}'.format(os.getpid(), output_filename))
+    skimage.io.imsave(tmp_filepath, segmented_mask, compress=6)
+    os.replace(tmp_filepath, output_filepath)
+
+
+MANIFEST_FOLDER = 'inference_manifest'
+
+
+def parse_shard(value):
+    # "i/N" -> (i, N), the shard i of N (zero based)
+    try:
+        shard_index, shard_count = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard "{}", expected i/N'.format(value))
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError('Invalid shard "{}", expected 0 <= i < N'.format(value))
+    return shard_index, shard_count
+
+
+class _Manifest():
+    # append only record of the masks written by one worker, one json line per image. Each worker (of each shard) has
+    # its own file, so no file is appended to by more than one process.
+    def __init__(self, filepath, saved_model_filepath):
+        self.filepath = filepath
+        self.saved_model_filepath = os.path.realpath(saved_model_filepath)
+        self.lock = threading.Lock()
+
+    def add(self, image_name, output_filename):
+        record = {'image': image_name, 'output': output_filename, 'saved_model': self.saved_model_filepath, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with self.lock:
+            with open(self.filepath, 'a') as fh:
+                fh.write(json.dumps(record) + '\n')
+                fh.flush()
+                os.fsync(fh.fileno())
+
+
+def read_completed_images(output_folder, saved_model_filepath):
+    # names of the images segmented by this saved_model according to any manifest in the output folder, whose masks
+    # still exist
+    completed = set()
+    manifest_folder = os.path.join(output_folder, MANIFEST_FOLDER)
+    if not os.path.exists(manifest_folder):
+        return completed
+    saved_model_filepath = os.path.realpath(saved_model_filepath)
+    for fn in os.listdir(manifest_folder):
+        if not fn.endswith('.jsonl'):
+            continue
+        with open(os.path.join(manifest_folder, fn), 'r') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # line cut short by a crash
+                if record['saved_model'] == saved_model_filepath and os.path.exists(os.path.join(output_folder, record['output'])):
+                    completed.add(record['image'])
+    return completed
+
+
+class _StageTimes():
+    # busy time of each pipeline stage, summed over its threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = dict()
+        self.counts = dict()
+
+    def add(self, stage, elapsed):
+        with self.lock:
+            self.times[stage] = self.times.get(stage, 0.0) + elapsed
+            self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def report(self, wall_time, log_prefix=''):
+        print(log_prefix + 'Stage times (total busy seconds summed over threads, mean per image, fraction of wall time):')
+        for stage in ['read', 'wait_for_input', 'model', 'wait_for_writer', 'write']:
+            if stage in self.times:
+                print(log_prefix + '  {:>16}: {:10.2f} s {:8.3f} s/image {:6.1%}'.format(stage, self.times[stage], self.times[stage] / self.counts[stage], self.times[stage] / max(wall_time, 1e-6)))
+
+
+def _output_filename(img_filepath, streaming=False):
+    # masks keep the name (and format) of their image, streaming masks are always tiled tiffs
+    slide_name = os.path.basename(img_filepath)
+    if streaming:
+        return os.path.splitext(slide_name)[0] + '.tif'
+    return slide_name
+
+
+def _read_worker(filepath_queue, image_queue, stage_times, load_fn):
+    # decode and normalize images ahead of the model, a None marks the end of this worker's input
+    while True:
+        img_filepath = filepath_queue.get()
+        if img_filepath is None:
+            image_queue.put(None)
+            return
+        start_time = time.time()
+        try:
+            img, error = load_fn(img_filepath), None
+        except Exception as e:
+            img, error = None, e
+        stage_times.add('read', time.time() - start_time)
+        # blocks while the model is behind, which bounds the number of decoded images held in memory
+        image_queue.put((img_filepath, img, error))
+
+
+def _write_worker(write_queue, stage_times, errors, manifest, cache=None):
+    # encode and write masks behind the model, a None marks the end of the output
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        output_filepath, segmented_mask, image_name, cache_key = item
+        start_time = time.time()
+        try:
+            _write_mask(segmented_mask, output_filepath)
+            if cache is not None:
+                cache.store(cache_key, output_filepath)
+            manifest.add(image_name, os.path.basename(output_filepath))
+        except Exception as e:
+            errors.append((output_filepath, e))
+        stage_times.add('write', time.time() - start_time)
+
+
+def computed_pixels(height, width, tile_size, tiled=None):
+    # number of pixels the model computes to segment a height x width image, including the halo of every tile and the
+    # padding to the U-Net Size Factor. tiled=None picks the mode _segment_image uses.
+    size_factor = unet_model.UNet.SIZE_FACTOR
+    padded_height = height + (size_factor - height % size_factor) % size_factor
+    padded_width = width + (size_factor - width % size_factor) % size_factor
+    if tiled is None:
+        tiled = height > tile_size or width > tile_size
+    if not tiled:
+        return padded_height * padded_width
+    radius = unet_model.UNet.RADIUS
+    zone_of_responsibility_size = tile_size - 2 * radius
+    # the tile extents along y and x are independent, so the total area is the product of their sums
+    tile_heights = [min(i + zone_of_responsibility_size + radius, padded_height) - max(i - radius, 0) for i in range(0, padded_height, zone_of_responsibility_size)]
+    tile_widths = [min(j + zone_of_responsibility_size + radius, padded_width) - max(j - radius, 0) for j in range(0, padded_width, zone_of_responsibility_size)]
+    return sum(tile_heights) * sum(tile_widths)
+
+
+def report_tile_size(tile_size, log_prefix=''):
+    # every tile recomputes a halo of RADIUS pixels on each side, which is thrown away
+    zone_of_responsibility_size = tile_size - 2 * unet_model.UNet.RADIUS
+    halo_overhead = 1.0 - (zone_of_responsibility_size / tile_size) ** 2
+    print('{}Tile size {} (zone of responsibility {}): the halo is {:.1%} of the pixels computed for an interior tile'.format(log_prefix, tile_size, zone_of_responsibility_size, halo_overhead))
+
+
+def probe_tile_size(number_channels, memory_budget_mb, memory_safety_margin, tile_batch_size=1, max_tile_size=4096):
+    # find the largest tile size which fits in memory, from a memory model fitted to synthetic forward passes
+    if memory_budget_mb > 0:
+        memory_budget, budget_source = memory_budget_mb * 2**20, 'memory_budget_mb'
+    else:
+        memory_budget, budget_source = memory_probe.get_default_memory_budget()
+    if memory_budget is None:
+        print('Probing tile size, {} is unknown, bounded by OOM only'.format(budget_source))
+    else:
+        print('Probing tile size with a memory budget of {:.0f} MB ({}) and a safety margin of {}'.format(memory_budget / 2**20, budget_source, memory_safety_margin))
+    # tiles must be larger than the halo on both sides, the class count only changes the size of the last layer
+    min_tile_size = 2 * unet_model.UNet.RADIUS + unet_model.UNet.SIZE_FACTOR
+    size_factor = unet_model.UNet.SIZE_FACTOR
+    if memory_budget is not None:
+        # two small forward passes give the fixed and the per pixel memory cost, the largest tile the budget leaves room
+        # for is then confirmed with a single forward pass
+        memory_limit = memory_budget * (1.0 - memory_safety_margin)
+        fixed_bytes, bytes_per_pixel, _ = memory_probe.fit_inference_memory_model(number_channels, batch_size=tile_batch_size)
+        if bytes_per_pixel is not None:
+            print('Memory model: {:.1f} MB fixed + {:.2f} KB per tile pixel'.format(fixed_bytes / 2**20, bytes_per_pixel / 2**10))
+            tile_size = memory_probe.predict_max_tile_size(fixed_bytes, bytes_per_pixel, memory_limit, tile_batch_size, size_factor, min_tile_size, max_tile_size)
+            if tile_size is None:
+                raise RuntimeError('A {} pixel tile does not fit within the memory budget'.format(min_tile_size))
+            result = memory_probe.measure_inference_step([tile_size, tile_size, number_channels], tile_batch_size)
+            if not result['oom'] and result['step_time'] is not None and result['peak_memory_bytes'] <= memory_limit:
+                print('Auto tile size: {} (peak memory {:.1f} MB, step time {:.4f} s)'.format(tile_size, result['peak_memory_bytes'] / 2**20, result['step_time']))
+                return tile_size
+            # fragmentation or workspace allocations the model does not capture, search below the prediction
+            print('Predicted tile size {} does not fit, searching below it'.format(tile_size))
+            max_tile_size = tile_size - size_factor
+        else:
+            print('Memory model could not be fitted, searching')
+    if max_tile_size < min_tile_size:
+        raise RuntimeError('A {} pixel tile does not fit within the memory budget'.format(min_tile_size))
+    tile_size, result = memory_probe.find_max_tile_size(number_channels, min_tile_size=min_tile_size, max_tile_size=max_tile_size, size_factor=size_factor, memory_budget=memory_budget, safety_margin=memory_safety_margin, batch_size=tile_batch_size)
+    if tile_size is None:
+        raise RuntimeError('A {} pixel tile does not fit within the memory budget'.format(min_tile_size))
+    print('Auto tile size: {} (peak memory {:.1f} MB, step time {:.4f} s)'.format(tile_size, result['peak_memory_bytes'] / 2**20, result['step_time']))
+    return tile_size
+
+
+def _run_worker(worker_index, worker_count, img_filepath_list, saved_model_filepath, output_folder, manifest_filepath, tile_size, tile_batch_size, reader_count, writer_count, profile_images, cpu_set, streaming=False, empty_tile_filter=None, cache=None, backend='auto', backend_threads=0):
+    log_prefix = '' if worker_count == 1 else '[worker {}] '.format(worker_index)
+    if worker_count > 1:
+        # each worker process gets its own device (round robin over the GPUs) and model instance
+        gpus = tf.config.list_physical_devices('GPU')
+        if len(gpus) > 0:
+            tf.config.set_visible_devices(gpus[worker_index % len(gpus)], 'GPU')
+    if cpu_set is not None:
+        # pin the worker to its own cores, with tensorflow thread pools to match
+        os.sched_setaffinity(0, cpu_set)
+        tf.config.threading.set_intra_op_parallelism_threads(len(cpu_set))
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, len(cpu_set)))
+        print('{}pinned to cpus {}'.format(log_prefix, sorted(cpu_set)))
+
+    if backend_threads == 0 and cpu_set is not None:
+        backend_threads = len(cpu_set)
+    model = inference_backends.load_backend(saved_model_filepath, backend, backend_threads)
+    print('{}Running {} with the {} backend'.format(log_prefix, saved_model_filepath, model.name))
+    manifest = _Manifest(manifest_filepath, saved_model_filepath)
+
+    profiler = None
+    if profile_images > 0 and worker_index == 0:
+        # trace the model step of the first N images (with the concurrent read and write threads) into a tensorboard
+        # log directory
+        profiler = profile_window.ProfileWindow(os.path.join(output_folder, 'tensorboard'), 0, profile_images - 1, name='inference')
+
+    # the images are read and normalized by reader_count threads ahead of the model and written by writer_count
+    # threads behind it, so the device is not idle during file I/O and compression. The bounded queues limit the
+    # number of images held in memory.
+    stage_times = _StageTimes()
+    tile_counts = dict()
+    if streaming:
+        load_fn = _open_streaming_image
+    elif empty_tile_filter is not None:
+        load_fn = lambda img_filepath: _load_image(img_filepath, keep_raw=True)
+    else:
+        load_fn = _load_image
+    if cache is not None:
+        # the image files are hashed by the reader threads, a cache hit places the stored mask without decoding the image
+        uncached_load_fn = load_fn
+
+        def load_fn(img_filepath):
+            cache_key = cache.get_key(img_filepath)
+            if cache.fetch(cache_key, os.path.join(output_folder, _output_filename(img_filepath, streaming))):
+                return None, cache_key
+            return uncached_load_fn(img_filepath), cache_key
+    filepath_queue = queue.Queue()
+    for img_filepath in img_filepath_list:
+        filepath_queue.put(img_filepath)
+    image_queue = queue.Queue(maxsize=reader_count)
+    write_queue = queue.Queue(maxsize=writer_count)
+    write_errors = list()
+    readers = list()
+    for r in range(reader_count):
+        filepath_queue.put(None)
+        readers.append(threading.Thread(target=_read_worker, args=(filepath_queue, image_queue, stage_times, load_fn), daemon=True))
+    writers = [threading.Thread(target=_write_worker, args=(write_queue, stage_times, write_errors, manifest, cache), daemon=True) for w in range(writer_count)]
+    for t in readers + writers:
+        t.start()
+
+    start_time = time.time()
+    i = 0
+    finished_readers = 0
+    image_pixels = 0
+    model_pixels = 0
+    cached_images = 0
+    read_errors = list()
+    try:
+        while finished_readers < reader_count:
+            wait_start_time = time.time()
+            item = image_queue.get()
+            stage_times.add('wait_for_input', time.time() - wait_start_time)
+            if item is None:
+                finished_readers += 1
+                continue
+            img_filepath, img, error = item
+            _, slide_name = os.path.split(img_filepath)
+            if error is not None:
+                # skipped, the image is not in the manifest so a rerun retries it
+                print('{}Failed to load {}: {}'.format(log_prefix, img_filepath, error))
+                read_errors.append((img_filepath, error))
+                continue
+            cache_key = None
+            if cache is not None:
+                img, cache_key = img
+                if img is None:
+                    print('{}{}/{} : {} (cached)'.format(log_prefix, i, len(img_filepath_list), slide_name))
+                    manifest.add(slide_name, _output_filename(img_filepath, streaming))
+                    cached_images += 1
+                    i += 1
+                    continue
+            if streaming:
+                # the tiles are read, segmented and written within the model stage, one batch at a time
+                lazy_img, mean, std = img
+                print('{}{}/{} : {} img.shape={} (streaming)'.format(log_prefix, i, len(img_filepath_list), slide_name, lazy_img.shape))
+                image_pixels += lazy_img.shape[0] * lazy_img.shape[1]
+                model_pixels += computed_pixels(lazy_img.shape[0], lazy_img.shape[1], tile_size, tiled=True)
+                output_filename = _output_filename(img_filepath, streaming)
+                model_start_time = time.time()
+                try:
+                    if profiler is None:
+                        _inference_streaming(lazy_img, mean, std, model, tile_size, tile_batch_size, os.path.join(output_folder, output_filename), empty_tile_filter, tile_counts)
+                    else:
+                        with profiler.step(i):
+                            _inference_streaming(lazy_img, mean, std, model, tile_size, tile_batch_size, os.path.join(output_folder, output_filename), empty_tile_filter, tile_counts)
+                finally:
+                    lazy_img.close()
+                stage_times.add('model', time.time() - model_start_time)
+                if cache is not None:
+                    cache.store(cache_key, os.path.join(output_folder, output_filename))
+                manifest.add(slide_name, output_filename)
+                i += 1
+                continue
+
+            raw_img = None
+            if empty_tile_filter is not None:
+                img, raw_img = img
+            print('{}{}/{} : {} img.shape={}'.format(log_prefix, i, len(img_filepath_list), slide_name, img.shape))
+            image_pixels += img.shape[0] * img.shape[1]
+            model_pixels += computed_pixels(img.shape[0], img.shape[1], tile_size)
+
+            model_start_time = time.time()
+            if profiler is None:
+                segmented_mask = _segment_image(img, model, tile_size, tile_batch_size, raw_img, empty_tile_filter, tile_counts)
+            else:
+                with profiler.step(i):
+                    segmented_mask = _segment_image(img, model, tile_size, tile_batch_size, raw_img, empty_tile_filter, tile_counts)
+            stage_times.add('model', time.time() - model_start_time)
+
+            wait_start_time = time.time()
+            write_queue.put((os.path.join(output_folder, _output_filename(img_filepath, streaming)), segmented_mask, slide_name, cache_key))
+            stage_times.add('wait_for_writer', time.time() - wait_start_time)
+            i += 1
+    finally:
+        # the writers finish the masks already queued (and record them in the manifest) even if the model stage failed
+        for w in writers:
+            write_queue.put(None)
+        for w in writers:
+            w.join()
+
+    if profiler is not None:
+        profiler.close()
+
+    wall_time = time.time() - start_time
+    print('{}Segmented {} images in {:.2f} s'.format(log_prefix, i - cached_images, wall_time))
+    if cache is not None:
+        cache.report(log_prefix)
+    if model_pixels > 0:
+        print('{}Computed {:.1f} Mpixels for {:.1f} Mpixels of images, {:.1%} of the compute was halo and padding'.format(log_prefix, model_pixels / 1e6, image_pixels / 1e6, 1.0 - image_pixels / model_pixels))
+    if empty_tile_filter is not None and tile_counts.get('pixels', 0) > 0:
+        skipped_pixels = tile_counts.get('skipped_pixels', 0)
+        remaining = max(tile_counts['pixels'] - skipped_pixels, 1)
+        print('{}Skipped {} of {} tiles as empty, {:.1%} of the tile pixels did not go through the model ({:.2f}x less model compute)'.format(log_prefix, tile_counts.get('skipped_tiles', 0), tile_counts['tiles'], skipped_pixels / tile_counts['pixels'], tile_counts['pixels'] / remaining))
+    stage_times.report(wall_time, log_prefix)
+    for output_filepath, error in write_errors:
+        print('{}Failed to write {}: {}'.format(log_prefix, output_filepath, error))
+    if len(read_errors) > 0 or len(write_errors) > 0:
+        raise IOError('Failed to load {} images and to write {} masks'.format(len(read_errors), len(write_errors)))
+
+
+def _evict_result_cache(result_cache_folder, result_cache_size_mb):
+    # once all the workers are done, so no entry is evicted between being stored and being linked
+    if result_cache_folder is None:
+        return
+    evicted, remaining, remaining_bytes = result_cache.evict(result_cache_folder, result_cache_size_mb * 2**20)
+    print('Result cache holds {} masks ({:.1f} MB), {} evicted'.format(remaining, remaining_bytes / 2**20, evicted))
+
+
+def main(saved_model_filepath, image_folder, output_folder, image_format, profile_images=0, auto_tile=False, memory_budget_mb=0, memory_safety_margin=0.1, tile_batch_size=1, reader_count=2, writer_count=2, shard='0/1', worker_count=1, worker_cpu_affinity=False, streaming=False, tile_size=1024, max_tile_size=4096, empty_tile_std=0.0, empty_tile_max=0.0, background_class=0, result_cache_folder=None, result_cache_size_mb=10240, backend='auto', backend_threads=0, result_cache_hard_link=False):
     print('Arguments:')
     print('saved_model_filepath = {}'.format(saved_model_filepath))
     print('image_folder = {}'.format(image_folder))
     print('output_folder = {}'.format(output_folder))
     print('image_format = {}'.format(image_format))
-    
-    # create output filepath
-    if not os.path.exists(output_folder):
-        os.mkdir(output_folder)
-
-    img_filepath_list = [os.path.join(image_folder, fn) for fn in os.listdir(image_folder) if fn.endswith('.{}'.format(image_format))]
+    print('profile_images = {}'.format(profile_images))
+    print('auto_tile = {}'.format(auto_tile))
+    print('memory_budget_mb = {}'.format(memory_budget_mb))
+    print('memory_safety_margin = {}'.format(memory_safety_margin))
+    print('tile_batch_size = {}'.format(tile_batch_size))
+    print('reader_count = {}'.format(reader_count))
+    print('writer_count = {}'.format(writer_count))
+    print('shard = {}'.format(shard))
+    print('worker_count = {}'.format(worker_count))
+    print('worker_cpu_affinity = {}'.format(worker_cpu_affinity))
+    print('streaming = {}'.format(streaming))
+    print('tile_size = {}'.format(tile_size))
+    print('max_tile_size = {}'.format(max_tile_size))
+    print('empty_tile_std = {}'.format(empty_tile_std))
+    print('empty_tile_max = {}'.format(empty_tile_max))
+    print('background_class = {}'.format(background_class))
+    print('result_cache_folder = {}'.format(result_cache_folder))
+    print('result_cache_size_mb = {}'.format(result_cache_size_mb))
+    print('result_cache_hard_link = {}'.format(result_cache_hard_link))
+    print('backend = {}'.format(backend))
+    print('backend_threads = {}'.format(backend_threads))
+
+    shard_index, shard_count = parse_shard(shard)
+    if worker_count < 1:
+        raise ValueError('worker_count must be >= 1')
+    if backend == 'auto':
+        backend = inference_backends.detect_backend(saved_model_filepath)
+    if tile_size % unet_model.UNet.SIZE_FACTOR != 0 or tile_size <= 2 * unet_model.UNet.RADIUS:
+        raise ValueError('tile_size must be a multiple of {} larger than {}'.format(unet_model.UNet.SIZE_FACTOR, 2 * unet_model.UNet.RADIUS))
 
-    model = tf.saved_model.load(saved_model_filepath)
-
-    print('Starting inference of file list')
-    for i in range(len(img_filepath_list)):
-        img_filepath = img_filepath_list[i]
-        _, slide_name = os.path.split(img_filepath)
-        print('{}/{} : {}'.format(i, len(img_filepath_list), slide_name))
-
-        print('Loading image: {}'.format(img_filepath))
-        img = imagereader.imread(img_filepath)
-        img = img.astype(np.float32)
-
-        # normalize with whole image stats
-        img = imagereader.zscore_normalize(img)
-        print('  img.shape={}'.format(img.shape))
-
-        if img.shape[0] > 1024 or img.shape[1] > 1024:
-            tile_size = 1024  # in theory UNet takes about 420x the amount of memory of the input image
-            # to a tile size of 1024 should require 1.7 GB of GPU memory
-            segmented_mask = _inference_tiling(img, model, tile_size)
+    # create output filepath
+    os.makedirs(os.path.join(output_folder, MANIFEST_FOLDER), exist_ok=True)
+
+    # sorted, so every shard (and every rerun) splits the folder the same way
+    img_filepath_list = sorted([os.path.join(image_folder, fn) for fn in os.listdir(image_folder) if fn.endswith('.{}'.format(image_format))])
+    img_filepath_list = img_filepath_list[shard_index::shard_count]
+    shard_image_count = len(img_filepath_list)
+    completed = read_completed_images(output_folder, saved_model_filepath)
+    img_filepath_list = [fp for fp in img_filepath_list if os.path.basename(fp) not in completed]
+    print('Shard {}/{} has {} images, {} already segmented, {} remaining'.format(shard_index, shard_count, shard_image_count, shard_image_count - len(img_filepath_list), len(img_filepath_list)))
+    if len(img_filepath_list) == 0:
+        return
+
+    if auto_tile:
+        # probed before the model is loaded onto the device, each probe runs in its own process
+        if streaming:
+            lazy_img = streaming_io.LazyImage(img_filepath_list[0])
+            number_channels = lazy_img.shape[2]
+            lazy_img.close()
         else:
-            segmented_mask = _inference(img, model)
-
-        if 0 <= np.max(segmented_mask) <= 255:
-            segmented_mask = segmented_mask.astype(np.uint8)
-        if 255 < np.max(segmented_mask) < 65536:
-            segmented_mask = segmented_mask.astype(np.uint16)
-        if np.max(segmented_mask) > 65536:
-            segmented_mask = segmented_mask.astype(np.int32)
-        skimage.io.imsave(os.path.join(output_folder, slide_name), segmented_mask, compress=6)
+            img = imagereader.imread(img_filepath_list[0])
+            number_channels = img.shape[2] if len(img.shape) == 3 else 1
+        tile_size = probe_tile_size(number_channels, memory_budget_mb, memory_safety_margin, tile_batch_size, max_tile_size)
+    report_tile_size(tile_size)
+
+    empty_tile_filter = None
+    if empty_tile_std > 0 or empty_tile_max > 0:
+        empty_tile_filter = EmptyTileFilter(empty_tile_std, empty_tile_max, background_class)
+
+    cache = None
+    if result_cache_folder is not None:
+        # every setting which changes the masks is part of the cache key, the tile batch size and worker layout are not
+        start_time = time.time()
+        model_fingerprint = result_cache.get_model_fingerprint(saved_model_filepath)
+        params = {'backend': backend, 'tile_size': tile_size, 'streaming': bool(streaming), 'empty_tile_std': empty_tile_std, 'empty_tile_max': empty_tile_max, 'background_class': background_class}
+        cache = result_cache.ResultCache(result_cache_folder, model_fingerprint, params, result_cache_hard_link)
+        print('Result cache {} (model fingerprint {}, {:.2f} s)'.format(result_cache_folder, model_fingerprint[0:16], time.time() - start_time))
+
+    cpu_sets = [None] * worker_count
+    if worker_cpu_affinity:
+        # split the cpus available to this process into one contiguous, disjoint set per worker
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < worker_count:
+            raise ValueError('worker_cpu_affinity needs at least one cpu per worker ({} cpus, {} workers)'.format(len(cpus), worker_count))
+        cpu_sets = [set(c.tolist()) for c in np.array_split(np.asarray(cpus), worker_count)]
 
+    print('Starting inference of file list')
+    worker_args = list()
+    for w in range(worker_count):
+        manifest_filepath = os.path.join(output_folder, MANIFEST_FOLDER, 'shard-{}-of-{}.worker-{}.jsonl'.format(shard_index, shard_count, w))
+        worker_args.append((w, worker_count, img_filepath_list[w::worker_count], saved_model_filepath, output_folder, manifest_filepath, tile_size, tile_batch_size, reader_count, writer_count, profile_images, cpu_sets[w], streaming, empty_tile_filter, cache, backend, backend_threads))
+
+    if worker_count == 1:
+        _run_worker(*worker_args[0])
+        _evict_result_cache(result_cache_folder, result_cache_size_mb)
+        return
+
+    # spawned (not forked) so every worker initializes its own tensorflow runtime
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=_run_worker, args=args) for args in worker_args]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    _evict_result_cache(result_cache_folder, result_cache_size_mb)
+    failed = [w for w in range(worker_count) if workers[w].exitcode != 0]
+    if len(failed) > 0:
+        # the masks written so far are in the manifests, a rerun only segments the remaining images
+        raise RuntimeError('Inference workers {} failed'.format(failed))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog='inference',
                                      description='Script to detect stars with the selected unet model')
 
     parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str,
-                        help='SavedModel filepath to the  model to use', required=True)
+                        help='SavedModel filepath to the  model to use (or a .tflite or .onnx file from export_model.py)', required=True)
     parser.add_argument('--image_folder', dest='image_folder', type=str,
                         help='filepath to the folder containing tif images to inference (Required)', required=True)
     parser.add_argument('--output_folder', dest='output_folder', type=str, required=True)
     parser.add_argument('--image_format', dest='image_format', type=str, help='format (extension) of the input images. E.g {tif, jpg, png)', default='tif')
+    parser.add_argument('--tile_size', dest='tile_size', type=int, help='size of the (square) tiles images larger than it are segmented with, a multiple of 16 larger than 192', default=1024)
+    parser.add_argument('--auto_tile', dest='auto_tile', type=int, help='whether to pick the largest tile size which fits in the memory budget instead of tile_size, from the per pixel memory cost measured with synthetic forward passes at startup [0 = false, 1 = true]', default=0)
+    parser.add_argument('--max_tile_size', dest='max_tile_size', type=int, help='largest tile size auto_tile picks', default=4096)
+    parser.add_argument('--memory_budget_mb', dest='memory_budget_mb', type=int, help='memory budget for auto_tile in MB [0 = the memory of the first GPU, or the host memory when running on CPU]', default=0)
+    parser.add_argument('--memory_safety_margin', dest='memory_safety_margin', type=float, help='fraction of the memory budget auto_tile leaves unused', default=0.1)
+    parser.add_argument('--tile_batch_size', dest='tile_batch_size', type=int, help='number of tiles of images larger than the tile size to run through the model at once', default=1)
+    parser.add_argument('--reader_count', dest='reader_count', type=int, help='number of threads reading and normalizing images ahead of the model', default=2)
+    parser.add_argument('--writer_count', dest='writer_count', type=int, help='number of threads compressing and writing masks behind the model', default=2)
+    parser.add_argument('--shard', dest='shard', type=str, help='segment only shard i of N (i/N, zero based) of the sorted image list, e.g. --shard=${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT}', default='0/1')
+    parser.add_argument('--worker_count', dest='worker_count', type=int, help='number of worker processes, each with its own model instance (and GPU when several are visible), splitting the shard', default=1)
+    parser.add_argument('--worker_cpu_affinity', dest='worker_cpu_affinity', type=int, help='whether to pin each worker to its own disjoint set of the available cpus [0 = false, 1 = true]', default=0)
+    parser.add_argument('--streaming', dest='streaming', type=int, help='whether to segment images out of core, reading tiles lazily from (BigTIFF, tiled, or uncompressed) tif or npy images and writing the masks tile by tile as tiled BigTIFFs, for images too large for memory [0 = false, 1 = true]', default=0)
+    parser.add_argument('--empty_tile_std', dest='empty_tile_std', type=float, help='tiles (or images within the tile size) whose raw intensity standard deviation is below this are assigned background_class without running the model [0 = disabled]', default=0.0)
+    parser.add_argument('--empty_tile_max', dest='empty_tile_max', type=float, help='tiles (or images within the tile size) whose raw maximum intensity is below this are assigned background_class without running the model [0 = disabled]', default=0.0)
+    parser.add_argument('--background_class', dest='background_class', type=int, help='class assigned to the pixels of empty tiles', default=0)
+    parser.add_argument('--backend', dest='backend', type=str, help='runtime to run the model with [auto = from the model filepath, saved_model, tflite, onnx]', default='auto')
+    parser.add_argument('--backend_threads', dest='backend_threads', type=int, help='number of threads of the tflite and onnx backends [0 = the runtime default, or the pinned cpus with worker_cpu_affinity]', default=0)
+    parser.add_argument('--result_cache', dest='result_cache_folder', type=str, help='folder of a cache of masks keyed by the image contents, the model and the settings, shared between runs; cached masks are copied into the output folder instead of segmenting the image again [default: no cache]', default=None)
+    parser.add_argument('--result_cache_size_mb', dest='result_cache_size_mb', type=int, help='size the result cache is evicted down to (least recently used first) at the end of the run, in MB', default=10240)
+    parser.add_argument('--result_cache_hard_link', dest='result_cache_hard_link', type=int, help='hard link the cached masks and the output masks instead of copying them [0 = false, 1 = true]. The linked files share their data: editing an output mask in place changes the cache, and evicting an entry frees no space while its output exists', default=0)
+    parser.add_argument('--profile_images', dest='profile_images', type=int, help='capture a Tensorflow profiler trace of the first N images into <output_folder>/tensorboard [0 = disabled]', default=0)
 
     args = parser.parse_args()
 
@@ -227,6 +815,27 @@ if __name__ == "__main__":
     image_folder = args.image_folder
     output_folder = args.output_folder
     image_format = args.image_format
-
-    main(saved_model_filepath, image_folder, output_folder, image_format)
+    profile_images = args.profile_images
+    auto_tile = args.auto_tile
+    memory_budget_mb = args.memory_budget_mb
+    memory_safety_margin = args.memory_safety_margin
+    tile_batch_size = args.tile_batch_size
+    reader_count = args.reader_count
+    writer_count = args.writer_count
+    shard = args.shard
+    worker_count = args.worker_count
+    worker_cpu_affinity = args.worker_cpu_affinity
+    streaming = args.streaming
+    tile_size = args.tile_size
+    max_tile_size = args.max_tile_size
+    empty_tile_std = args.empty_tile_std
+    empty_tile_max = args.empty_tile_max
+    background_class = args.background_class
+    result_cache_folder = args.result_cache_folder
+    result_cache_size_mb = args.result_cache_size_mb
+    result_cache_hard_link = args.result_cache_hard_link
+    backend = args.backend
+    backend_threads = args.backend_threads
+
+    main(saved_model_filepath, image_folder, output_folder, image_format, profile_images, auto_tile, memory_budget_mb, memory_safety_margin, tile_batch_size, reader_count, writer_count, shard, worker_count, worker_cpu_affinity, streaming, tile_size, max_tile_size, empty_tile_std, empty_tile_max, background_class, result_cache_folder, result_cache_size_mb, backend, backend_threads, result_cache_hard_link)
 
@@ -0,0 +1,146 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import glob
+import os
+import numpy as np
+
+
+# Runtimes a trained model can be run with for inference. Every backend is called like the loaded SavedModel: with an
+# NCHW float32 batch, returning the NHWC softmax as a numpy array.
+#   saved_model: the SavedModel folder written by train_unet.py, run by tensorflow
+#   tflite: a .tflite file (from export_model.py), run by the TFLite interpreter with the XNNPACK CPU delegate
+#   onnx: a .onnx file (from export_model.py), run by ONNX Runtime, which is only needed when this backend is used
+
+BACKENDS = ['saved_model', 'tflite', 'onnx']
+
+
+def detect_backend(model_filepath):
+    if os.path.isdir(model_filepath) and os.path.exists(os.path.join(model_filepath, 'saved_model.pb')):
+        return 'saved_model'
+    ext = os.path.splitext(model_filepath)[1].lower()
+    if ext == '.tflite':
+        return 'tflite'
+    if ext == '.onnx':
+        return 'onnx'
+    raise ValueError('Cannot tell the backend of {}, expecting a SavedModel folder, a .tflite or an .onnx file'.format(model_filepath))
+
+
+def get_static_tflite_filepath(tflite_filepath, batch_shape):
+    # fixed input shape variants of a .tflite model sit next to it: model.tflite -> model.static-1x1x1024x1024.tflite
+    return '{}.static-{}.tflite'.format(os.path.splitext(tflite_filepath)[0], 'x'.join(str(d) for d in batch_shape))
+
+
+def _quantize(data, tensor_details):
+    scale, zero_point = tensor_details['quantization']
+    info = np.iinfo(tensor_details['dtype'])
+    data = np.round(data / scale) + zero_point
+    return np.clip(data, info.min, info.max).astype(tensor_details['dtype'])
+
+
+def _dequantize(data, tensor_details):
+    scale, zero_point = tensor_details['quantization']
+    return (data.astype(np.float32) - zero_point) * scale
+
+
+class SavedModelBackend():
+    name = 'saved_model'
+
+    def __init__(self, model_filepath, thread_count=0):
+        import tensorflow as tf
+        # the tensorflow thread pools are configured by the caller, before the runtime starts
+        self.model = tf.saved_model.load(model_filepath)
+
+    def __call__(self, batch_data):
+        return self.model(batch_data).numpy()
+
+
+class TFLiteBackend():
+    # XNNPACK only accelerates graphs with static shapes, so a fixed shape variant of the model (exported with
+    # export_model.py --tflite_static_shapes) is used for the batch shapes it exists for, e.g. the interior tiles. Other
+    # shapes resize the dynamic model, which runs with the reference kernels where XNNPACK cannot be applied.
+    name = 'tflite'
+
+    def __init__(self, model_filepath, thread_count=0, use_static_models=True):
+        import tensorflow as tf
+        self.tf = tf
+        self.model_filepath = model_filepath
+        self.thread_count = thread_count if thread_count > 0 else None
+        self.static_filepaths = set()
+        if use_static_models:
+            self.static_filepaths = set(glob.glob('{}.static-*.tflite'.format(os.path.splitext(model_filepath)[0])))
+        self.interpreters = dict()
+        self.dynamic_shape = None
+
+    def _create_interpreter(self, filepath):
+        interpreter = self.tf.lite.Interpreter(model_path=filepath, num_threads=self.thread_count)
+        interpreter.allocate_tensors()
+        return interpreter
+
+    def __call__(self, batch_data):
+        batch_data = np.ascontiguousarray(batch_data, dtype=np.float32)
+        shape = tuple(batch_data.shape)
+        static_filepath = get_static_tflite_filepath(self.model_filepath, shape)
+        if static_filepath in self.static_filepaths:
+            if shape not in self.interpreters:
+                self.interpreters[shape] = self._create_interpreter(static_filepath)
+            interpreter = self.interpreters[shape]
+        else:
+            if 'dynamic' not in self.interpreters:
+                self.interpreters['dynamic'] = self._create_interpreter(self.model_filepath)
+            interpreter = self.interpreters['dynamic']
+            if self.dynamic_shape != shape:
+                interpreter.resize_tensor_input(interpreter.get_input_details()[0]['index'], shape)
+                interpreter.allocate_tensors()
+                self.dynamic_shape = shape
+        input_details = interpreter.get_input_details()[0]
+        if input_details['dtype'] != np.float32:
+            # fully integer models (from quantize_model.py) take the quantized input
+            batch_data = _quantize(batch_data, input_details)
+        interpreter.set_tensor(input_details['index'], batch_data)
+        interpreter.invoke()
+        output_details = interpreter.get_output_details()[0]
+        output = interpreter.get_tensor(output_details['index'])
+        if output_details['dtype'] != np.float32:
+            return _dequantize(output, output_details)
+        # copied, the output buffer is reused by the next invoke
+        return output.copy()
+
+
+class OnnxBackend():
+    name = 'onnx'
+
+    def __init__(self, model_filepath, thread_count=0):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('The onnx backend requires onnxruntime (pip install onnxruntime, or onnxruntime-gpu)')
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if thread_count > 0:
+            options.intra_op_num_threads = thread_count
+        available = onnxruntime.get_available_providers()
+        providers = [p for p in ['CUDAExecutionProvider', 'CPUExecutionProvider'] if p in available]
+        self.session = onnxruntime.InferenceSession(model_filepath, options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch_data):
+        return self.session.run(None, {self.input_name: np.ascontiguousarray(batch_data, dtype=np.float32)})[0]
+
+
+def load_backend(model_filepath, backend='auto', thread_count=0):
+    # thread_count = 0 leaves the thread count to the runtime
+    if backend == 'auto':
+        backend = detect_backend(model_filepath)
+    if backend == 'saved_model':
+        return SavedModelBackend(model_filepath, thread_count)
+    if backend == 'tflite':
+        return TFLiteBackend(model_filepath, thread_count)
+    if backend == 'onnx':
+        return OnnxBackend(model_filepath, thread_count)
+    raise ValueError('Unknown backend: {}, expecting one of {}'.format(backend, ['auto'] + BACKENDS))
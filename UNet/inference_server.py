@@ -0,0 +1,409 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import http.client
+import http.server
+import io
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+import numpy as np
+import skimage.io
+import tifffile
+
+
+# Keeps a model loaded and warmed up, and segments single images sent over HTTP (on a TCP port or a unix socket) for
+# interactive tools which cannot pay the tensorflow startup for every frame. Requests from concurrent clients are
+# queued and images of the same shape are run through the model together, a batch is started when it is full or when
+# its first request has waited max_wait_ms. Prometheus metrics are served on /metrics.
+#
+#   POST /segment   body: a tif/png image or a .npy array, response: the mask as .npy (or tif with ?format=tif)
+#   GET  /metrics   request and batch latency histograms, throughput counters, queue depth
+#   GET  /healthz
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+NPY_MAGIC = b'\x93NUMPY'
+
+
+class _Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, help_text):
+        lines = ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append('{}_bucket{{le="{}"}} {}'.format(name, bound, count))
+        lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, self.count))
+        lines.append('{}_sum {}'.format(name, self.sum))
+        lines.append('{}_count {}'.format(name, self.count))
+        return lines
+
+
+class _Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.request_latency = _Histogram(LATENCY_BUCKETS)
+        self.queue_latency = _Histogram(LATENCY_BUCKETS)
+        self.batch_latency = _Histogram(LATENCY_BUCKETS)
+        self.batch_size = _Histogram(BATCH_SIZE_BUCKETS)
+        self.requests = dict()
+        self.pixels = 0
+
+    def observe_request(self, status, latency, pixels=0):
+        with self.lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.request_latency.observe(latency)
+            self.pixels += pixels
+
+    def observe_batch(self, batch_size, queue_latencies, latency):
+        with self.lock:
+            self.batch_size.observe(batch_size)
+            self.batch_latency.observe(latency)
+            for queue_latency in queue_latencies:
+                self.queue_latency.observe(queue_latency)
+
+    def render(self, queue_depth):
+        with self.lock:
+            lines = ['# HELP unet_requests_total Segmentation requests by HTTP status', '# TYPE unet_requests_total counter']
+            for status in sorted(self.requests):
+                lines.append('unet_requests_total{{status="{}"}} {}'.format(status, self.requests[status]))
+            lines += ['# HELP unet_pixels_total Image pixels segmented', '# TYPE unet_pixels_total counter', 'unet_pixels_total {}'.format(self.pixels)]
+            lines += self.request_latency.render('unet_request_latency_seconds', 'Time from receiving an image to having its mask')
+            lines += self.queue_latency.render('unet_queue_latency_seconds', 'Time requests wait in the queue before their batch starts')
+            lines += self.batch_latency.render('unet_batch_latency_seconds', 'Model time of each batch')
+            lines += self.batch_size.render('unet_batch_size', 'Number of images in each batch')
+            lines += ['# HELP unet_queue_depth Requests waiting for a batch', '# TYPE unet_queue_depth gauge', 'unet_queue_depth {}'.format(queue_depth)]
+            lines += ['# HELP unet_uptime_seconds Seconds since the server started', '# TYPE unet_uptime_seconds gauge', 'unet_uptime_seconds {:.3f}'.format(time.time() - self.start_time)]
+        return '\n'.join(lines) + '\n'
+
+
+class _PendingRequest():
+    def __init__(self, img):
+        self.img = img
+        self.submit_time = time.time()
+        self.done = threading.Event()
+        self.mask = None
+        self.error = None
+
+
+def decode_image(body):
+    # .npy arrays are recognized by their magic bytes, anything else is left to skimage (tif, png, ...)
+    if body[0:len(NPY_MAGIC)] == NPY_MAGIC:
+        return np.load(io.BytesIO(body), allow_pickle=False)
+    return skimage.io.imread(io.BytesIO(body))
+
+
+def encode_mask(mask, output_format):
+    # same dtype rules as the masks inference.py writes
+    max_value = np.max(mask) if mask.size > 0 else 0
+    if max_value < 256:
+        mask = mask.astype(np.uint8)
+    elif max_value < 65536:
+        mask = mask.astype(np.uint16)
+    buffer = io.BytesIO()
+    if output_format == 'tif':
+        tifffile.imwrite(buffer, mask, compression='zlib')
+        return buffer.getvalue(), 'image/tiff'
+    np.save(buffer, mask, allow_pickle=False)
+    return buffer.getvalue(), 'application/x-npy'
+
+
+class InferenceServer():
+
+    def __init__(self, saved_model_filepath, max_batch_size=8, max_wait_ms=10, tile_size=1024, tile_batch_size=1, warmup_size=(512, 512), number_channels=1, backend='auto', backend_threads=0):
+        # tensorflow is only imported on the server side, so the client functions below start quickly
+        import imagereader
+        import inference
+        import inference_backends
+        import unet_model
+        self.imagereader = imagereader
+        self.inference = inference
+        self.size_factor = unet_model.UNet.SIZE_FACTOR
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.tile_size = tile_size
+        self.tile_batch_size = tile_batch_size
+
+        start_time = time.time()
+        self.model = inference_backends.load_backend(saved_model_filepath, backend, backend_threads)
+        print('Loaded {} with the {} backend in {:.2f} s'.format(saved_model_filepath, self.model.name, time.time() - start_time))
+        if warmup_size is not None:
+            # the first calls build the kernels for the input shape, pay for them before the first client does
+            for batch_size in sorted({1, max_batch_size}):
+                start_time = time.time()
+                self.model(np.zeros((batch_size, number_channels, warmup_size[0], warmup_size[1]), dtype=np.float32))
+                print('Warmed up {}x{} with a batch of {} in {:.2f} s'.format(warmup_size[0], warmup_size[1], batch_size, time.time() - start_time))
+
+        self.metrics = _Metrics()
+        self.queue = queue.Queue()
+        self.batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self.batcher.start()
+
+    def segment(self, raw_img):
+        # blocking, called from the request handler threads
+        img = raw_img.astype(np.float32)
+        img = self.imagereader.zscore_normalize(img)
+        if len(img.shape) == 2:
+            img = img.reshape((img.shape[0], img.shape[1], 1))
+        request = _PendingRequest(img)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.mask
+
+    def _collect_batch(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # finish this batch, stop at the next one
+                break
+            batch.append(request)
+        return batch
+
+    def _run_group(self, group):
+        # images of the same shape, padded to the U-Net Size Factor (as in inference._inference) and stacked
+        height, width = group[0].img.shape[0], group[0].img.shape[1]
+        pad_y = (self.size_factor - height % self.size_factor) % self.size_factor
+        pad_x = (self.size_factor - width % self.size_factor) % self.size_factor
+        batch_data = np.stack([np.pad(r.img, pad_width=((0, pad_y), (0, pad_x), (0, 0)), mode='reflect').transpose((2, 0, 1)) for r in group])
+        softmax = self.model(batch_data)  # model output defined in unet_model is softmax
+        pred = np.argmax(softmax, axis=-1).astype(np.int32)
+        for k, request in enumerate(group):
+            request.mask = pred[k, 0:height, 0:width]
+
+    def _batch_loop(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                return
+            start_time = time.time()
+            queue_latencies = [start_time - r.submit_time for r in batch]
+            # images larger than the tile size are tiled on their own, the others are grouped by shape
+            groups = list()
+            shape_groups = dict()
+            for request in batch:
+                if request.img.shape[0] > self.tile_size or request.img.shape[1] > self.tile_size:
+                    groups.append((True, [request]))
+                elif request.img.shape in shape_groups:
+                    shape_groups[request.img.shape].append(request)
+                else:
+                    shape_groups[request.img.shape] = [request]
+                    groups.append((False, shape_groups[request.img.shape]))
+            for tiled, group in groups:
+                try:
+                    if tiled:
+                        group[0].mask = self.inference._segment_image(group[0].img, self.model, self.tile_size, self.tile_batch_size)
+                    else:
+                        self._run_group(group)
+                except Exception as e:
+                    for request in group:
+                        request.error = e
+                for request in group:
+                    request.done.set()
+            self.metrics.observe_batch(len(batch), queue_latencies, time.time() - start_time)
+
+    def render_metrics(self):
+        return self.metrics.render(self.queue.qsize())
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.batcher.join()
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep alive, interactive clients reuse their connection
+
+    def address_string(self):
+        # client_address is not a (host, port) tuple on unix sockets
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format, *args):
+        pass  # one line per frame is too much, the metrics cover it
+
+    def _reply(self, status, body, content_type='text/plain'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/metrics':
+            self._reply(200, self.server.inference_server.render_metrics(), 'text/plain; version=0.0.4')
+        elif path == '/healthz':
+            self._reply(200, 'ok\n')
+        else:
+            self._reply(404, 'not found\n')
+
+    def do_POST(self):
+        start_time = time.time()
+        url = urllib.parse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if url.path != '/segment':
+            self._reply(404, 'not found\n')
+            return
+        output_format = urllib.parse.parse_qs(url.query).get('format', ['npy'])[0]
+        metrics = self.server.inference_server.metrics
+        try:
+            raw_img = decode_image(body)
+            if len(raw_img.shape) not in [2, 3]:
+                raise ValueError('Expecting an HW or HWC image, got shape {}'.format(raw_img.shape))
+        except Exception as e:
+            metrics.observe_request(400, time.time() - start_time)
+            self._reply(400, 'Invalid image: {}\n'.format(e))
+            return
+        try:
+            mask = self.server.inference_server.segment(raw_img)
+            response, content_type = encode_mask(mask, output_format)
+        except Exception as e:
+            metrics.observe_request(500, time.time() - start_time)
+            self._reply(500, 'Inference failed: {}\n'.format(e))
+            return
+        metrics.observe_request(200, time.time() - start_time, raw_img.shape[0] * raw_img.shape[1])
+        self._reply(200, response, content_type)
+
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_http_server(inference_server, host='127.0.0.1', port=8765, unix_socket=None):
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)  # left over from a server which did not shut down cleanly
+        httpd = _ThreadingUnixHTTPServer(unix_socket, _RequestHandler)
+    else:
+        httpd = http.server.ThreadingHTTPServer((host, port), _RequestHandler)
+    httpd.inference_server = inference_server
+    return httpd
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+def connect(address, timeout=60):
+    # address is host:port or the filepath of a unix socket, the connection can be reused for many requests
+    if ':' in address and os.path.sep not in address:
+        host, port = address.rsplit(':', 1)
+        return http.client.HTTPConnection(host, int(port), timeout=timeout)
+    return _UnixHTTPConnection(address, timeout)
+
+
+def _request(connection, method, path, body=None):
+    connection.request(method, path, body=body, headers={'Content-Type': 'application/octet-stream'} if body is not None else {})
+    response = connection.getresponse()
+    data = response.read()
+    if response.status != 200:
+        raise RuntimeError('{} {} failed with {}: {}'.format(method, path, response.status, data.decode('utf-8', 'replace').strip()))
+    return data
+
+
+def segment(connection, img):
+    # img is an HW or HWC numpy array of raw intensities, returns the HW mask
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(img), allow_pickle=False)
+    return np.load(io.BytesIO(_request(connection, 'POST', '/segment', buffer.getvalue())), allow_pickle=False)
+
+
+def get_metrics(connection):
+    return _request(connection, 'GET', '/metrics').decode('utf-8')
+
+
+def main(saved_model_filepath, host, port, unix_socket, max_batch_size, max_wait_ms, tile_size, tile_batch_size, warmup_size, number_channels, backend='auto', backend_threads=0):
+    print('saved_model_filepath = {}'.format(saved_model_filepath))
+    print('host = {}'.format(host))
+    print('port = {}'.format(port))
+    print('unix_socket = {}'.format(unix_socket))
+    print('max_batch_size = {}'.format(max_batch_size))
+    print('max_wait_ms = {}'.format(max_wait_ms))
+    print('tile_size = {}'.format(tile_size))
+    print('tile_batch_size = {}'.format(tile_batch_size))
+    print('warmup_size = {}'.format(warmup_size))
+    print('number_channels = {}'.format(number_channels))
+    print('backend = {}'.format(backend))
+    print('backend_threads = {}'.format(backend_threads))
+
+    if max_batch_size < 1:
+        raise ValueError('max_batch_size must be >= 1')
+    warmup_shape = None if warmup_size in [None, '', '0'] else [int(v) for v in warmup_size.split('x')]
+    server = InferenceServer(saved_model_filepath, max_batch_size, max_wait_ms, tile_size, tile_batch_size, warmup_shape, number_channels, backend, backend_threads)
+    httpd = create_http_server(server, host, port, unix_socket)
+    print('Serving on {}'.format(unix_socket if unix_socket is not None else 'http://{}:{}'.format(host, port)))
+    # scheduler and kill terminations go through the same shutdown as ctrl-c
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        httpd.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        print('Shutting down')
+    finally:
+        httpd.server_close()
+        server.shutdown()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='inference_server', description='Serves segmentations of single images with a model kept loaded, batching the requests of concurrent clients')
+
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel filepath to the model to use, or a .tflite or .onnx file from export_model.py (Required)', required=True)
+    parser.add_argument('--host', dest='host', type=str, help='address to listen on, the default only accepts local clients', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8765)
+    parser.add_argument('--unix_socket', dest='unix_socket', type=str, help='filepath of a unix socket to serve on instead of the TCP port', default=None)
+    parser.add_argument('--max_batch_size', dest='max_batch_size', type=int, help='most images of the same shape run through the model at once', default=8)
+    parser.add_argument('--max_wait_ms', dest='max_wait_ms', type=float, help='longest a request waits for others to batch with, in milliseconds', default=10)
+    parser.add_argument('--tile_size', dest='tile_size', type=int, help='images larger than this are segmented tile by tile on their own', default=1024)
+    parser.add_argument('--tile_batch_size', dest='tile_batch_size', type=int, help='number of tiles of images larger than the tile size to run through the model at once', default=1)
+    parser.add_argument('--warmup_size', dest='warmup_size', type=str, help='HxW of the synthetic images run through the model at startup [0 = no warm up]', default='512x512')
+    parser.add_argument('--number_channels', dest='number_channels', type=int, help='number of channels of the warm up images', default=1)
+    parser.add_argument('--backend', dest='backend', type=str, help='runtime to run the model with [auto = from the model filepath, saved_model, tflite, onnx]', default='auto')
+    parser.add_argument('--backend_threads', dest='backend_threads', type=int, help='number of threads of the tflite and onnx backends [0 = the runtime default]', default=0)
+
+    args = parser.parse_args()
+
+    main(args.saved_model_filepath, args.host, args.port, args.unix_socket, args.max_batch_size, args.max_wait_ms, args.tile_size, args.tile_batch_size, args.warmup_size, args.number_channels, args.backend, args.backend_threads)
@@ -0,0 +1,46 @@
+#!/bin/bash
+
+# **************************
+# START - MODIFY THESE OPTIONS
+
+#SBATCH --partition=gpu
+#SBATCH --array=0-7
+#SBATCH --nodes=1
+#SBATCH --cpus-per-task=40
+#SBATCH --gres=gpu:1
+#SBATCH --job-name=unet-inference
+#SBATCH -o unet-inference_%A_%a.out
+#SBATCH --time=24:0:0
+#SBATCH --requeue
+
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+
+# job configuration
+image_folder="/wrk/mmajursk/small-data-cnns/images"
+output_folder="/wrk/mmajursk/small-data-cnns/masks"
+saved_model_filepath="/wrk/mmajursk/tmp/unet/saved_model"
+image_format="tif"
+
+worker_count=1 # model instances per array task, each gets its own gpu (round robin) when several are allocated
+tile_batch_size=4
+
+# END - MODIFY THESE OPTIONS
+# **************************
+
+
+# each array task segments its own shard of the sorted image list. Completed masks are recorded in
+# <output_folder>/inference_manifest, so a requeued (or resubmitted) task only segments the images it has not finished
+shard="${SLURM_ARRAY_TASK_ID}/${SLURM_ARRAY_TASK_COUNT}"
+echo "Shard: $shard"
+
+source /opt/anaconda3/etc/profile.d/conda.sh
+conda activate tf2
+
+mkdir -p ${output_folder}
+
+python inference.py --saved_model_filepath="$saved_model_filepath" --image_folder="$image_folder" --output_folder="$output_folder" --image_format=${image_format} --shard=${shard} --worker_count=${worker_count} --tile_batch_size=${tile_batch_size}
+
+echo "Job completed"
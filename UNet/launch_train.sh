@@ -25,6 +25,9 @@ test_database="/mnt/isgnas/project/Car-T_Cell_Project/CAR-T training dataset 201
 
 output_folder="/mnt/isgnas/project/Car-T_Cell_Project/CAR-T training dataset 20190823/Trained_model"
 
+# node local folder the databases are copied into (in the background) so later epochs do not read over the network
+staging_cache="/tmp/unet-staging-cache"
+
 # how many classes exist in your training dataset (e.g. 2 for binary segmentation)
 number_classes=2
 
@@ -43,4 +46,4 @@ export CUDA_DEVICE_ORDER="PCI_BUS_ID"
 export CUDA_VISIBLE_DEVICES=${GPU}
 
 
-python train_unet.py --test_every_n_steps=${test_every_n_step} --batch_size=${batch_size} --train_database=${train_database} --test_database=${test_database} --output_dir=${output_folder} --number_classes=${number_classes} --learning_rate=${learning_rate}  --use_augmentation=${use_augmentation} --balance_classes=${balance_classes}
\ No newline at end of file
+python train_unet.py --test_every_n_steps=${test_every_n_step} --batch_size=${batch_size} --train_database=${train_database} --test_database=${test_database} --output_dir=${output_folder} --number_classes=${number_classes} --learning_rate=${learning_rate}  --use_augmentation=${use_augmentation} --balance_classes=${balance_classes} --staging_cache="${staging_cache}"
\ No newline at end of file
@@ -0,0 +1,50 @@
+#!/bin/bash
+
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+
+# Launches multi-worker (data parallel) training with several CPU worker processes on this machine.
+# Useful for testing the multi-worker code path without a SLURM cluster.
+
+# ************************************
+# MODIFY THESE OPTIONS
+
+worker_count=2
+base_port=23456
+
+test_every_n_step=1000
+batch_size=2
+
+train_database="../data/train-HES.lmdb"
+test_database="../data/test-HES.lmdb"
+output_folder="./multiworker-test"
+
+number_classes=2
+learning_rate=3e-4
+use_augmentation=1
+balance_classes=1
+
+# END MODIFY THESE OPTIONS
+# ************************************
+
+
+# hide all GPUs so every worker runs on the CPU
+export CUDA_VISIBLE_DEVICES=""
+
+worker_hosts="localhost:${base_port}"
+for ((i=1; i<worker_count; i++)); do
+    worker_hosts="${worker_hosts},localhost:$((base_port + i))"
+done
+
+pids=()
+for ((i=0; i<worker_count; i++)); do
+    python train_unet.py --test_every_n_steps=${test_every_n_step} --batch_size=${batch_size} --train_database=${train_database} --test_database=${test_database} --output_dir=${output_folder} --number_classes=${number_classes} --learning_rate=${learning_rate} --use_augmentation=${use_augmentation} --balance_classes=${balance_classes} --multi_worker=1 --worker_hosts=${worker_hosts} --task_index=${i} > "worker_${i}.log" 2>&1 &
+    pids+=($!)
+done
+
+echo "Launched ${worker_count} workers, logs in worker_<i>.log"
+for pid in "${pids[@]}"; do
+    wait ${pid}
+done
@@ -10,6 +10,7 @@
 #SBATCH --job-name=unet
 #SBATCH -o unet_%N.%j.out
 #SBATCH --time=24:0:0
+#SBATCH --requeue
 
 # NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
 # NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
@@ -25,20 +26,23 @@ test_lmdb_file="test-hes.lmdb"
 
 input_data_directory="/wrk/mmajursk/small-data-cnns/data"
 output_directory="/wrk/mmajursk/tmp"
+# node local folder the databases are staged into while training starts on the network copies, shared by all jobs on the node so a staged database is reused
+staging_cache="/scratch/unet-staging-cache"
 
-experiment_name="unet-$(date +%Y%m%dT%H%M%S)"
+# the job id is kept when a preempted job is requeued, so the requeued job finds (and resumes from) the same results directory
+experiment_name="unet-${SLURM_JOB_ID}"
 
 number_classes=2
 learning_rate=3e-4
 use_augmentation=1
 balance_classes=1
+checkpoint_every_n_steps=500 # how often to save the full training state for resuming after preemption
 
 # END - MODIFY THESE OPTIONS
 # **************************
 
 
 echo "Experiment: $experiment_name"
-scratch_dir="/scratch/${SLURM_JOB_ID}"
 
 # define the handler function
 # note that this is not executed here, but rather
@@ -56,18 +60,6 @@ trap 'term_handler' TERM
 source /opt/anaconda3/etc/profile.d/conda.sh
 conda activate tf2
 
-# make working directory
-mkdir -p ${scratch_dir}
-echo "Created Directory: $scratch_dir"
-
-# copy data to node
-echo "Copying data to Node"
-cp -r ${input_data_directory}/${train_lmdb_file} ${scratch_dir}/${train_lmdb_file}
-cp -r ${input_data_directory}/${test_lmdb_file} ${scratch_dir}/${test_lmdb_file}
-echo "data copy to node complete"
-echo "Working directory contains: "
-ls ${scratch_dir}
-
 results_dir="$output_directory/$experiment_name"
 mkdir -p ${results_dir}
 echo "Results Directory: $results_dir"
@@ -78,6 +70,6 @@ cp -r . "$results_dir/src"
 # launch training script with required options
 echo "Launching Training Script"
 
-python train_unet.py --test_every_n_steps=${test_every_n_steps} --batch_size=${batch_size} --train_database="$scratch_dir/$train_lmdb_file" --test_database="$scratch_dir/$test_lmdb_file" --output_dir="$results_dir" --number_classes=${number_classes} --learning_rate=${learning_rate}  --use_augmentation=${use_augmentation} --balance_classes=${balance_classes} | tee "$results_dir/log.txt"
+python train_unet.py --test_every_n_steps=${test_every_n_steps} --batch_size=${batch_size} --train_database="$input_data_directory/$train_lmdb_file" --test_database="$input_data_directory/$test_lmdb_file" --staging_cache="$staging_cache" --output_dir="$results_dir" --number_classes=${number_classes} --learning_rate=${learning_rate}  --use_augmentation=${use_augmentation} --balance_classes=${balance_classes} --checkpoint_every_n_steps=${checkpoint_every_n_steps} --resume=1 | tee -a "$results_dir/log.txt"
 
 echo "Job completed"
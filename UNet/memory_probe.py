@@ -0,0 +1,259 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import multiprocessing
+import os
+import queue
+import resource
+import subprocess
+import time
+import traceback
+
+
+def _get_peak_memory(tf):
+    # peak device memory when running on GPU, peak resident set size of this process when running on CPU
+    gpus = tf.config.experimental.list_physical_devices('GPU')
+    if len(gpus) > 0 and hasattr(tf.config.experimental, 'get_memory_info'):
+        return int(tf.config.experimental.get_memory_info('GPU:0')['peak'])
+    # ru_maxrss is reported in kilobytes on linux
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def _train_step_worker(result_queue, img_size, batch_size, number_classes, checkpoint_levels, step_count):
+    result = {'img_size': list(img_size), 'batch_size': batch_size, 'checkpoint_levels': checkpoint_levels, 'oom': False, 'step_time': None, 'peak_memory_bytes': None}
+    try:
+        import numpy as np
+        import tensorflow as tf
+        import unet_model
+
+        # only allocate the GPU memory which is actually used, so the peak memory measurement is meaningful
+        for gpu in tf.config.experimental.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(gpu, True)
+
+        model = unet_model.UNet(number_classes, batch_size, img_size, checkpoint_levels=checkpoint_levels)
+        loss_metric = tf.keras.metrics.Mean('loss', dtype=tf.float32)
+        accuracy_metric = tf.keras.metrics.CategoricalAccuracy('accuracy')
+        train_step = tf.function(model.train_step)
+
+        # synthetic NCHW images and NHWC one-hot labels, so no I/O is involved in the measurement
+        images = tf.constant(np.random.randn(batch_size, img_size[2], img_size[0], img_size[1]).astype(np.float32))
+        labels = np.random.randint(0, number_classes, size=(batch_size, img_size[0], img_size[1]))
+        labels = tf.one_hot(labels, number_classes, dtype=tf.int32)
+        inputs = (images, labels, loss_metric, accuracy_metric)
+
+        # first step includes the graph tracing cost
+        train_step(inputs).numpy()
+
+        start_time = time.time()
+        for i in range(step_count):
+            loss_value = train_step(inputs)
+        loss_value.numpy()  # wait for the device to finish
+        result['step_time'] = (time.time() - start_time) / step_count
+        result['peak_memory_bytes'] = _get_peak_memory(tf)
+    except Exception as e:
+        if type(e).__name__ == 'ResourceExhaustedError':
+            result['oom'] = True
+        else:
+            traceback.print_exc()
+            result['error'] = str(e)
+    result_queue.put(result)
+
+
+def _inference_step_worker(result_queue, img_size, batch_size, number_classes, step_count):
+    result = {'img_size': list(img_size), 'batch_size': batch_size, 'oom': False, 'step_time': None, 'peak_memory_bytes': None}
+    try:
+        import numpy as np
+        import tensorflow as tf
+        import unet_model
+
+        for gpu in tf.config.experimental.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(gpu, True)
+
+        model = unet_model.UNet(number_classes, batch_size, img_size)
+        keras_model = model.get_keras_model()
+        inference_step = tf.function(lambda x: keras_model(x, training=False))
+
+        images = tf.constant(np.random.randn(batch_size, img_size[2], img_size[0], img_size[1]).astype(np.float32))
+
+        # first step includes the graph tracing cost
+        inference_step(images).numpy()
+
+        start_time = time.time()
+        for i in range(step_count):
+            softmax = inference_step(images)
+        softmax.numpy()  # wait for the device to finish
+        result['step_time'] = (time.time() - start_time) / step_count
+        result['peak_memory_bytes'] = _get_peak_memory(tf)
+    except Exception as e:
+        if type(e).__name__ == 'ResourceExhaustedError':
+            result['oom'] = True
+        else:
+            traceback.print_exc()
+            result['error'] = str(e)
+    result_queue.put(result)
+
+
+def _run_worker(target, args, oom_result):
+    # Each measurement runs in a fresh process, so the peak memory is not polluted by earlier measurements and the
+    # device memory is released after the measurement completes.
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    p = ctx.Process(target=target, args=(result_queue,) + tuple(args))
+    p.start()
+    while True:
+        try:
+            result = result_queue.get(timeout=1)
+            break
+        except queue.Empty:
+            if not p.is_alive():
+                # the process died without reporting (e.g. killed by the kernel OOM killer)
+                result = oom_result
+                break
+    p.join()
+    return result
+
+
+def measure_train_step(img_size, batch_size, number_classes=2, checkpoint_levels=0, step_count=5):
+    # Measures the peak memory and average step time of UNet.train_step on synthetic data.
+    # img_size is [H, W, C]
+    oom_result = {'img_size': list(img_size), 'batch_size': batch_size, 'checkpoint_levels': checkpoint_levels, 'oom': True, 'step_time': None, 'peak_memory_bytes': None}
+    return _run_worker(_train_step_worker, (img_size, batch_size, number_classes, checkpoint_levels, step_count), oom_result)
+
+
+def measure_inference_step(img_size, batch_size, number_classes=2, step_count=5):
+    # Measures the peak memory and average step time of a UNet forward pass (training=False) on synthetic data.
+    # img_size is [H, W, C]
+    oom_result = {'img_size': list(img_size), 'batch_size': batch_size, 'oom': True, 'step_time': None, 'peak_memory_bytes': None}
+    return _run_worker(_inference_step_worker, (img_size, batch_size, number_classes, step_count), oom_result)
+
+
+def get_default_memory_budget():
+    # total memory of the first visible GPU (from nvidia-smi), or the physical memory of the node when running on CPU
+    # returns (bytes, description), bytes is None when the GPU memory cannot be determined
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES', None)
+    if visible_devices is None or len(visible_devices.strip()) > 0:
+        gpu_id = '0' if visible_devices is None else visible_devices.split(',')[0].strip()
+        try:
+            output = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits', '-i', gpu_id], stderr=subprocess.DEVNULL)
+            return int(output.decode('ascii').strip().split('\n')[0]) * 2**20, 'GPU {} memory'.format(gpu_id)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            if visible_devices is not None:
+                # GPUs were explicitly selected, but their memory is unknown
+                return None, 'GPU {} memory (unknown)'.format(gpu_id)
+            # no nvidia driver, running on the CPU
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES'), 'host memory'
+
+
+def _search_largest(measure_fn, low, high, memory_limit):
+    # Find the largest integer value in [low, high] whose measurement fits within memory_limit bytes (None = only
+    # exclude OOM), assuming memory use grows with the value. Doubles until the first failure, then bisects.
+    # Returns (value, measurement), value is None if even low does not fit.
+    measurements = dict()
+
+    def fits(value):
+        result = measure_fn(value)
+        measurements[value] = result
+        if result['oom'] or result['step_time'] is None:
+            print('  {}: OOM'.format(value))
+            return False
+        print('  {}: peak memory {:.1f} MB, step time {:.4f} s'.format(value, result['peak_memory_bytes'] / 2**20, result['step_time']))
+        return memory_limit is None or result['peak_memory_bytes'] <= memory_limit
+
+    if not fits(low):
+        return None, measurements[low]
+    good = low
+    bad = None
+    while bad is None and good < high:
+        value = min(good * 2, high)
+        if fits(value):
+            good = value
+        else:
+            bad = value
+    if bad is not None:
+        while bad - good > 1:
+            value = (good + bad) // 2
+            if fits(value):
+                good = value
+            else:
+                bad = value
+    return good, measurements[good]
+
+
+def _apply_margin(measure_fn, value, result, low, memory_budget, safety_margin):
+    # without a known memory budget only OOM bounds the search, so the margin is taken off the value instead
+    if memory_budget is not None or safety_margin <= 0:
+        return value, result
+    reduced = max(low, int(value * (1.0 - safety_margin)))
+    if reduced != value:
+        value, result = reduced, measure_fn(reduced)
+    return value, result
+
+
+def find_max_batch_size(img_size, number_classes=2, checkpoint_levels=0, memory_budget=None, safety_margin=0.1, max_batch_size=256, step_count=2):
+    # Largest per device train batch size whose peak memory stays below (1 - safety_margin) * memory_budget bytes.
+    # Returns (batch_size, measurement) with batch_size None if a single image does not fit.
+    memory_limit = None if memory_budget is None else memory_budget * (1.0 - safety_margin)
+    measure_fn = lambda b: measure_train_step(img_size, b, number_classes, checkpoint_levels, step_count)
+    batch_size, result = _search_largest(measure_fn, 1, max_batch_size, memory_limit)
+    if batch_size is None:
+        return None, result
+    return _apply_margin(measure_fn, batch_size, result, 1, memory_budget, safety_margin)
+
+
+def find_max_tile_size(number_channels, number_classes=2, min_tile_size=256, max_tile_size=4096, size_factor=16, memory_budget=None, safety_margin=0.1, step_count=2, batch_size=1):
+    # Largest square inference tile size (multiple of size_factor) whose peak memory with batch_size tiles stays below
+    # (1 - safety_margin) * memory_budget bytes. Returns (tile_size, measurement) with tile_size None if min_tile_size
+    # does not fit.
+    memory_limit = None if memory_budget is None else memory_budget * (1.0 - safety_margin)
+    measure_fn = lambda k: measure_inference_step([k * size_factor, k * size_factor, number_channels], batch_size, number_classes, step_count)
+    low = min_tile_size // size_factor
+    k, result = _search_largest(measure_fn, low, max_tile_size // size_factor, memory_limit)
+    if k is None:
+        return None, result
+    k, result = _apply_margin(measure_fn, k, result, low, memory_budget, safety_margin)
+    return k * size_factor, result
+
+
+def fit_inference_memory_model(number_channels, number_classes=2, tile_sizes=(256, 512), batch_size=1, step_count=2):
+    # Fits peak memory = fixed_bytes + bytes_per_pixel * batch_size * tile_size^2 (least squares) to forward passes at
+    # tile_sizes. The activations of every layer scale with the tile area, the fixed part is the weights and runtime.
+    # Returns (fixed_bytes, bytes_per_pixel, measurements), bytes_per_pixel is None if a measurement failed.
+    measurements = list()
+    for tile_size in tile_sizes:
+        result = measure_inference_step([tile_size, tile_size, number_channels], batch_size, number_classes, step_count)
+        measurements.append(result)
+        if result['oom'] or result['step_time'] is None:
+            print('  {}: OOM'.format(tile_size))
+            return None, None, measurements
+        print('  {}: peak memory {:.1f} MB, step time {:.4f} s'.format(tile_size, result['peak_memory_bytes'] / 2**20, result['step_time']))
+
+    pixels = [float(batch_size * t * t) for t in tile_sizes]
+    peaks = [float(m['peak_memory_bytes']) for m in measurements]
+    mean_pixels = sum(pixels) / len(pixels)
+    mean_peak = sum(peaks) / len(peaks)
+    var_pixels = sum((p - mean_pixels) ** 2 for p in pixels)
+    if var_pixels <= 0:
+        return None, None, measurements
+    bytes_per_pixel = sum((p - mean_pixels) * (m - mean_peak) for p, m in zip(pixels, peaks)) / var_pixels
+    if bytes_per_pixel <= 0:
+        # the measurements are dominated by noise (e.g. the RSS of a CPU run barely moved)
+        return None, None, measurements
+    fixed_bytes = max(0.0, mean_peak - bytes_per_pixel * mean_pixels)
+    return fixed_bytes, bytes_per_pixel, measurements
+
+
+def predict_max_tile_size(fixed_bytes, bytes_per_pixel, memory_limit, batch_size=1, size_factor=16, min_tile_size=256, max_tile_size=4096):
+    # Largest square tile size (multiple of size_factor, clipped to [min_tile_size, max_tile_size]) the memory model
+    # predicts fits within memory_limit bytes with batch_size tiles. Returns None if not even min_tile_size does.
+    available = memory_limit - fixed_bytes
+    if available <= 0:
+        return None
+    tile_size = int((available / (bytes_per_pixel * batch_size)) ** 0.5) // size_factor * size_factor
+    if tile_size < min_tile_size:
+        return None
+    return min(tile_size, max_tile_size // size_factor * size_factor)
@@ -0,0 +1,91 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import tensorflow as tf
+
+DEFAULT_PORT = 23456
+
+
+def get_slurm_worker_hosts(port=DEFAULT_PORT):
+    # Derive the list of worker addresses and the index of this worker from the SLURM job environment.
+    # One worker is launched per SLURM task (e.g. with srun), when several tasks share a node they get consecutive ports.
+    if 'SLURM_JOB_NODELIST' not in os.environ or 'SLURM_PROCID' not in os.environ:
+        raise RuntimeError('SLURM environment variables not found, multi-worker training needs to be launched with srun or given explicit --worker_hosts')
+
+    # expand the compressed node list (e.g. "node[01-04]") into host names
+    hostnames = subprocess.check_output(['scontrol', 'show', 'hostnames', os.environ['SLURM_JOB_NODELIST']]).decode('utf-8').split()
+    tasks_per_node = int(os.environ.get('SLURM_NTASKS_PER_NODE', '1'))
+    task_count = int(os.environ.get('SLURM_NTASKS', str(len(hostnames) * tasks_per_node)))
+
+    # SLURM assigns task ranks to nodes in blocks by default
+    worker_hosts = list()
+    for rank in range(task_count):
+        hostname = hostnames[rank // tasks_per_node]
+        worker_hosts.append('{}:{}'.format(hostname, port + rank % tasks_per_node))
+    task_index = int(os.environ['SLURM_PROCID'])
+    return worker_hosts, task_index
+
+
+def configure_cluster(worker_hosts=None, task_index=None, port=DEFAULT_PORT):
+    # Setup the TF_CONFIG cluster description used by the MultiWorkerMirroredStrategy, either from an explicit comma
+    # separated list of "host:port" worker addresses plus the index of this worker, an already existing TF_CONFIG,
+    # or the SLURM job environment.
+    # returns (task_index, worker_count)
+    if worker_hosts is not None and len(worker_hosts) > 0:
+        if task_index is None:
+            raise RuntimeError('task_index is required when explicitly specifying worker_hosts')
+        worker_hosts = worker_hosts.split(',')
+    elif 'TF_CONFIG' in os.environ:
+        tf_config = json.loads(os.environ['TF_CONFIG'])
+        return int(tf_config['task']['index']), len(tf_config['cluster']['worker'])
+    else:
+        worker_hosts, task_index = get_slurm_worker_hosts(port)
+
+    if task_index < 0 or task_index >= len(worker_hosts):
+        raise RuntimeError('Invalid task_index {} for {} workers'.format(task_index, len(worker_hosts)))
+
+    tf_config = {'cluster': {'worker': worker_hosts}, 'task': {'type': 'worker', 'index': task_index}}
+    os.environ['TF_CONFIG'] = json.dumps(tf_config)
+    return task_index, len(worker_hosts)
+
+
+def create_strategy():
+    # needs to be created before any other Tensorflow ops are run
+    if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    return tf.distribute.experimental.MultiWorkerMirroredStrategy()
+
+
+def disable_auto_shard(dataset):
+    # Each worker reads its own shard of the database keys (see ImageReader shard_index), so Tensorflow must not try to
+    # (re)shard the generator based dataset, which would discard most of the examples each worker produces.
+    options = tf.data.Options()
+    if hasattr(tf.data.experimental, 'AutoShardPolicy'):
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    else:
+        options.experimental_distribute.auto_shard = False
+    return dataset.with_options(options)
+
+
+def get_write_folder(folder, task_index):
+    # Saving a checkpoint requires every worker to participate, but only the chief (task 0) should write into the
+    # output folder. The other workers write into a node local temporary folder which is removed at the end of training.
+    if task_index == 0:
+        return folder
+    return os.path.join(tempfile.gettempdir(), 'unet_worker_{}'.format(task_index), os.path.basename(os.path.normpath(folder)))
+
+
+def cleanup_write_folder(task_index):
+    if task_index != 0:
+        shutil.rmtree(os.path.join(tempfile.gettempdir(), 'unet_worker_{}'.format(task_index)), ignore_errors=True)
@@ -0,0 +1,81 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import contextlib
+import tensorflow as tf
+
+
+def parse_profile_steps(value):
+    # parse "START:END" (inclusive) into a (start, end) tuple, None or an empty string disables profiling
+    if value is None or len(value) == 0:
+        return None
+    toks = value.split(':')
+    if len(toks) != 2:
+        raise ValueError('profile steps must be formatted as START:END, got: {}'.format(value))
+    start, end = int(toks[0]), int(toks[1])
+    if start < 0 or end < start:
+        raise ValueError('invalid profile steps: {}'.format(value))
+    return start, end
+
+
+class ProfileWindow():
+    # Captures a Tensorflow profiler trace (ops on the devices plus host side activity, including the input pipeline)
+    # of the steps start through end (inclusive) into logdir, where TensorBoard shows it in the Profile tab.
+    # Only construct one when profiling is requested, callers skip the step() context entirely otherwise.
+    def __init__(self, logdir, start_step, end_step, name='train'):
+        self.logdir = logdir
+        self.start_step = start_step
+        self.end_step = end_step
+        self.name = name
+        self.active = False
+        self.done = False
+        # tf.profiler.experimental was added in Tensorflow 2.2, fall back to the summary trace api on older versions
+        self.use_experimental = hasattr(tf.profiler, 'experimental') and hasattr(tf.profiler.experimental, 'start')
+        self.writer = None
+
+    def _start(self):
+        print('Starting profiler trace at {} step {}'.format(self.name, self.start_step))
+        if self.use_experimental:
+            options = None
+            if hasattr(tf.profiler.experimental, 'ProfilerOptions'):
+                options = tf.profiler.experimental.ProfilerOptions(host_tracer_level=2, python_tracer_level=0, device_tracer_level=1)
+            tf.profiler.experimental.start(self.logdir, options=options)
+        else:
+            self.writer = tf.summary.create_file_writer(self.logdir)
+            tf.summary.trace_on(graph=False, profiler=True)
+        self.active = True
+
+    def _stop(self, step_num):
+        if self.use_experimental:
+            tf.profiler.experimental.stop()
+        else:
+            with self.writer.as_default():
+                tf.summary.trace_export(name=self.name, step=step_num, profiler_outdir=self.logdir)
+        self.active = False
+        self.done = True
+        print('Profiler trace written to: {}'.format(self.logdir))
+
+    @contextlib.contextmanager
+    def step(self, step_num):
+        # wrap the work of a single step, the profiler is started and stopped at the window boundaries
+        if not self.active and not self.done and self.start_step <= step_num <= self.end_step:
+            # checks the range rather than start_step, so a run resumed within the window still captures the rest
+            self._start()
+        if self.active and self.use_experimental:
+            # the step marker lets the TensorBoard overview and input pipeline pages break the trace down per step
+            with tf.profiler.experimental.Trace(self.name, step_num=step_num, _r=1):
+                yield
+        else:
+            yield
+        if self.active and step_num >= self.end_step:
+            self._stop(step_num)
+
+    def close(self):
+        # stop a trace which is still running (e.g. training ended within the window)
+        if self.active:
+            self._stop(self.end_step)
@@ -0,0 +1,202 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import tensorflow as tf
+tf_version = tf.__version__.split('.')
+if int(tf_version[0]) != 2:
+    raise Exception('Tensorflow 2.x.x required')
+
+import argparse
+import os
+import time
+import numpy as np
+import imagereader
+import inference_backends
+import segmentation_metrics
+import export_model
+
+
+# Post training int8 quantization of the SavedModel of a training run, for the tflite backend on CPUs:
+#   <output_folder>/model.int8.tflite                  dynamic input shape, int8 weights, activations, input and output
+#   <output_folder>/model.int8.static-NxCxHxW.tflite   fixed input shapes, which XNNPACK can fully accelerate
+# The activation ranges are calibrated on a representative sample of the training database, read without augmentation.
+
+
+def _get_folder_size(filepath):
+    if os.path.isfile(filepath):
+        return os.path.getsize(filepath)
+    return sum(os.path.getsize(os.path.join(root, fn)) for root, _, fns in os.walk(filepath) for fn in fns)
+
+
+def load_calibration_images(train_lmdb_filepath, number_classes, calibration_count):
+    # a random sample of the (z-score normalized, CHW) training images, with no augmentation, so the activation ranges
+    # match what the model sees at inference time
+    reader = imagereader.ImageReader(train_lmdb_filepath, use_augmentation=False, shuffle=True, num_workers=1, balance_classes=False, number_classes=number_classes)
+    calibration_count = min(calibration_count, reader.get_image_count())
+    images = list()
+    try:
+        reader.startup()
+        while len(images) < calibration_count:
+            images.append(reader.get_example()[0])
+    finally:
+        reader.shutdown()
+    return images
+
+
+def _fit_to_shape(img, height, width):
+    # mirror pad and then crop a CHW image to the given spatial size
+    pad_y = max(0, height - img.shape[1])
+    pad_x = max(0, width - img.shape[2])
+    if pad_y > 0 or pad_x > 0:
+        img = np.pad(img, ((0, 0), (0, pad_y), (0, pad_x)), mode='symmetric')
+    return img[:, 0:height, 0:width]
+
+
+def quantize(saved_model_filepath, output_filepath, calibration_images, static_shape=None):
+    if static_shape is None:
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_filepath)
+
+        def representative_dataset():
+            for img in calibration_images:
+                yield [img[np.newaxis, ...]]
+    else:
+        # trace the model for a single input shape, all the intermediate shapes become static
+        model = tf.saved_model.load(saved_model_filepath)
+        concrete_function = tf.function(lambda x: model(x)).get_concrete_function(tf.TensorSpec(static_shape, tf.float32))
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], model)
+        batch_size, _, height, width = static_shape
+
+        def representative_dataset():
+            for i in range(0, len(calibration_images) - batch_size + 1, batch_size):
+                yield [np.stack([_fit_to_shape(img, height, width) for img in calibration_images[i:i + batch_size]])]
+
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    # fail the conversion rather than silently keeping float kernels for any op without an int8 implementation
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    tflite_model = converter.convert()
+    with open(output_filepath, 'wb') as fh:
+        fh.write(tflite_model)
+
+
+def _print_scores(label, cm):
+    iou = segmentation_metrics.iou(cm)
+    dice = segmentation_metrics.dice(cm)
+    accuracy = float(np.trace(cm) / np.sum(cm))
+    print('  {}: pixel accuracy {:.4%}, mean IoU {:.4f}, mean Dice {:.4f}'.format(label, accuracy, float(np.nanmean(iou)), float(np.nanmean(dice))))
+    for c in range(cm.shape[0]):
+        print('    class {}: IoU {:.4f}, Dice {:.4f}'.format(c, iou[c], dice[c]))
+
+
+def evaluate(float_model_filepath, int8_model_filepath, test_lmdb_filepath, number_classes, thread_count=0):
+    # compares the int8 model with the float model on every image of the test database: the agreement between their
+    # masks, the accuracy of each against the ground truth, and their throughput
+    float_backend = inference_backends.load_backend(float_model_filepath, thread_count=thread_count)
+    int8_backend = inference_backends.load_backend(int8_model_filepath, backend='tflite', thread_count=thread_count)
+
+    reader = imagereader.ImageReader(test_lmdb_filepath, use_augmentation=False, shuffle=False, num_workers=1, balance_classes=False, number_classes=number_classes)
+    image_count = reader.get_image_count()
+    agreement_cm = np.zeros((number_classes, number_classes), dtype=np.int64)
+    float_cm = np.zeros((number_classes, number_classes), dtype=np.int64)
+    int8_cm = np.zeros((number_classes, number_classes), dtype=np.int64)
+    float_elapsed = 0.0
+    int8_elapsed = 0.0
+    pixel_count = 0
+    try:
+        reader.startup()
+        for i in range(image_count):
+            img, label = reader.get_example()[0:2]
+            batch_data = img[np.newaxis, ...]
+            if i == 0:
+                # warm up, the first call builds the interpreters and the tensorflow graph
+                float_backend(batch_data)
+                int8_backend(batch_data)
+
+            start_time = time.time()
+            float_mask = np.argmax(float_backend(batch_data)[0], axis=-1)
+            float_elapsed += time.time() - start_time
+            start_time = time.time()
+            int8_mask = np.argmax(int8_backend(batch_data)[0], axis=-1)
+            int8_elapsed += time.time() - start_time
+
+            target = np.argmax(label, axis=-1)
+            agreement_cm += segmentation_metrics.confusion_matrix(float_mask, int8_mask, number_classes)
+            float_cm += segmentation_metrics.confusion_matrix(target, float_mask, number_classes)
+            int8_cm += segmentation_metrics.confusion_matrix(target, int8_mask, number_classes)
+            pixel_count += target.size
+    finally:
+        reader.shutdown()
+
+    print('Evaluated {} test images'.format(image_count))
+    print('Throughput (batch size 1):')
+    for name, elapsed in [('float ({})'.format(float_backend.name), float_elapsed), ('int8', int8_elapsed)]:
+        print('  {}: {:.2f} images/s, {:.2f} Mpixels/s'.format(name, image_count / elapsed, pixel_count / elapsed / 1e6))
+    print('  int8 speedup: {:.2f}x'.format(float_elapsed / int8_elapsed))
+    print('Agreement of the int8 masks with the float masks:')
+    _print_scores('int8 vs float', agreement_cm)
+    print('Against the ground truth:')
+    _print_scores('float', float_cm)
+    _print_scores('int8', int8_cm)
+
+
+def main(model_folder, train_lmdb_filepath, test_lmdb_filepath, output_folder, number_classes, calibration_count, static_shapes, float_model_filepath, thread_count):
+    print('model_folder = {}'.format(model_folder))
+    print('train_database = {}'.format(train_lmdb_filepath))
+    print('test_database = {}'.format(test_lmdb_filepath))
+    print('output_folder = {}'.format(output_folder))
+    print('number_classes = {}'.format(number_classes))
+    print('calibration_count = {}'.format(calibration_count))
+    print('static_shapes = {}'.format(static_shapes))
+    print('float_model = {}'.format(float_model_filepath))
+    print('thread_count = {}'.format(thread_count))
+
+    saved_model_filepath = export_model.find_saved_model(model_folder)
+    if output_folder is None:
+        output_folder = os.path.join(os.path.dirname(os.path.abspath(saved_model_filepath)), 'exported')
+    os.makedirs(output_folder, exist_ok=True)
+    if float_model_filepath is None:
+        float_model_filepath = saved_model_filepath
+
+    print('Loading {} calibration images'.format(calibration_count))
+    calibration_images = load_calibration_images(train_lmdb_filepath, number_classes, calibration_count)
+    number_channels = calibration_images[0].shape[0]
+
+    start_time = time.time()
+    output_filepath = os.path.join(output_folder, 'model.int8.tflite')
+    quantize(saved_model_filepath, output_filepath, calibration_images)
+    for batch_size, height, width in static_shapes:
+        batch_shape = [batch_size, number_channels, height, width]
+        if batch_size > len(calibration_images):
+            raise ValueError('static shape batch size {} is larger than the calibration_count'.format(batch_size))
+        quantize(saved_model_filepath, inference_backends.get_static_tflite_filepath(output_filepath, batch_shape), calibration_images, batch_shape)
+    print('Quantized in {:.1f} s'.format(time.time() - start_time))
+    print('Model size: {:.1f} MB float, {:.1f} MB int8'.format(_get_folder_size(float_model_filepath) / 1e6, _get_folder_size(output_filepath) / 1e6))
+
+    if test_lmdb_filepath is not None:
+        evaluate(float_model_filepath, output_filepath, test_lmdb_filepath, number_classes, thread_count)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='quantize_model', description='Post training int8 quantization of the SavedModel of a training run for the tflite inference backend')
+
+    parser.add_argument('--model_folder', dest='model_folder', type=str, help='output_dir of a training run, or a SavedModel folder (Required)', required=True)
+    parser.add_argument('--train_database', dest='train_database_filepath', type=str, help='lmdb database to draw the calibration images from (Required)', required=True)
+    parser.add_argument('--test_database', dest='test_database_filepath', type=str, help='lmdb database to compare the int8 model with the float model on [default: no comparison]', default=None)
+    parser.add_argument('--output_folder', dest='output_folder', type=str, help='folder to write the quantized models into [default: exported/ next to the SavedModel]', default=None)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--calibration_count', dest='calibration_count', type=int, help='number of training images to calibrate the activation ranges on', default=100)
+    parser.add_argument('--static_shapes', dest='static_shapes', type=str, help='comma separated list of BxHxW input shapes to also quantize fixed shape models for (see export_model.py --tflite_static_shapes)', default='')
+    parser.add_argument('--float_model', dest='float_model_filepath', type=str, help='float model to compare with, e.g. exported/model.tflite to compare under the same runtime [default: the SavedModel]', default=None)
+    parser.add_argument('--thread_count', dest='thread_count', type=int, help='intra op threads of both models during the comparison (0 = runtime default)', default=0)
+
+    args = parser.parse_args()
+    static_shapes = [[int(v) for v in s.split('x')] for s in args.static_shapes.split(',') if len(s.strip()) > 0]
+
+    main(args.model_folder, args.train_database_filepath, args.test_database_filepath, args.output_folder, args.number_classes, args.calibration_count, static_shapes, args.float_model_filepath, args.thread_count)
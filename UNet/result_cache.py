@@ -0,0 +1,190 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+# Content addressed cache of inference outputs. An entry is keyed by the sha256 of the image file, a fingerprint of the
+# SavedModel files and the inference parameters which change the output, so a mask is reused for the same image
+# whatever its name or folder, and never across models or settings. Entries are stored as
+# <cache_folder>/<key[0:2]>/<key><ext> and copied into the output folder. With hard_link the entries and the outputs are
+# hard linked instead (when on the same filesystem): the two files share their data, so editing an output in place
+# changes the cache entry, and evicting an entry frees no space while an output links to it. The least recently used
+# entries are evicted once the cache exceeds its size.
+
+_hash_chunk_size = 2**20
+
+
+def _sha256(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(_hash_chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_model_fingerprint(saved_model_filepath):
+    # hash of the contents of every file of the SavedModel (graph and variables), independent of its location. Exported
+    # models (.tflite, .onnx) are a single file.
+    if os.path.isfile(saved_model_filepath):
+        return _sha256(saved_model_filepath)
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(saved_model_filepath):
+        dirs.sort()
+        for fn in sorted(files):
+            filepath = os.path.join(root, fn)
+            h.update(os.path.relpath(filepath, saved_model_filepath).encode('utf-8'))
+            h.update(_sha256(filepath).encode('ascii'))
+    return h.hexdigest()
+
+
+def get_params_fingerprint(params):
+    # params: dict of the inference settings the output depends on
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dst, hard_link=False):
+    # written under a temporary name and renamed, so the destination is never a partial file
+    tmp_filepath = os.path.join(os.path.dirname(dst), '.tmp-{}-{}-{}'.format(os.getpid(), threading.get_ident(), os.path.basename(dst)))
+    linked = False
+    if hard_link:
+        try:
+            os.link(src, tmp_filepath)
+            linked = True
+        except OSError:
+            pass  # different filesystems (or no hard link support)
+    if not linked:
+        shutil.copyfile(src, tmp_filepath)
+    try:
+        os.replace(tmp_filepath, dst)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+
+class ResultCache():
+
+    def __init__(self, cache_folder, model_fingerprint, params, hard_link=False):
+        self.cache_folder = cache_folder
+        self.hard_link = hard_link
+        self.fingerprint = hashlib.sha256((model_fingerprint + get_params_fingerprint(params)).encode('ascii')).hexdigest()
+        os.makedirs(cache_folder, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.hashed_bytes = 0
+
+    def __getstate__(self):
+        # sent to spawned inference workers, each counts its own statistics
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_key(self, img_filepath):
+        image_hash = _sha256(img_filepath)
+        with self.lock:
+            self.hashed_bytes += os.path.getsize(img_filepath)
+        return hashlib.sha256((image_hash + self.fingerprint).encode('ascii')).hexdigest()
+
+    def _entry_filepath(self, key, output_filepath):
+        # the extension of the output is kept, it determines the file format
+        return os.path.join(self.cache_folder, key[0:2], key + os.path.splitext(output_filepath)[1])
+
+    def fetch(self, key, output_filepath):
+        # places the cached mask at output_filepath, returns False on a miss
+        entry_filepath = self._entry_filepath(key, output_filepath)
+        try:
+            _link_or_copy(entry_filepath, output_filepath, self.hard_link)
+            # the modification time orders the entries for eviction
+            os.utime(entry_filepath)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, output_filepath):
+        entry_filepath = self._entry_filepath(key, output_filepath)
+        os.makedirs(os.path.dirname(entry_filepath), exist_ok=True)
+        _link_or_copy(output_filepath, entry_filepath, self.hard_link)
+        with self.lock:
+            self.stored += 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'stored': self.stored, 'hashed_bytes': self.hashed_bytes}
+
+    def report(self, log_prefix=''):
+        stats = self.get_stats()
+        lookups = max(stats['hits'] + stats['misses'], 1)
+        print('{}Result cache: {} hits, {} misses ({:.1%} hit rate), {} masks stored, {:.1f} MB of images hashed'.format(log_prefix, stats['hits'], stats['misses'], stats['hits'] / lookups, stats['stored'], stats['hashed_bytes'] / 2**20))
+
+
+def _list_entries(cache_folder):
+    entries = list()
+    for root, dirs, files in os.walk(cache_folder):
+        for fn in files:
+            if fn.startswith('.tmp-'):
+                continue
+            filepath = os.path.join(root, fn)
+            try:
+                st = os.stat(filepath)
+            except FileNotFoundError:
+                continue  # evicted concurrently
+            entries.append((st.st_mtime, st.st_size, filepath))
+    return entries
+
+
+def evict(cache_folder, max_size_bytes):
+    # removes the least recently used entries until the cache fits in max_size_bytes. Outputs hard linked to an evicted
+    # entry are not affected, and keep its data on disk. Returns (evicted entry count, remaining entry count, remaining bytes).
+    entries = sorted(_list_entries(cache_folder))
+    total_bytes = sum(size for _, size, _ in entries)
+    evicted = 0
+    for mtime, size, filepath in entries:
+        if total_bytes <= max_size_bytes:
+            break
+        try:
+            os.remove(filepath)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+        evicted += 1
+    return evicted, len(entries) - evicted, total_bytes
+
+
+def main(cache_folder, max_size_mb):
+    print('cache_folder = {}'.format(cache_folder))
+    print('max_size_mb = {}'.format(max_size_mb))
+
+    evicted, remaining, remaining_bytes = evict(cache_folder, max_size_mb * 2**20)
+    print('Evicted {} entries, {} entries ({:.1f} MB) remain'.format(evicted, remaining, remaining_bytes / 2**20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='result_cache', description='Evict the least recently used masks of an inference result cache down to a size')
+
+    parser.add_argument('--cache_folder', dest='cache_folder', type=str, help='result cache folder (Required)', required=True)
+    parser.add_argument('--max_size_mb', dest='max_size_mb', type=int, help='size to evict the cache down to in MB', default=10240)
+
+    args = parser.parse_args()
+
+    main(args.cache_folder, args.max_size_mb)
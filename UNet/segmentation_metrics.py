@@ -0,0 +1,56 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import numpy as np
+
+
+def confusion_matrix(target, prediction, number_classes):
+    # Accumulate the confusion matrix of two integer class label arrays (of any, but matching, shape).
+    # Rows are the target class, columns the predicted class.
+    target = np.asarray(target, dtype=np.int64).reshape(-1)
+    prediction = np.asarray(prediction, dtype=np.int64).reshape(-1)
+    cm = np.bincount(target * number_classes + prediction, minlength=number_classes * number_classes)
+    return cm.reshape((number_classes, number_classes))
+
+
+def _safe_divide(numerator, denominator):
+    # classes which never occur (in the target or the prediction) get a nan score
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    result = np.full(numerator.shape, np.nan)
+    valid = denominator > 0
+    result[valid] = numerator[valid] / denominator[valid]
+    return result
+
+
+def iou(cm):
+    # per class intersection over union (Jaccard index)
+    tp = np.diag(cm)
+    fp = np.sum(cm, axis=0) - tp
+    fn = np.sum(cm, axis=1) - tp
+    return _safe_divide(tp, tp + fp + fn)
+
+
+def dice(cm):
+    # per class Dice coefficient (F1 score)
+    tp = np.diag(cm)
+    fp = np.sum(cm, axis=0) - tp
+    fn = np.sum(cm, axis=1) - tp
+    return _safe_divide(2 * tp, 2 * tp + fp + fn)
+
+
+def precision(cm):
+    # per class fraction of the pixels predicted as the class which are the class
+    tp = np.diag(cm)
+    return _safe_divide(tp, np.sum(cm, axis=0))
+
+
+def recall(cm):
+    # per class fraction of the pixels of the class which are predicted as the class
+    tp = np.diag(cm)
+    return _safe_divide(tp, np.sum(cm, axis=1))
@@ -0,0 +1,150 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import collections
+import numpy as np
+import tifffile
+
+
+# Out of core access to images too large to hold in memory: images are read region by region from uncompressed
+# (memory mapped) or tiled/stripped (compressed) TIFF and BigTIFF files, or from .npy files, normalization statistics
+# are accumulated in a chunked pass, and masks are written tile by tile into a tiled BigTIFF.
+
+STREAMING_EXTENSIONS = ('.tif', '.tiff', '.npy')
+
+
+class LazyImage():
+    # HWC view of an image on disk, read one region at a time
+
+    def __init__(self, filepath, cache_size_bytes=256 * 2**20):
+        self.filepath = filepath
+        self.tif = None
+        self.array = None
+        self.page = None
+        # decoded tiff segments (tiles or strips), shared by the overlapping regions of neighboring tiles
+        self.segment_cache = collections.OrderedDict()
+        self.segment_cache_bytes = 0
+        self.cache_size_bytes = cache_size_bytes
+
+        if filepath.lower().endswith('.npy'):
+            self.array = np.load(filepath, mmap_mode='r')
+        elif filepath.lower().endswith(('.tif', '.tiff')):
+            self.tif = tifffile.TiffFile(filepath)
+            page = self.tif.pages[0]
+            if page.is_memmappable:
+                self.array = tifffile.memmap(filepath, page=0, mode='r')
+            else:
+                if page.planarconfig != 1 and page.samplesperpixel > 1:
+                    raise IOError('Streaming requires contiguous (interleaved) samples: {}'.format(filepath))
+                self.page = page
+                self.chunk_shape = page.chunks[:2]
+                self.chunk_grid = page.chunked[:2]
+        else:
+            raise IOError('Streaming supports {} images: {}'.format(', '.join(STREAMING_EXTENSIONS), filepath))
+
+        if self.array is not None:
+            if self.array.ndim not in (2, 3):
+                raise IOError('Invalid number of dimensions for input image. Expecting HW or HWC dimension ordering.')
+            self.shape = (self.array.shape[0], self.array.shape[1], 1 if self.array.ndim == 2 else self.array.shape[2])
+            self.dtype = self.array.dtype
+        else:
+            if len(self.page.shape) not in (2, 3):
+                raise IOError('Invalid number of dimensions for input image. Expecting HW or HWC dimension ordering.')
+            self.shape = (self.page.shape[0], self.page.shape[1], 1 if len(self.page.shape) == 2 else self.page.shape[2])
+            self.dtype = self.page.dtype
+
+    def close(self):
+        self.array = None
+        self.segment_cache.clear()
+        if self.tif is not None:
+            self.tif.close()
+
+    def _decode_segment(self, index):
+        if index in self.segment_cache:
+            self.segment_cache.move_to_end(index)
+            return self.segment_cache[index]
+        fh = self.tif.filehandle
+        fh.seek(self.page.dataoffsets[index])
+        data = fh.read(self.page.databytecounts[index])
+        segment, indices, _ = self.page.decode(data, index, jpegtables=self.page.jpegtables)
+        # (1, h, w, samples) -> (h, w, samples), clipped to the image at the right and bottom borders
+        segment = segment[0, :self.shape[0] - indices[2], :self.shape[1] - indices[3]]
+        self.segment_cache[index] = segment
+        self.segment_cache_bytes += segment.nbytes
+        while self.segment_cache_bytes > self.cache_size_bytes and len(self.segment_cache) > 1:
+            _, old = self.segment_cache.popitem(last=False)
+            self.segment_cache_bytes -= old.nbytes
+        return segment
+
+    def read_region(self, y_st, y_end, x_st, x_end):
+        # HWC copy of the image region [y_st, y_end) x [x_st, x_end)
+        if self.array is not None:
+            region = np.array(self.array[y_st:y_end, x_st:x_end])
+            return region.reshape((region.shape[0], region.shape[1], self.shape[2]))
+
+        region = np.empty((y_end - y_st, x_end - x_st, self.shape[2]), dtype=self.dtype)
+        ch, cw = self.chunk_shape
+        for gy in range(y_st // ch, (y_end - 1) // ch + 1):
+            for gx in range(x_st // cw, (x_end - 1) // cw + 1):
+                segment = self._decode_segment(gy * self.chunk_grid[1] + gx)
+                # overlap of the segment with the region, in image coordinates
+                sy_st, sx_st = gy * ch, gx * cw
+                oy_st, oy_end = max(y_st, sy_st), min(y_end, sy_st + segment.shape[0])
+                ox_st, ox_end = max(x_st, sx_st), min(x_end, sx_st + segment.shape[1])
+                region[oy_st - y_st:oy_end - y_st, ox_st - x_st:ox_end - x_st] = segment[oy_st - sy_st:oy_end - sy_st, ox_st - sx_st:ox_end - sx_st]
+        return region
+
+    def iter_chunks(self, max_chunk_bytes=64 * 2**20):
+        # every pixel exactly once, as (h, w, C) blocks of bounded size
+        if self.array is not None:
+            row_bytes = self.shape[1] * self.shape[2] * self.dtype.itemsize
+            rows = max(1, max_chunk_bytes // row_bytes)
+            for y in range(0, self.shape[0], rows):
+                yield self.read_region(y, min(y + rows, self.shape[0]), 0, self.shape[1])
+        else:
+            # decode segment by segment, without filling the region cache
+            fh = self.tif.filehandle
+            for index in range(len(self.page.dataoffsets)):
+                fh.seek(self.page.dataoffsets[index])
+                segment, indices, _ = self.page.decode(fh.read(self.page.databytecounts[index]), index, jpegtables=self.page.jpegtables)
+                yield segment[0, :self.shape[0] - indices[2], :self.shape[1] - indices[3]]
+
+
+def compute_normalization(lazy_image):
+    # per channel mean and (population) standard deviation, combined chunk by chunk in float64
+    count = 0
+    mean = np.zeros(lazy_image.shape[2], dtype=np.float64)
+    m2 = np.zeros(lazy_image.shape[2], dtype=np.float64)
+    for chunk in lazy_image.iter_chunks():
+        chunk = chunk.reshape((-1, lazy_image.shape[2])).astype(np.float64)
+        n = chunk.shape[0]
+        if n == 0:
+            continue
+        chunk_mean = np.mean(chunk, axis=0)
+        chunk_m2 = np.sum((chunk - chunk_mean) ** 2, axis=0)
+        delta = chunk_mean - mean
+        total = count + n
+        mean = mean + delta * n / total
+        m2 = m2 + chunk_m2 + delta ** 2 * count * n / total
+        count = total
+    std = np.sqrt(m2 / max(count, 1))
+    return mean, std
+
+
+def normalize(region, mean, std):
+    # z-score normalize with the whole image statistics, matching imagereader.zscore_normalize (which does not divide
+    # by standard deviations <= 1)
+    region = region.astype(np.float32) - mean.astype(np.float32)
+    scale = np.where(std > 1.0, std, 1.0).astype(np.float32)
+    return region / scale
+
+
+def write_tiled_tiff(output_filepath, shape, dtype, tile_size, tiles):
+    # tiles: (tile_size, tile_size) arrays in row major order, written (zlib compressed) one at a time into a BigTIFF
+    with tifffile.TiffWriter(output_filepath, bigtiff=True) as tif:
+        tif.write(data=tiles, shape=tuple(shape), dtype=dtype, tile=(tile_size, tile_size), compression='zlib', compressionargs={'level': 6})
@@ -12,6 +12,7 @@ os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"  # so the IDs match nvidia-smi
 
 import argparse
 import datetime
+import json
 import numpy as np
 
 import tensorflow as tf
@@ -21,10 +22,119 @@ if int(tf_version[0]) != 2:
 
 import unet_model
 import imagereader
+import multiworker
+import evaluator
+import profile_window
+import memory_probe
 import time
 
 
-def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gpu_ids=""):
+class TestLossHistory(tf.train.experimental.PythonState):
+    # Stores the per epoch test loss history (which drives early stopping) inside the training checkpoint, so it is
+    # saved and restored atomically with the model and optimizer state.
+    def __init__(self, test_loss):
+        self.test_loss = test_loss
+
+    def serialize(self):
+        return json.dumps([float(v) for v in self.test_loss])
+
+    def deserialize(self, string_value):
+        # update in place, the training loop holds a reference to this list
+        self.test_loss[:] = json.loads(string_value)
+
+
+# maximum number of seconds to wait for the sidecar evaluator to catch up at the end of training
+ASYNC_EVAL_TIMEOUT = 3600
+
+
+def get_best_epoch(test_loss):
+    # test_loss maps each evaluated epoch to its test loss, epochs can be missing (e.g. with async_eval)
+    CONVERGENCE_TOLERANCE = 1e-4
+    epochs = sorted(test_loss.keys())
+    losses = np.asarray([test_loss[e] for e in epochs])
+    error_from_best = np.abs(losses - np.min(losses))
+    error_from_best[error_from_best < CONVERGENCE_TOLERANCE] = 0
+    best_epoch = epochs[np.where(error_from_best == 0)[0][0]] # select first time since that value has happened
+    return best_epoch
+
+
+def is_converged(test_loss, early_stopping_count):
+    # early_stopping_count epochs have been trained since the best epoch without improving on it
+    if len(test_loss) == 0:
+        return False
+    return max(test_loss.keys()) - get_best_epoch(test_loss) >= early_stopping_count
+
+
+def get_test_loss_by_epoch(test_loss, output_folder, async_eval):
+    if async_eval:
+        # the evaluator numbers each epoch by the count of epochs completed when its checkpoint was written
+        return {r[0] - 1: r[1] for r in evaluator.read_eval_results(output_folder)}
+    return dict(enumerate(test_loss))
+
+
+def parse_crop_schedule(value):
+    # parse "CROP:EPOCHS,CROP:EPOCHS,..." into a list of (crop_size, epoch_count) stages
+    crop_schedule = list()
+    if value is None or len(value) == 0:
+        return crop_schedule
+    for stage in value.split(','):
+        toks = stage.split(':')
+        if len(toks) != 2:
+            raise ValueError('crop schedule stages must be formatted as CROP:EPOCHS, got: {}'.format(stage))
+        crop_size, epoch_count = int(toks[0]), int(toks[1])
+        if crop_size <= 0 or crop_size % unet_model.UNet.SIZE_FACTOR != 0:
+            raise ValueError('crop sizes must be positive multiples of {}'.format(unet_model.UNet.SIZE_FACTOR))
+        crop_schedule.append((crop_size, epoch_count))
+    return crop_schedule
+
+
+def get_crop_size(crop_schedule, epoch):
+    # crop size to train the given epoch on, 0 once the schedule is complete (full size tiles)
+    for crop_size, epoch_count in crop_schedule:
+        if epoch < epoch_count:
+            return crop_size
+        epoch = epoch - epoch_count
+    return 0
+
+
+def probe_batch_size(train_lmdb_filepath, number_classes, gradient_checkpoint_levels, memory_budget_mb, memory_safety_margin):
+    # find the largest per GPU batch size which fits in memory with synthetic train steps at the database tile size
+    img_size = imagereader.get_database_image_size(train_lmdb_filepath)
+    if memory_budget_mb > 0:
+        memory_budget, budget_source = memory_budget_mb * 2**20, 'memory_budget_mb'
+    else:
+        memory_budget, budget_source = memory_probe.get_default_memory_budget()
+    if memory_budget is None:
+        print('Probing batch size for {} tiles, {} is unknown, bounded by OOM only'.format(img_size, budget_source))
+    else:
+        print('Probing batch size for {} tiles with a memory budget of {:.0f} MB ({}) and a safety margin of {}'.format(img_size, memory_budget / 2**20, budget_source, memory_safety_margin))
+    batch_size, result = memory_probe.find_max_batch_size(img_size, number_classes, gradient_checkpoint_levels, memory_budget, memory_safety_margin)
+    if batch_size is None:
+        raise RuntimeError('A batch of a single {} tile does not fit within the memory budget'.format(img_size))
+    print('Auto batch size: {} (peak memory {:.1f} MB, step time {:.4f} s)'.format(batch_size, result['peak_memory_bytes'] / 2**20, result['step_time']))
+    return batch_size
+
+
+def run_train_step(model, mirrored_strategy, train_reader, batch, train_loss_metric, train_acc_metric):
+    inputs = (batch[0], batch[1], train_loss_metric, train_acc_metric)
+    if train_reader.loss_sampling:
+        loss_value, sample_losses, key_ids = model.dist_train_step_with_sample_losses(mirrored_strategy, inputs, batch[2])
+        # feed the per record losses back to the reader workers
+        train_reader.report_sample_losses(key_ids.numpy(), sample_losses.numpy())
+    else:
+        model.dist_train_step(mirrored_strategy, inputs)
+
+
+def create_train_dataset(train_reader, global_batch_size, accumulate_steps, reader_count, multi_worker, mirrored_strategy):
+    train_dataset = train_reader.get_tf_dataset()
+    # each train step consumes accumulate_steps micro-batches before applying a single gradient update
+    train_dataset = train_dataset.batch(global_batch_size * accumulate_steps).prefetch(reader_count)
+    if multi_worker:
+        train_dataset = multiworker.disable_auto_shard(train_dataset)
+    return mirrored_strategy.experimental_distribute_dataset(train_dataset)
+
+
+def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gpu_ids="", gradient_checkpoint_levels=0, accumulate_steps=1, resume=False, checkpoint_every_n_steps=0, init_from=None, freeze_encoder_levels=0, multi_worker=False, worker_hosts=None, task_index=None, async_eval=False, profile_steps=None, crop_schedule=None, auto_batch=False, memory_budget_mb=0, memory_safety_margin=0.1, loss_sampling=False, loss_sampling_floor=0.2, samples_per_decode=1, train_dataset_server=None, test_dataset_server=None, staging_cache=None):
 
     if gpu_ids is not None and len(gpu_ids) > 0:
         # gpus_to_use must bs comma separated list of gpu ids, e.g. "1,3,4"
@@ -32,48 +142,121 @@ def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, te
 
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
+    if crop_schedule is None:
+        crop_schedule = list()
+
+    if async_eval and multi_worker:
+        # every worker must reach the same early stopping decision, which polling a file does not guarantee
+        raise ValueError('async_eval is not supported with multi_worker training')
+    if auto_batch and multi_worker:
+        # workers probing on their own hardware can pick different batch sizes, which breaks the collectives
+        raise ValueError('auto_batch is not supported with multi_worker training, set batch_size explicitly')
+
+    if auto_batch:
+        # probed before this process initializes any device, each probe runs in its own process
+        batch_size = probe_batch_size(train_lmdb_filepath, number_classes, gradient_checkpoint_levels, memory_budget_mb, memory_safety_margin)
+
+    if multi_worker:
+        # data parallel training across several nodes, each worker uses all of its available devices
+        task_index, worker_count = multiworker.configure_cluster(worker_hosts, task_index)
+        print('Worker {} of {}'.format(task_index, worker_count))
+        mirrored_strategy = multiworker.create_strategy()
+    else:
+        task_index, worker_count = 0, 1
+        # uses all available devices
+        mirrored_strategy = tf.distribute.MirroredStrategy()
+    # only the chief worker writes logs, tensorboard summaries and checkpoints into the output folder
+    is_chief = task_index == 0
+    log = print if is_chief else lambda *args: None
 
-    # TODO add ability to reload a checkpoint or saved model to resume training
     training_checkpoint_filepath = None
+    best_checkpoint_filepath = os.path.join(output_folder, 'checkpoint', "ckpt")
+    best_checkpoint_write_filepath = os.path.join(multiworker.get_write_folder(os.path.join(output_folder, 'checkpoint'), task_index), "ckpt")
 
-    # uses all available devices
-    mirrored_strategy = tf.distribute.MirroredStrategy()
     with mirrored_strategy.scope():
 
         # scale the batch size based on the GPU count
         global_batch_size = batch_size * mirrored_strategy.num_replicas_in_sync
-        # scale the number of I/O readers based on the GPU count
-        reader_count = reader_count * mirrored_strategy.num_replicas_in_sync
-
-        print('Setting up test image reader')
-        test_reader = imagereader.ImageReader(test_lmdb_filepath, use_augmentation=False, shuffle=False, num_workers=reader_count, balance_classes=False, number_classes=number_classes)
-        print('Test Reader has {} images'.format(test_reader.get_image_count()))
-
-        print('Setting up training image reader')
-        train_reader = imagereader.ImageReader(train_lmdb_filepath, use_augmentation=use_augmentation, shuffle=True, num_workers=reader_count, balance_classes=balance_classes, number_classes=number_classes)
-        print('Train Reader has {} images'.format(train_reader.get_image_count()))
-
+        # scale the number of I/O readers based on the GPU count of this worker
+        reader_count = reader_count * (mirrored_strategy.num_replicas_in_sync // worker_count)
+
+        # each worker reads a disjoint shard of the databases
+        test_reader = None
+        if not async_eval:  # with async_eval the test database is read by the sidecar evaluator
+            log('Setting up test image reader')
+            test_reader = imagereader.ImageReader(test_lmdb_filepath, use_augmentation=False, shuffle=False, num_workers=reader_count, balance_classes=False, number_classes=number_classes, shard_index=task_index, shard_count=worker_count, dataset_server_address=test_dataset_server, staging_cache=staging_cache)
+            log('Test Reader has {} images'.format(test_reader.get_image_count()))
+
+        log('Setting up training image reader')
+        train_reader = imagereader.ImageReader(train_lmdb_filepath, use_augmentation=use_augmentation, shuffle=True, num_workers=reader_count, balance_classes=balance_classes, number_classes=number_classes, shard_index=task_index, shard_count=worker_count, dynamic_crop=len(crop_schedule) > 0, loss_sampling=loss_sampling, loss_sampling_floor=loss_sampling_floor, samples_per_decode=samples_per_decode, dataset_server_address=train_dataset_server, staging_cache=staging_cache)
+        log('Train Reader has {} images'.format(train_reader.get_image_count()))
+
+        training_state_manager = None
+        eval_checkpoint = None
+        checkpoint_options = None
         try:  # if any errors happen we want to catch them and shut down the multiprocess readers
-            print('Starting Readers')
+            log('Starting Readers')
             train_reader.startup()
-            print('  train_reader online')
-            test_reader.startup()
-            print('  test_reader online')
+            log('  train_reader online')
+            if test_reader is not None:
+                test_reader.startup()
+                log('  test_reader online')
 
-            train_dataset = train_reader.get_tf_dataset()
-            train_dataset = train_dataset.batch(global_batch_size).prefetch(reader_count)
-            train_dataset = mirrored_strategy.experimental_distribute_dataset(train_dataset)
+            train_dataset = create_train_dataset(train_reader, global_batch_size, accumulate_steps, reader_count, multi_worker, mirrored_strategy)
+            current_crop_size = 0  # full size tiles
             
-            test_dataset = test_reader.get_tf_dataset()
-            test_dataset = test_dataset.batch(global_batch_size).prefetch(reader_count)
-            test_dataset = mirrored_strategy.experimental_distribute_dataset(test_dataset)
+            if test_reader is not None:
+                test_dataset = test_reader.get_tf_dataset()
+                test_dataset = test_dataset.batch(global_batch_size).prefetch(reader_count)
+                if multi_worker:
+                    test_dataset = multiworker.disable_auto_shard(test_dataset)
+                test_dataset = mirrored_strategy.experimental_distribute_dataset(test_dataset)
             
 
-            print('Creating model')
-            model = unet_model.UNet(number_classes, global_batch_size, train_reader.get_image_size(), learning_rate)
+            log('Creating model')
+            model = unet_model.UNet(number_classes, global_batch_size, train_reader.get_image_size(), learning_rate, checkpoint_levels=gradient_checkpoint_levels, accumulate_steps=accumulate_steps, frozen_encoder_levels=freeze_encoder_levels)
+            if init_from is not None:
+                # fine tune from an existing model, resuming from a training state (below) takes precedence
+                log('Initializing model weights from: {}'.format(init_from))
+                model.restore_weights(init_from)
 
             checkpoint = tf.train.Checkpoint(optimizer=model.get_optimizer(), model=model.get_keras_model())
 
+            # the full training state, written periodically so training can be resumed after a preemption
+            test_loss = list()
+            epoch_variable = tf.Variable(0, dtype=tf.int64, trainable=False)  # current epoch
+            step_variable = tf.Variable(0, dtype=tf.int64, trainable=False)  # number of train steps completed within the current epoch
+            training_state = tf.train.Checkpoint(optimizer=model.get_optimizer(), model=model.get_keras_model(), epoch=epoch_variable, step=step_variable, test_loss=TestLossHistory(test_loss))
+            training_state_folder = os.path.join(output_folder, 'training_state')
+            training_state_manager = tf.train.CheckpointManager(training_state, multiworker.get_write_folder(training_state_folder, task_index), max_to_keep=2)
+            try:
+                # write the checkpoint files in a background thread (requires Tensorflow >= 2.11)
+                checkpoint_options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+            except (TypeError, AttributeError):
+                checkpoint_options = None
+            # older Tensorflow versions do not accept the options argument at all
+            save_kwargs = {} if checkpoint_options is None else {'options': checkpoint_options}
+
+            # all workers resume from the training state written by the chief
+            resume_filepath = tf.train.latest_checkpoint(training_state_folder)
+            if resume and resume_filepath is not None:
+                log('Resuming training from: {}'.format(resume_filepath))
+                training_state.restore(resume_filepath)
+                if os.path.exists(best_checkpoint_filepath + '.index'):
+                    training_checkpoint_filepath = best_checkpoint_filepath
+                # the train reader samples keys at random (with replacement), so it carries no position to restore
+            elif resume:
+                log('No training state found in {}, starting from scratch'.format(training_state_folder))
+            training_complete_filepath = os.path.join(output_folder, evaluator.TRAINING_COMPLETE_FILENAME)
+            if async_eval:
+                if os.path.exists(training_complete_filepath):
+                    os.remove(training_complete_filepath)  # left over from a previous (resumed) run
+                # the model weights at the end of every epoch, in their own folder so the step checkpoints of the
+                # training state never evict them. The evaluator deletes each one once it has scored it.
+                eval_checkpoint = tf.train.Checkpoint(model=model.get_keras_model(), epoch=epoch_variable)
+                os.makedirs(os.path.join(output_folder, evaluator.EVAL_CHECKPOINT_FOLDER), exist_ok=True)
+                evaluator.touch_trainer_heartbeat(output_folder)
+
             # This requires pydot and graphviz, so its commented out to obviate those
             # # print the model summary to file
             # with open(os.path.join(output_folder, 'model.txt'), 'w') as summary_fh:
@@ -84,9 +267,9 @@ def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, te
 
             # train_epoch_size = train_reader.get_image_count()/batch_size
             train_epoch_size = test_every_n_steps
-            test_epoch_size = test_reader.get_image_count() / batch_size
-
-            test_loss = list()
+            if test_reader is not None:
+                # every worker needs to run the same number of test steps, so base it on the smallest shard size
+                test_epoch_size = int(test_reader.get_total_image_count() / worker_count) / batch_size
 
             # Prepare the metrics.
             train_loss_metric = tf.keras.metrics.Mean('train_loss', dtype=tf.float32)
@@ -96,109 +279,191 @@ def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, te
 
             current_time = datetime.datetime.now().strftime("%Y%m%dT%H%M%S")
             train_log_dir = os.path.join(output_folder, 'tensorboard-' + current_time, 'train')
-            if not os.path.exists(train_log_dir):
+            if is_chief and not os.path.exists(train_log_dir):
                 os.makedirs(train_log_dir)
             test_log_dir = os.path.join(output_folder, 'tensorboard-' + current_time, 'test')
-            if not os.path.exists(test_log_dir):
+            if is_chief and not os.path.exists(test_log_dir):
                 os.makedirs(test_log_dir)
 
-            train_summary_writer = tf.summary.create_file_writer(train_log_dir)
-            test_summary_writer = tf.summary.create_file_writer(test_log_dir)
-
-            epoch = 0
-            print('Running Network')
-            while True:  # loop until early stopping
-                print('---- Epoch: {} ----'.format(epoch))
+            if is_chief:
+                train_summary_writer = tf.summary.create_file_writer(train_log_dir)
+                test_summary_writer = tf.summary.create_file_writer(test_log_dir)
+            else:
+                train_summary_writer = tf.summary.create_noop_writer()
+                test_summary_writer = tf.summary.create_noop_writer()
+
+            profiler = None
+            if is_chief and profile_steps is not None:
+                # the trace is written next to the train and test summaries, so TensorBoard picks it up
+                profiler = profile_window.ProfileWindow(os.path.join(output_folder, 'tensorboard-' + current_time), profile_steps[0], profile_steps[1])
+
+            epoch = int(epoch_variable.numpy())
+            start_step = int(step_variable.numpy())
+            # a resumed run might have already met the early stopping criteria before it was stopped
+            converged = is_converged(get_test_loss_by_epoch(test_loss, output_folder, async_eval), early_stopping_count)
+            log('Running Network')
+            while not converged:  # loop until early stopping
+                log('---- Epoch: {} ----'.format(epoch))
 
                 if epoch == 0:
                     cur_train_epoch_size = min(1000, train_epoch_size)
-                    print('Performing Adam Optimizer learning rate warmup for {} steps'.format(cur_train_epoch_size))
+                    log('Performing Adam Optimizer learning rate warmup for {} steps'.format(cur_train_epoch_size))
                     model.set_learning_rate(learning_rate / 10)
                 else:
                     cur_train_epoch_size = train_epoch_size
                     model.set_learning_rate(learning_rate)
 
+                crop_size = get_crop_size(crop_schedule, epoch)
+                if crop_size != current_crop_size:
+                    # move to the next stage of the crop size curriculum
+                    current_crop_size = crop_size
+                    train_reader.set_crop_size(crop_size)
+                    crop_shape = train_reader.get_crop_shape()
+                    image_size = train_reader.get_image_size()
+                    # scale the batch size with the crop area, keeping the pixels per batch (and so the memory use) constant
+                    stage_batch_size = max(1, int(batch_size * (image_size[0] * image_size[1]) / (crop_shape[0] * crop_shape[1])))
+                    stage_global_batch_size = stage_batch_size * mirrored_strategy.num_replicas_in_sync
+                    log('Training on {}x{} crops with batch size {}'.format(crop_shape[0], crop_shape[1], stage_batch_size))
+                    model.set_train_global_batch_size(stage_global_batch_size)
+                    train_dataset = create_train_dataset(train_reader, stage_global_batch_size, accumulate_steps, reader_count, multi_worker, mirrored_strategy)
+
                 # Iterate over the batches of the train dataset.
                 start_time = time.time()
-                for step, (batch_images, batch_labels) in enumerate(train_dataset):
+                for step, batch in enumerate(train_dataset, start_step):
                     if step > cur_train_epoch_size:
                         break
 
-                    inputs = (batch_images, batch_labels, train_loss_metric, train_acc_metric)
-                    model.dist_train_step(mirrored_strategy, inputs)
-
-                    print('Train Epoch {}: Batch {}/{}: Loss {} Accuracy = {}'.format(epoch, step, train_epoch_size, train_loss_metric.result(), train_acc_metric.result()))
+                    if profiler is None:
+                        run_train_step(model, mirrored_strategy, train_reader, batch, train_loss_metric, train_acc_metric)
+                    else:
+                        # profile steps use the same global step numbering as the tensorboard summaries
+                        with profiler.step(int(epoch * train_epoch_size + step)):
+                            run_train_step(model, mirrored_strategy, train_reader, batch, train_loss_metric, train_acc_metric)
+                    if async_eval:
+                        evaluator.touch_trainer_heartbeat(output_folder)
+
+                    # the last step of the epoch is covered by the end of epoch save, which writes the same
+                    # checkpoint number
+                    if checkpoint_every_n_steps > 0 and (step + 1) % checkpoint_every_n_steps == 0 and step < cur_train_epoch_size:
+                        step_variable.assign(step + 1)
+                        training_state_manager.save(checkpoint_number=model.get_optimizer().iterations, **save_kwargs)
+
+                    log('Train Epoch {}: Batch {}/{}: Loss {} Accuracy = {}'.format(epoch, step, train_epoch_size, train_loss_metric.result(), train_acc_metric.result()))
                     with train_summary_writer.as_default():
                         tf.summary.scalar('loss', train_loss_metric.result(), step=int(epoch * train_epoch_size + step))
                         tf.summary.scalar('accuracy', train_acc_metric.result(), step=int(epoch * train_epoch_size + step))
                     train_loss_metric.reset_states()
                     train_acc_metric.reset_states()
 
-                # Iterate over the batches of the test dataset.
-                epoch_test_loss = list()
-                for step, (batch_images, batch_labels) in enumerate(test_dataset):
-                    if step > test_epoch_size:
-                        break
-
-                    inputs = (batch_images, batch_labels, test_loss_metric, test_acc_metric)
-                    loss_value = model.dist_test_step(mirrored_strategy, inputs)
+                if not async_eval:
+                    # with async_eval the sidecar evaluator records the test loss of each completed epoch, lagging
+                    # behind training
+                    # Iterate over the batches of the test dataset.
+                    epoch_test_loss = list()
+                    for step, (batch_images, batch_labels) in enumerate(test_dataset):
+                        if step > test_epoch_size:
+                            break
+
+                        inputs = (batch_images, batch_labels, test_loss_metric, test_acc_metric)
+                        loss_value = model.dist_test_step(mirrored_strategy, inputs)
+
+                        epoch_test_loss.append(loss_value.numpy())
+                        # print('Test Epoch {}: Batch {}/{}: Loss {}'.format(epoch, step, test_epoch_size, loss_value))
+                    test_loss.append(np.mean(epoch_test_loss))
+
+                    log('Test Epoch: {}: Loss = {} Accuracy = {}'.format(epoch, test_loss_metric.result(), test_acc_metric.result()))
+                    with test_summary_writer.as_default():
+                        tf.summary.scalar('loss', test_loss_metric.result(), step=int((epoch+1) * train_epoch_size))
+                        tf.summary.scalar('accuracy', test_acc_metric.result(), step=int((epoch+1) * train_epoch_size))
+                    test_loss_metric.reset_states()
+                    test_acc_metric.reset_states()
+
+                    if is_chief:
+                        with open(os.path.join(output_folder, 'test_loss.csv'), 'w') as csvfile:
+                            for i in range(len(test_loss)):
+                                csvfile.write(str(test_loss[i]))
+                                csvfile.write('\n')
+
+                    # determine if to record a new checkpoint based on best test loss
+                    if (len(test_loss) - 1) == np.argmin(test_loss):
+                        # save tf checkpoint
+                        log('Test loss improved: {}, saving checkpoint'.format(np.min(test_loss)))
+                        # checkpoint.save(os.path.join(output_folder, 'checkpoint', "ckpt")) # does not overwrite
+                        checkpoint.write(best_checkpoint_write_filepath)
+                        training_checkpoint_filepath = best_checkpoint_filepath
+
+                log('Epoch took: {} s'.format(time.time() - start_time))
 
-                    epoch_test_loss.append(loss_value.numpy())
-                    # print('Test Epoch {}: Batch {}/{}: Loss {}'.format(epoch, step, test_epoch_size, loss_value))
-                test_loss.append(np.mean(epoch_test_loss))
+                # determine early stopping
+                log('Best Current Epoch Selection:')
+                log('Test Loss:')
+                test_loss_by_epoch = get_test_loss_by_epoch(test_loss, output_folder, async_eval)
+                log(test_loss_by_epoch)
+                best_epoch = get_best_epoch(test_loss_by_epoch) if len(test_loss_by_epoch) > 0 else 0
+                log('Best epoch: {}'.format(best_epoch))
 
-                print('Test Epoch: {}: Loss = {} Accuracy = {}'.format(epoch, test_loss_metric.result(), test_acc_metric.result()))
-                with test_summary_writer.as_default():
-                    tf.summary.scalar('loss', test_loss_metric.result(), step=int((epoch+1) * train_epoch_size))
-                    tf.summary.scalar('accuracy', test_acc_metric.result(), step=int((epoch+1) * train_epoch_size))
-                test_loss_metric.reset_states()
-                test_acc_metric.reset_states()
+                epoch = epoch + 1
+                start_step = 0
 
-                with open(os.path.join(output_folder, 'test_loss.csv'), 'w') as csvfile:
-                    for i in range(len(test_loss)):
-                        csvfile.write(str(test_loss[i]))
-                        csvfile.write('\n')
+                # record the completed epoch in the training state
+                epoch_variable.assign(epoch)
+                step_variable.assign(0)
+                training_state_manager.save(checkpoint_number=model.get_optimizer().iterations, **save_kwargs)
+                if eval_checkpoint is not None:
+                    eval_checkpoint.write(evaluator.get_eval_checkpoint_filepath(output_folder, epoch), **save_kwargs)
 
-                print('Epoch took: {} s'.format(time.time() - start_time))
+                if is_converged(test_loss_by_epoch, early_stopping_count):
+                    break  # break the epoch loop
 
-                # determine if to record a new checkpoint based on best test loss
-                if (len(test_loss) - 1) == np.argmin(test_loss):
-                    # save tf checkpoint
-                    print('Test loss improved: {}, saving checkpoint'.format(np.min(test_loss)))
-                    # checkpoint.save(os.path.join(output_folder, 'checkpoint', "ckpt")) # does not overwrite
-                    training_checkpoint_filepath = checkpoint.write(os.path.join(output_folder, 'checkpoint', "ckpt"))
+            if async_eval:
+                # the best checkpoint is written by the evaluator, wait for it to catch up with the final epoch
+                log('Waiting for the evaluator to evaluate epoch {}'.format(epoch))
+                wait_start_time = time.time()
+                while time.time() - wait_start_time < ASYNC_EVAL_TIMEOUT:
+                    results = evaluator.read_eval_results(output_folder)
+                    if len(results) > 0 and results[-1][0] >= epoch:
+                        break
+                    evaluator.touch_trainer_heartbeat(output_folder)
+                    time.sleep(10)
+                else:
+                    log('Timed out waiting for the evaluator')
+                # signal the evaluator to exit once it has no checkpoints left to evaluate
+                with open(training_complete_filepath, 'w') as fh:
+                    fh.write('{}\n'.format(epoch))
+                if os.path.exists(best_checkpoint_filepath + '.index'):
+                    training_checkpoint_filepath = best_checkpoint_filepath
 
-                # determine early stopping
-                CONVERGENCE_TOLERANCE = 1e-4
-                print('Best Current Epoch Selection:')
-                print('Test Loss:')
-                print(test_loss)
-                min_test_loss = np.min(test_loss)
-                error_from_best = np.abs(test_loss - min_test_loss)
-                error_from_best[error_from_best < CONVERGENCE_TOLERANCE] = 0
-                best_epoch = np.where(error_from_best == 0)[0][0] # unpack numpy array, select first time since that value has happened
-                print('Best epoch: {}'.format(best_epoch))
-
-                if len(test_loss) - best_epoch > early_stopping_count:
-                    break  # break the epoch loop
-                epoch = epoch + 1
+            if profiler is not None:
+                profiler.close()
 
         finally: # if any erros happened during training, shut down the disk readers
-            print('Shutting down train_reader')
+            if checkpoint_options is not None:
+                # wait for the asynchronous checkpoint writes, so the last training state is complete before the
+                # SavedModel export and before the process exits
+                try:
+                    for pending_checkpoint in (training_state_manager, eval_checkpoint):
+                        if pending_checkpoint is not None:
+                            pending_checkpoint.sync()
+                except Exception as e:
+                    # never skip the reader shutdown, which would leave the reader processes running
+                    print('Unable to wait for the checkpoint writes: {}'.format(e))
+            log('Shutting down train_reader')
             train_reader.shutdown()
-            print('Shutting down test_reader')
-            test_reader.shutdown()
+            if test_reader is not None:
+                log('Shutting down test_reader')
+                test_reader.shutdown()
+            multiworker.cleanup_write_folder(task_index)
 
     # convert training checkpoint to the saved model format
-    if training_checkpoint_filepath is not None:
+    if is_chief and training_checkpoint_filepath is not None:
         # restore the checkpoint and generate a saved model
-        model = unet_model.UNet(number_classes, global_batch_size, train_reader.get_image_size(), learning_rate)
+        model = unet_model.UNet(number_classes, global_batch_size, train_reader.get_image_size(), learning_rate, accumulate_steps=accumulate_steps)
         checkpoint = tf.train.Checkpoint(optimizer=model.get_optimizer(), model=model.get_keras_model())
         checkpoint.restore(training_checkpoint_filepath)
         tf.saved_model.save(model.get_keras_model(), os.path.join(output_folder, 'saved_model'))
 
 
-
+def main(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gpu_ids="", gradient_checkpoint_levels=0, accumulate_steps=1, resume=False, checkpoint_every_n_steps=0, init_from=None, freeze_encoder_levels=0, multi_worker=False, worker_hosts=None, task_index=None, async_eval=False, profile_steps=None, crop_schedule=None, auto_batch=False, memory_budget_mb=0, memory_safety_margin=0.1, loss_sampling=False, loss_sampling_floor=0.2, samples_per_decode=1, train_dataset_server=None, test_dataset_server=None, staging_cache=None):
     print('batch_size = {}'.format(batch_size))
     print('number_classes = {}'.format(number_classes))
     print('learning_rate = {}'.format(learning_rate))
@@ -213,8 +478,29 @@ def train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, te
     print('early_stopping count = {}'.format(early_stopping_count))
     print('reader_count = {}'.format(reader_count))
     print('gpu_ids = {}'.format(gpu_ids))
-
-    train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gpu_ids)
+    print('gradient_checkpoint_levels = {}'.format(gradient_checkpoint_levels))
+    print('accumulate_steps = {}'.format(accumulate_steps))
+    print('resume = {}'.format(resume))
+    print('checkpoint_every_n_steps = {}'.format(checkpoint_every_n_steps))
+    print('init_from = {}'.format(init_from))
+    print('freeze_encoder_levels = {}'.format(freeze_encoder_levels))
+    print('multi_worker = {}'.format(multi_worker))
+    print('worker_hosts = {}'.format(worker_hosts))
+    print('task_index = {}'.format(task_index))
+    print('async_eval = {}'.format(async_eval))
+    print('profile_steps = {}'.format(profile_steps))
+    print('crop_schedule = {}'.format(crop_schedule))
+    print('auto_batch = {}'.format(auto_batch))
+    print('memory_budget_mb = {}'.format(memory_budget_mb))
+    print('memory_safety_margin = {}'.format(memory_safety_margin))
+    print('loss_sampling = {}'.format(loss_sampling))
+    print('loss_sampling_floor = {}'.format(loss_sampling_floor))
+    print('samples_per_decode = {}'.format(samples_per_decode))
+    print('train_dataset_server = {}'.format(train_dataset_server))
+    print('test_dataset_server = {}'.format(test_dataset_server))
+    print('staging_cache = {}'.format(staging_cache))
+
+    train_model(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gpu_ids, gradient_checkpoint_levels, accumulate_steps, resume, checkpoint_every_n_steps, init_from, freeze_encoder_levels, multi_worker, worker_hosts, task_index, async_eval, profile_steps, crop_schedule, auto_batch, memory_budget_mb, memory_safety_margin, loss_sampling, loss_sampling_floor, samples_per_decode, train_dataset_server, test_dataset_server, staging_cache)
 
 
 if __name__ == "__main__":
@@ -234,6 +520,35 @@ if __name__ == "__main__":
 
      parser.add_argument('--early_stopping', dest='early_stopping_count', type=int, help='Perform early stopping when the test loss does not improve for N epochs.', default=10)
      parser.add_argument('--reader_count', dest='reader_count', type=int, help='how many threads to use for disk I/O and augmentation per gpu', default=1)
+     parser.add_argument('--gradient_checkpoint_levels', dest='gradient_checkpoint_levels', type=int, help='recompute the activations of the N highest resolution UNet levels in the backward pass instead of storing them, trading compute for memory [0 = disabled, 5 = all levels]', default=0)
+
+     parser.add_argument('--accumulate_steps', dest='accumulate_steps', type=int, help='number of micro-batches of batch_size to accumulate gradients over before each optimizer update (effective batch size = batch_size * gpu count * accumulate_steps)', default=1)
+     parser.add_argument('--resume', dest='resume', type=int, help='whether to resume training from the latest training state checkpoint in the output_dir [0 = false, 1 = true]', default=0)
+     parser.add_argument('--checkpoint_every_n_steps', dest='checkpoint_every_n_steps', type=int, help='save the full training state every N train steps (in addition to after every test epoch) [0 = only after test epochs]', default=0)
+     parser.add_argument('--init_from', dest='init_from', type=str, help='SavedModel directory, checkpoint directory or checkpoint file prefix to initialize the model weights from (for fine tuning)', default=None)
+     parser.add_argument('--freeze_encoder_levels', dest='freeze_encoder_levels', type=int, help='number of encoder levels (starting at the highest resolution) to freeze during training [0 = none, 5 = whole encoder including the bottleneck]', default=0)
+     parser.add_argument('--multi_worker', dest='multi_worker', type=int, help='whether to train data parallel across several workers (nodes) with the MultiWorkerMirroredStrategy [0 = false, 1 = true]. The cluster is derived from the SLURM environment unless worker_hosts is specified', default=0)
+     parser.add_argument('--worker_hosts', dest='worker_hosts', type=str, help='comma separated list of host:port addresses of all workers, e.g. "localhost:23456,localhost:23457"', default=None)
+     parser.add_argument('--task_index', dest='task_index', type=int, help='index of this worker within worker_hosts (worker 0 is the chief)', default=None)
+
+     parser.add_argument('--async_eval', dest='async_eval', type=int, help='whether to leave the test epochs to a separately launched evaluator.py process [0 = false, 1 = true]. Training no longer stalls on evaluation, early stopping uses the test loss the evaluator writes to the output_dir', default=0)
+
+     parser.add_argument('--profile_steps', dest='profile_steps', type=str, help='capture a Tensorflow profiler trace of the train steps START:END (inclusive, numbered like the tensorboard train summaries) into the tensorboard log directory, e.g. "1010:1020"', default=None)
+
+     parser.add_argument('--crop_schedule', dest='crop_schedule', type=str, help='progressive tile size curriculum, train on random crops of CROP pixels for EPOCHS epochs per stage before moving to full size tiles, e.g. "128:4,256:4". The batch size is scaled to keep the pixels per batch constant', default=None)
+
+     parser.add_argument('--auto_batch', dest='auto_batch', type=int, help='whether to replace batch_size with the largest per GPU batch size which fits in the memory budget, found with synthetic train steps at startup [0 = false, 1 = true]', default=0)
+     parser.add_argument('--memory_budget_mb', dest='memory_budget_mb', type=int, help='memory budget for auto_batch in MB [0 = the memory of the first GPU, or the host memory when training on CPU]', default=0)
+     parser.add_argument('--memory_safety_margin', dest='memory_safety_margin', type=float, help='fraction of the memory budget auto_batch leaves unused', default=0.1)
+
+     parser.add_argument('--loss_sampling', dest='loss_sampling', type=int, help='whether to sample training records with a probability proportional to their recent training loss (hard example mining) instead of uniformly [0 = false, 1 = true]. Cannot be combined with balance_classes', default=0)
+     parser.add_argument('--loss_sampling_floor', dest='loss_sampling_floor', type=float, help='fraction of the loss_sampling probability spread uniformly over all records, so no record is starved [0, 1]', default=0.2)
+
+     parser.add_argument('--samples_per_decode', dest='samples_per_decode', type=int, help='number of independently augmented training samples each reader produces from a decoded record, amortizing the database read and decode when I/O dominates', default=1)
+
+     parser.add_argument('--train_dataset_server', dest='train_dataset_server', type=str, help='unix socket address of a dataset_server.py process serving the training database, records are fetched already decoded from its shared cache instead of read from train_database', default=None)
+     parser.add_argument('--test_dataset_server', dest='test_dataset_server', type=str, help='unix socket address of a dataset_server.py process serving the test database', default=None)
+     parser.add_argument('--staging_cache', dest='staging_cache', type=str, help='node local folder to stage the train and test databases into; training starts reading the source databases while they are copied in the background, and staged copies are reused by later jobs on the node', default=None)
 
      # TODO add parameter to specify the devices to use for training
 
@@ -249,5 +564,26 @@ if __name__ == "__main__":
      balance_classes = args.balance_classes
      use_augmentation = args.use_augmentation
      reader_count = args.reader_count
-
-     main(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count)
+     gradient_checkpoint_levels = args.gradient_checkpoint_levels
+     accumulate_steps = args.accumulate_steps
+     resume = args.resume
+     checkpoint_every_n_steps = args.checkpoint_every_n_steps
+     init_from = args.init_from
+     freeze_encoder_levels = args.freeze_encoder_levels
+     multi_worker = args.multi_worker
+     worker_hosts = args.worker_hosts
+     task_index = args.task_index
+     async_eval = args.async_eval
+     profile_steps = profile_window.parse_profile_steps(args.profile_steps)
+     crop_schedule = parse_crop_schedule(args.crop_schedule)
+     auto_batch = args.auto_batch
+     memory_budget_mb = args.memory_budget_mb
+     memory_safety_margin = args.memory_safety_margin
+     loss_sampling = args.loss_sampling
+     loss_sampling_floor = args.loss_sampling_floor
+     samples_per_decode = args.samples_per_decode
+     train_dataset_server = args.train_dataset_server
+     test_dataset_server = args.test_dataset_server
+     staging_cache = args.staging_cache
+
+     main(output_folder, batch_size, reader_count, train_lmdb_filepath, test_lmdb_filepath, use_augmentation, number_classes, balance_classes, learning_rate, test_every_n_steps, early_stopping_count, gradient_checkpoint_levels=gradient_checkpoint_levels, accumulate_steps=accumulate_steps, resume=resume, checkpoint_every_n_steps=checkpoint_every_n_steps, init_from=init_from, freeze_encoder_levels=freeze_encoder_levels, multi_worker=multi_worker, worker_hosts=worker_hosts, task_index=task_index, async_eval=async_eval, profile_steps=profile_steps, crop_schedule=crop_schedule, auto_batch=auto_batch, memory_budget_mb=memory_budget_mb, memory_safety_margin=memory_safety_margin, loss_sampling=loss_sampling, loss_sampling_floor=loss_sampling_floor, samples_per_decode=samples_per_decode, train_dataset_server=train_dataset_server, test_dataset_server=test_dataset_server, staging_cache=staging_cache)
@@ -6,6 +6,7 @@ import sys
 if sys.version_info[0] < 3:
     raise Exception('Python3 required')
 
+import os
 import tensorflow as tf
 # tf_version = tf.__version__.split('.')
 # if int(tf_version[0]) != 2:
@@ -19,127 +20,201 @@ class UNet():
     _POOLING_STRIDE = 2
 
     SIZE_FACTOR = 16
+    NUMBER_LEVELS = 5  # 4 encoder/decoder levels plus the bottleneck
+    # layer name prefix of each encoder level, from the highest resolution level down to the bottleneck
+    ENCODER_LEVEL_NAMES = ['encoder_1', 'encoder_2', 'encoder_3', 'encoder_4', 'bottleneck']
     RADIUS = 96  # nearest multiple of 16 over 92 pixels radius required from the unet paper ((572 - 388) / 2 = 92)
 
-    @staticmethod
-    def _conv_layer(input, filter_count, kernel, stride=1):
-        output = tf.keras.layers.Conv2D(filters=filter_count,
-                                        kernel_size=kernel,
-                                        strides=stride,
-                                        padding='same',
-                                        activation=tf.keras.activations.relu,  # 'relu'
-                                        data_format='channels_first')(input)
-        output = tf.keras.layers.BatchNormalization(axis=1)(output)
+    def _layer(self, key, create_fn):
+        # layers are created on their first use (building the functional model), later passes through the network
+        # (e.g. the recomputing train forward pass) look them up by key, so they share the same weights
+        if key not in self._layers:
+            self._layers[key] = create_fn()
+        return self._layers[key]
+
+    def _conv_layer(self, input, key, filter_count, kernel, stride=1, training=None, name=None):
+        conv = self._layer(key + '_conv', lambda: tf.keras.layers.Conv2D(filters=filter_count,
+                                                                         kernel_size=kernel,
+                                                                         strides=stride,
+                                                                         padding='same',
+                                                                         activation=tf.keras.activations.relu,  # 'relu'
+                                                                         data_format='channels_first',
+                                                                         name=None if name is None else name + '_conv'))
+        bn = self._layer(key + '_bn', lambda: tf.keras.layers.BatchNormalization(axis=1, name=None if name is None else name + '_bn'))
+        output = conv(input)
+        output = bn(output, training=training)
         return output
 
-    @staticmethod
-    def _deconv_layer(input, filter_count, kernel, stride=1):
-        output = tf.keras.layers.Conv2DTranspose(filters=filter_count,
-                                                 kernel_size=kernel,
-                                                 strides=stride,
-                                                 activation=None,
-                                                 padding='same',
-                                                 data_format='channels_first')(input)
-        output = tf.keras.layers.BatchNormalization(axis=1)(output)
+    def _conv_block(self, input, key, filter_count, kernel, training=None, recompute=False, name=None):
+        # two stacked conv layers, which make up a single level of the encoder or decoder
+        # if a name is provided all layers of the block are named with it as a prefix
+        name_1 = None if name is None else name + '_1'
+        name_2 = None if name is None else name + '_2'
+
+        def block(x):
+            output = self._conv_layer(x, key + '_1', filter_count, kernel, training=training, name=name_1)
+            output = self._conv_layer(output, key + '_2', filter_count, kernel, training=training, name=name_2)
+            return output
+
+        if recompute:
+            # only the block input is stored, the forward pass through the block is re-run when its gradients are
+            # required
+            return tf.recompute_grad(block)(input)
+        return block(input)
+
+    def _deconv_layer(self, input, key, filter_count, kernel, stride=1, training=None):
+        deconv = self._layer(key + '_deconv', lambda: tf.keras.layers.Conv2DTranspose(filters=filter_count,
+                                                                                      kernel_size=kernel,
+                                                                                      strides=stride,
+                                                                                      activation=None,
+                                                                                      padding='same',
+                                                                                      data_format='channels_first'))
+        bn = self._layer(key + '_bn', lambda: tf.keras.layers.BatchNormalization(axis=1))
+        output = deconv(input)
+        output = bn(output, training=training)
         return output
 
-    @staticmethod
-    def _pool(input, size):
-        pool = tf.keras.layers.MaxPool2D(pool_size=size, data_format='channels_first')(input)
-        return pool
+    def _pool(self, input, key, size):
+        pool = self._layer(key, lambda: tf.keras.layers.MaxPool2D(pool_size=size, data_format='channels_first'))
+        return pool(input)
 
-    @staticmethod
-    def _concat(input1, input2, axis):
-        output = tf.keras.layers.Concatenate(axis=axis)([input1, input2])
-        return output
+    def _concat(self, input1, input2, key, axis):
+        concat = self._layer(key, lambda: tf.keras.layers.Concatenate(axis=axis))
+        return concat([input1, input2])
 
-    @staticmethod
-    def _dropout(input):
-        output = tf.keras.layers.Dropout(rate=0.5)(input)
-        return output
+    def _dropout(self, input, key, training=None):
+        dropout = self._layer(key, lambda: tf.keras.layers.Dropout(rate=0.5))
+        return dropout(input, training=training)
 
-    def __init__(self, number_classes, global_batch_size, img_size, learning_rate=3e-4, label_smoothing=0):
+    def __init__(self, number_classes, global_batch_size, img_size, learning_rate=3e-4, label_smoothing=0, checkpoint_levels=0, accumulate_steps=1, frozen_encoder_levels=0):
 
         self.img_size = img_size
         self.learning_rate = learning_rate
         self.number_classes = number_classes
         self.global_batch_size = global_batch_size
+        # the train loss is scaled by a variable, so the train batch size can change (e.g. between the stages of a crop
+        # size curriculum) without retracing the train step
+        self.train_global_batch_size = tf.Variable(float(global_batch_size), dtype=tf.float32, trainable=False)
+        # gradient checkpointing (activation recomputation) is applied to the conv blocks of the N highest resolution
+        # levels of the network [0 = disabled, 5 = all levels including the bottleneck]
+        # it only changes how the train step runs the network, the layers (and so the checkpoints and SavedModels) are
+        # the same for every number of checkpoint levels
+        if checkpoint_levels < 0 or checkpoint_levels > UNet.NUMBER_LEVELS:
+            raise ValueError('checkpoint_levels must be in [0, {}]'.format(UNet.NUMBER_LEVELS))
+        self.checkpoint_levels = checkpoint_levels
+        # number of micro-batches the gradients are summed over before a single optimizer update is applied
+        # each replica receives accumulate_steps * batch_size images per train_step, which are split into micro-batches
+        if accumulate_steps < 1:
+            raise ValueError('accumulate_steps must be >= 1')
+        self.accumulate_steps = accumulate_steps
 
         # image is HWC (normally e.g. RGB image) however data needs to be NCHW for network
         self.inputs = tf.keras.Input(shape=(img_size[2], None, None))
         # self.inputs = tf.keras.Input(shape=(img_size[2], img_size[0], img_size[1]))
-        self.model = self._build_model()
+        self._layers = dict()
+        self.model = tf.keras.Model(self.inputs, self._forward(self.inputs), name='unet')
+        # level n is recomputed in the backward pass if it is one of the checkpoint_levels highest resolution levels
+        self.recompute = [0 < level <= self.checkpoint_levels for level in range(UNet.NUMBER_LEVELS + 1)]
+        # the recomputed blocks run their BatchNormalization layers twice per train step
+        self.moving_statistics = [w for layer in self.model.layers if isinstance(layer, tf.keras.layers.BatchNormalization) for w in (layer.moving_mean, layer.moving_variance)]
+
+        # freeze the N highest resolution encoder levels (e.g. for fine tuning), frozen layers are excluded from the
+        # trainable weights, so they get neither gradients nor optimizer state
+        # frozen BatchNormalization layers run in inference mode, using their moving statistics
+        if frozen_encoder_levels < 0 or frozen_encoder_levels > UNet.NUMBER_LEVELS:
+            raise ValueError('frozen_encoder_levels must be in [0, {}]'.format(UNet.NUMBER_LEVELS))
+        self.frozen_encoder_levels = frozen_encoder_levels
+        for level_name in UNet.ENCODER_LEVEL_NAMES[0:frozen_encoder_levels]:
+            for layer in self.model.layers:
+                if layer.name == level_name or layer.name.startswith(level_name + '_'):
+                    layer.trainable = False
 
         self.loss_fn = tf.keras.losses.CategoricalCrossentropy(from_logits=False, label_smoothing=label_smoothing, reduction=tf.keras.losses.Reduction.NONE)
 
         self.optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate)
 
-    def _build_model(self):
+    def _forward(self, inputs, training=None, recompute=None):
+        # builds the functional model when called on the keras Input, the train step calls it directly to recompute
+        # the activations of the levels flagged in recompute (indexed by level, 1 = highest resolution)
+        if recompute is None:
+            recompute = [False] * (UNet.NUMBER_LEVELS + 1)
 
         # Encoder
-        conv_1 = UNet._conv_layer(self.inputs, UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        conv_1 = UNet._conv_layer(conv_1, UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        conv_1 = self._conv_block(inputs, 'conv_1', UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[1], name=UNet.ENCODER_LEVEL_NAMES[0])
 
-        pool_1 = UNet._pool(conv_1, UNet._POOLING_STRIDE)
+        pool_1 = self._pool(conv_1, 'pool_1', UNet._POOLING_STRIDE)
 
-        conv_2 = UNet._conv_layer(pool_1, 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        conv_2 = UNet._conv_layer(conv_2, 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        conv_2 = self._conv_block(pool_1, 'conv_2', 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[2], name=UNet.ENCODER_LEVEL_NAMES[1])
 
-        pool_2 = UNet._pool(conv_2, UNet._POOLING_STRIDE)
+        pool_2 = self._pool(conv_2, 'pool_2', UNet._POOLING_STRIDE)
 
-        conv_3 = UNet._conv_layer(pool_2, 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        conv_3 = UNet._conv_layer(conv_3, 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        conv_3 = self._conv_block(pool_2, 'conv_3', 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[3], name=UNet.ENCODER_LEVEL_NAMES[2])
 
-        pool_3 = UNet._pool(conv_3, UNet._POOLING_STRIDE)
+        pool_3 = self._pool(conv_3, 'pool_3', UNet._POOLING_STRIDE)
 
-        conv_4 = UNet._conv_layer(pool_3, 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        conv_4 = UNet._conv_layer(conv_4, 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        conv_4 = UNet._dropout(conv_4)
+        conv_4 = self._conv_block(pool_3, 'conv_4', 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[4], name=UNet.ENCODER_LEVEL_NAMES[3])
+        # dropout is kept outside of the recomputed blocks, recomputing it would draw a different dropout mask
+        conv_4 = self._dropout(conv_4, 'dropout_4', training)
 
-        pool_4 = UNet._pool(conv_4, UNet._POOLING_STRIDE)
+        pool_4 = self._pool(conv_4, 'pool_4', UNet._POOLING_STRIDE)
 
         # bottleneck
-        bottleneck = UNet._conv_layer(pool_4, 16 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        bottleneck = UNet._conv_layer(bottleneck, 16 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        bottleneck = UNet._dropout(bottleneck)
+        bottleneck = self._conv_block(pool_4, 'bottleneck', 16 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[5], name=UNet.ENCODER_LEVEL_NAMES[4])
+        bottleneck = self._dropout(bottleneck, 'dropout_bottleneck', training)
 
         # Decoder
         # up-conv which reduces the number of feature channels by 2
-        deconv_4 = UNet._deconv_layer(bottleneck, 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE)
-        deconv_4 = UNet._concat(conv_4, deconv_4, axis=1)
-        deconv_4 = UNet._conv_layer(deconv_4, 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        deconv_4 = UNet._conv_layer(deconv_4, 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        deconv_4 = self._deconv_layer(bottleneck, 'deconv_4', 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE, training=training)
+        deconv_4 = self._concat(conv_4, deconv_4, 'concat_4', axis=1)
+        deconv_4 = self._conv_block(deconv_4, 'decoder_4', 8 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[4])
 
-        deconv_3 = UNet._deconv_layer(deconv_4, 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE)
-        deconv_3 = UNet._concat(conv_3, deconv_3, axis=1)
-        deconv_3 = UNet._conv_layer(deconv_3, 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        deconv_3 = UNet._conv_layer(deconv_3, 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        deconv_3 = self._deconv_layer(deconv_4, 'deconv_3', 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE, training=training)
+        deconv_3 = self._concat(conv_3, deconv_3, 'concat_3', axis=1)
+        deconv_3 = self._conv_block(deconv_3, 'decoder_3', 4 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[3])
 
-        deconv_2 = UNet._deconv_layer(deconv_3, 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE)
-        deconv_2 = UNet._concat(conv_2, deconv_2, axis=1)
-        deconv_2 = UNet._conv_layer(deconv_2, 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        deconv_2 = UNet._conv_layer(deconv_2, 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        deconv_2 = self._deconv_layer(deconv_3, 'deconv_2', 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE, training=training)
+        deconv_2 = self._concat(conv_2, deconv_2, 'concat_2', axis=1)
+        deconv_2 = self._conv_block(deconv_2, 'decoder_2', 2 * UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[2])
 
-        deconv_1 = UNet._deconv_layer(deconv_2, UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE)
-        deconv_1 = UNet._concat(conv_1, deconv_1, axis=1)
-        deconv_1 = UNet._conv_layer(deconv_1, UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
-        deconv_1 = UNet._conv_layer(deconv_1, UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE)
+        deconv_1 = self._deconv_layer(deconv_2, 'deconv_1', UNet._BASELINE_FEATURE_DEPTH, UNet._DECONV_KERNEL_SIZE, stride=UNet._POOLING_STRIDE, training=training)
+        deconv_1 = self._concat(conv_1, deconv_1, 'concat_1', axis=1)
+        deconv_1 = self._conv_block(deconv_1, 'decoder_1', UNet._BASELINE_FEATURE_DEPTH, UNet._KERNEL_SIZE, training, recompute[1])
 
-        logits = UNet._conv_layer(deconv_1, self.number_classes, 1)  # 1x1 kernel to convert feature map into class map
+        logits = self._conv_layer(deconv_1, 'logits', self.number_classes, 1, training=training)  # 1x1 kernel to convert feature map into class map
 
         # convert NCHW to NHWC so that softmax axis is the last dimension
-        logits = tf.keras.layers.Permute((2, 3, 1))(logits)
+        logits = self._layer('permute', lambda: tf.keras.layers.Permute((2, 3, 1)))(logits)
         # logits is [NHWC]
 
-        softmax = tf.keras.layers.Softmax(axis=-1, name='softmax')(logits)
-
-        unet = tf.keras.Model(self.inputs, softmax, name='unet')
+        softmax = self._layer('softmax', lambda: tf.keras.layers.Softmax(axis=-1, name='softmax'))(logits)
 
-        return unet
+        return softmax
 
     def get_keras_model(self):
         return self.model
 
+    def restore_weights(self, filepath):
+        # Initialize the model weights from either a SavedModel directory (as written by train_unet), a directory of
+        # checkpoints (the latest is used), or a training checkpoint file prefix. Only the model weights are restored,
+        # any optimizer state in the checkpoint is ignored.
+        if os.path.exists(os.path.join(filepath, 'saved_model.pb')):
+            # the SavedModel variables are a checkpoint rooted at the keras model
+            status = self.model.load_weights(os.path.join(filepath, 'variables', 'variables'))
+        else:
+            if os.path.isdir(filepath):
+                checkpoint_filepath = tf.train.latest_checkpoint(filepath)
+                if checkpoint_filepath is None and os.path.exists(os.path.join(filepath, 'ckpt.index')):
+                    # the best checkpoint folder of a training run, written without a checkpoint state file
+                    checkpoint_filepath = os.path.join(filepath, 'ckpt')
+                if checkpoint_filepath is None:
+                    raise IOError('No checkpoint found in: {}'.format(filepath))
+                filepath = checkpoint_filepath
+            # read (rather than restore) since the training checkpoints are written without a save counter
+            status = tf.train.Checkpoint(model=self.model).read(filepath)
+        # every layer of this model needs a value in the checkpoint
+        status.assert_existing_objects_matched()
+        status.expect_partial()
+
     def get_optimizer(self):
         return self.optimizer
 
@@ -149,31 +224,84 @@ class UNet():
     def get_learning_rate(self):
         return self.optimizer.learning_rate
 
-    def train_step(self, inputs):
-        (images, labels, loss_metric, accuracy_metric) = inputs
+    def set_train_global_batch_size(self, global_batch_size):
+        self.train_global_batch_size.assign(float(global_batch_size))
+
+    def _compute_gradients(self, images, labels):
         # Open a GradientTape to record the operations run
         # during the forward pass, which enables autodifferentiation.
         with tf.GradientTape() as tape:
-            softmax = self.model(images, training=True)
+            if self.checkpoint_levels > 0:
+                # runs the same layers as self.model, with the activations of the recomputed levels dropped
+                softmax = self._forward(images, training=True, recompute=self.recompute)
+            else:
+                softmax = self.model(images, training=True)
 
             loss_value = self.loss_fn(labels, softmax) # [NxHxWx1]
+            # mean loss of each image, reported back to a loss driven sampler
+            sample_loss_value = tf.reduce_mean(loss_value, axis=[1, 2])
             # average across the batch (N) with the approprite global batch size
-            loss_value = tf.reduce_sum(loss_value, axis=0) / self.global_batch_size
+            # when accumulating gradients the effective global batch spans all of the micro-batches
+            loss_value = tf.reduce_sum(loss_value, axis=0) / (self.train_global_batch_size * self.accumulate_steps)
             # reduce down to a scalar (reduce H, W)
             loss_value = tf.reduce_mean(loss_value)
 
         # Use the gradient tape to automatically retrieve
         # the gradients of the trainable variables with respect to the loss.
-        grads = tape.gradient(loss_value, self.model.trainable_weights)
+        if self.checkpoint_levels > 0:
+            # the recompute in the backward pass updates the BatchNormalization moving statistics a second time, they
+            # are put back to their values after the forward pass so they get a single momentum update per batch
+            moving_values = [w.read_value() for w in self.moving_statistics]
+            grads = tape.gradient(loss_value, self.model.trainable_weights)
+            with tf.control_dependencies(grads):
+                for w, v in zip(self.moving_statistics, moving_values):
+                    w.assign(v)
+        else:
+            grads = tape.gradient(loss_value, self.model.trainable_weights)
+        return loss_value, grads, softmax, tf.stop_gradient(sample_loss_value)
+
+    def train_step(self, inputs):
+        loss_value, _ = self.train_step_with_sample_losses(inputs)
+        return loss_value
+
+    def train_step_with_sample_losses(self, inputs):
+        # returns the (scaled) batch loss and the [N] mean loss of each image in the batch
+        (images, labels, loss_metric, accuracy_metric) = inputs
+
+        if self.accumulate_steps == 1:
+            loss_value, grads, softmax, sample_loss_value = self._compute_gradients(images, labels)
+            accuracy_metric.update_state(labels, softmax)
+        else:
+            # split the per replica batch into micro-batches, only one micro-batch worth of activations is alive at once
+            # when the batch does not divide evenly by accumulate_steps the last micro-batch holds the remainder. The
+            # loss is a sum over the images scaled by the effective batch size, so every image carries the same weight
+            # whichever micro-batch it is in.
+            batch_size = tf.shape(images)[0]
+            micro_batch_size = (batch_size + self.accumulate_steps - 1) // self.accumulate_steps
+            micro_batch_count = (batch_size + micro_batch_size - 1) // micro_batch_size
+            loss_value = tf.constant(0.0)
+            grads = [tf.zeros_like(w) for w in self.model.trainable_weights]
+            sample_losses = tf.TensorArray(tf.float32, size=micro_batch_count, infer_shape=False)
+            for k in tf.range(micro_batch_count):
+                st = k * micro_batch_size
+                micro_images = images[st:st + micro_batch_size]
+                micro_labels = labels[st:st + micro_batch_size]
+                # BatchNormalization statistics (and moving average updates) are computed per micro-batch
+                micro_loss_value, micro_grads, softmax, micro_sample_loss_value = self._compute_gradients(micro_images, micro_labels)
+                # the loss is already scaled by the effective batch size, so the sum is the full batch gradient
+                grads = [g + mg for g, mg in zip(grads, micro_grads)]
+                loss_value += micro_loss_value
+                sample_losses = sample_losses.write(k, micro_sample_loss_value)
+                accuracy_metric.update_state(micro_labels, softmax)
+            sample_loss_value = sample_losses.concat()
 
         # Run one step of gradient descent by updating
         # the value of the variables to minimize the loss.
         self.optimizer.apply_gradients(zip(grads, self.model.trainable_weights))
 
         loss_metric.update_state(loss_value)
-        accuracy_metric.update_state(labels, softmax)
 
-        return loss_value
+        return loss_value, sample_loss_value
 
     @tf.function
     def dist_train_step(self, dist_strategy, inputs):
@@ -182,6 +310,16 @@ class UNet():
 
         return loss_value
 
+    @tf.function
+    def dist_train_step_with_sample_losses(self, dist_strategy, inputs, keys):
+        # keys identify the images of the batch, they are returned in the same (local replica) order as the losses
+        per_gpu_loss, per_gpu_sample_loss = dist_strategy.experimental_run_v2(self.train_step_with_sample_losses, args=(inputs,))
+        loss_value = dist_strategy.reduce(tf.distribute.ReduceOp.SUM, per_gpu_loss, axis=None)
+        sample_loss_value = tf.concat(dist_strategy.experimental_local_results(per_gpu_sample_loss), axis=0)
+        keys = tf.concat(dist_strategy.experimental_local_results(keys), axis=0)
+
+        return loss_value, sample_loss_value, keys
+
     def test_step(self, inputs):
         (images, labels, loss_metric, accuracy_metric) = inputs
         softmax = self.model(images, training=False)
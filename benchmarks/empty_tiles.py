@@ -0,0 +1,92 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import inference
+
+
+def main(saved_model_filepath, image_folder, image_format, image_count, tile_size, tile_batch_size, empty_tile_std, empty_tile_max, background_class, output_filepath):
+    model = tf.saved_model.load(saved_model_filepath)
+    empty_tile_filter = inference.EmptyTileFilter(empty_tile_std, empty_tile_max, background_class)
+
+    img_filepath_list = sorted([os.path.join(image_folder, fn) for fn in os.listdir(image_folder) if fn.endswith('.{}'.format(image_format))])
+    if image_count > 0:
+        img_filepath_list = img_filepath_list[0:image_count]
+    if len(img_filepath_list) == 0:
+        raise IOError('No {} images in {}'.format(image_format, image_folder))
+
+    # trace the model for the image shape first, so neither timed pass pays for it
+    img, raw_img = inference._load_image(img_filepath_list[0], keep_raw=True)
+    inference._segment_image(img, model, tile_size, tile_batch_size)
+
+    full_time = 0.0
+    filtered_time = 0.0
+    tile_counts = dict()
+    results = list()
+    for img_filepath in img_filepath_list:
+        img, raw_img = inference._load_image(img_filepath, keep_raw=True)
+
+        start_time = time.time()
+        reference = inference._segment_image(img, model, tile_size, tile_batch_size)
+        full_time += time.time() - start_time
+
+        image_tile_counts = dict()
+        start_time = time.time()
+        mask = inference._segment_image(img, model, tile_size, tile_batch_size, raw_img, empty_tile_filter, image_tile_counts)
+        filtered_time += time.time() - start_time
+
+        differing_pixels = int(np.count_nonzero(mask != reference))
+        for key, value in image_tile_counts.items():
+            tile_counts[key] = tile_counts.get(key, 0) + value
+        results.append({'image': os.path.basename(img_filepath), 'tiles': image_tile_counts.get('tiles', 0), 'skipped_tiles': image_tile_counts.get('skipped_tiles', 0), 'differing_pixels': differing_pixels})
+        if differing_pixels > 0:
+            print('{}: {} of {} tiles skipped, {} pixels differ from full inference'.format(results[-1]['image'], results[-1]['skipped_tiles'], results[-1]['tiles'], differing_pixels))
+
+    differing_images = [r['image'] for r in results if r['differing_pixels'] > 0]
+    summary = {'image_count': len(results), 'tile_size': tile_size, 'empty_tile_std': empty_tile_std, 'empty_tile_max': empty_tile_max,
+               'tiles': tile_counts.get('tiles', 0), 'skipped_tiles': tile_counts.get('skipped_tiles', 0),
+               'full_time': full_time, 'filtered_time': filtered_time, 'speedup': full_time / max(filtered_time, 1e-6),
+               'differing_images': len(differing_images), 'differing_pixels': sum(r['differing_pixels'] for r in results)}
+    print('{} images, {} of {} tiles skipped as empty'.format(summary['image_count'], summary['skipped_tiles'], summary['tiles']))
+    print('full inference {:.2f} s, with the empty tile filter {:.2f} s ({:.2f}x)'.format(full_time, filtered_time, summary['speedup']))
+    print('{} images ({} pixels) differ from full inference'.format(summary['differing_images'], summary['differing_pixels']))
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump({'summary': summary, 'images': results}, fh, indent=2)
+    if len(differing_images) > 0:
+        print('The empty tile thresholds are not conservative enough for this model and these images')
+        sys.exit(1)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='empty_tiles', description='Check that skipping empty tiles matches full inference on a folder of images, and measure the speedup')
+
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel of a trained model', required=True)
+    parser.add_argument('--image_folder', dest='image_folder', type=str, help='folder of images to check', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'images'))
+    parser.add_argument('--image_format', dest='image_format', type=str, default='tif')
+    parser.add_argument('--image_count', dest='image_count', type=int, help='number of images to check [0 = all]', default=0)
+    parser.add_argument('--tile_size', dest='tile_size', type=int, default=1024)
+    parser.add_argument('--tile_batch_size', dest='tile_batch_size', type=int, default=1)
+    parser.add_argument('--empty_tile_std', dest='empty_tile_std', type=float, help='raw intensity standard deviation below which a tile is empty [0 = disabled]', default=0.0)
+    parser.add_argument('--empty_tile_max', dest='empty_tile_max', type=float, help='raw maximum intensity below which a tile is empty [0 = disabled]', default=0.0)
+    parser.add_argument('--background_class', dest='background_class', type=int, default=0)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the results into', default=None)
+
+    args = parser.parse_args()
+
+    main(args.saved_model_filepath, args.image_folder, args.image_format, args.image_count, args.tile_size, args.tile_batch_size, args.empty_tile_std, args.empty_tile_max, args.background_class, args.output_filepath)
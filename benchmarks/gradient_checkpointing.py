@@ -0,0 +1,53 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import json
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import memory_probe
+
+
+def main(tile_sizes, checkpoint_levels_list, batch_size, number_channels, number_classes, step_count, output_filepath):
+    # report the peak memory vs step time trade off of gradient checkpointing for each tile size
+    results = list()
+    print('{:>10} {:>18} {:>18} {:>14}'.format('tile_size', 'checkpoint_levels', 'peak_memory (MB)', 'step_time (s)'))
+    for tile_size in tile_sizes:
+        for checkpoint_levels in checkpoint_levels_list:
+            result = memory_probe.measure_train_step([tile_size, tile_size, number_channels], batch_size, number_classes, checkpoint_levels, step_count)
+            results.append(result)
+            if result['oom']:
+                print('{:>10} {:>18} {:>18} {:>14}'.format(tile_size, checkpoint_levels, 'OOM', '-'))
+            elif result['step_time'] is None:
+                print('{:>10} {:>18} {:>18} {:>14}'.format(tile_size, checkpoint_levels, 'error', '-'))
+            else:
+                print('{:>10} {:>18} {:>18.1f} {:>14.4f}'.format(tile_size, checkpoint_levels, result['peak_memory_bytes'] / 2**20, result['step_time']))
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='gradient_checkpointing', description='Report peak memory vs step time for UNet gradient checkpointing at several tile sizes')
+
+    parser.add_argument('--tile_sizes', dest='tile_sizes', type=str, help='comma separated list of tile sizes (multiples of 16)', default='256,512,1024')
+    parser.add_argument('--checkpoint_levels', dest='checkpoint_levels', type=str, help='comma separated list of checkpoint levels to compare [0 = disabled, 5 = all]', default='0,2,5')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=4)
+    parser.add_argument('--number_channels', dest='number_channels', type=int, default=1)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--step_count', dest='step_count', type=int, help='number of timed training steps per configuration', default=5)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the results into', default=None)
+
+    args = parser.parse_args()
+    tile_sizes = [int(t) for t in args.tile_sizes.split(',')]
+    checkpoint_levels_list = [int(c) for c in args.checkpoint_levels.split(',')]
+
+    main(tile_sizes, checkpoint_levels_list, args.batch_size, args.number_channels, args.number_classes, args.step_count, args.output_filepath)
@@ -0,0 +1,109 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import inference
+import inference_backends
+
+
+def _backend_filepath(backend, saved_model_filepath, exported_folder):
+    if backend == 'saved_model':
+        return saved_model_filepath
+    return os.path.join(exported_folder, 'model.{}'.format(backend))
+
+
+def main(saved_model_filepath, exported_folder, backends, image_folder, image_format, image_count, tile_size, tile_batch_size, repeats, thread_count, output_filepath):
+    if exported_folder is None:
+        exported_folder = os.path.join(os.path.dirname(os.path.abspath(saved_model_filepath)), 'exported')
+    img_filepath_list = sorted([os.path.join(image_folder, fn) for fn in os.listdir(image_folder) if fn.endswith('.{}'.format(image_format))])
+    if image_count > 0:
+        img_filepath_list = img_filepath_list[0:image_count]
+    images = [inference._load_image(fp) for fp in img_filepath_list]
+    megapixels = sum(img.shape[0] * img.shape[1] for img in images) / 1e6
+    print('{} images ({:.2f} Mpixels), tile size {}'.format(len(images), megapixels, tile_size))
+
+    results = list()
+    reference_masks = None
+    for backend in backends:
+        model_filepath = _backend_filepath(backend, saved_model_filepath, exported_folder)
+        if not os.path.exists(model_filepath):
+            print('{}: skipped, {} does not exist (see export_model.py)'.format(backend, model_filepath))
+            continue
+        start_time = time.time()
+        try:
+            model = inference_backends.load_backend(model_filepath, backend, thread_count)
+        except ImportError as e:
+            print('{}: skipped, {}'.format(backend, e))
+            continue
+        load_time = time.time() - start_time
+
+        # the first image includes the kernel setup for its shape
+        start_time = time.time()
+        inference._segment_image(images[0], model, tile_size, tile_batch_size)
+        first_time = time.time() - start_time
+
+        latencies = list()
+        masks = list()
+        for r in range(repeats):
+            for img in images:
+                start_time = time.time()
+                mask = inference._segment_image(img, model, tile_size, tile_batch_size)
+                latencies.append(time.time() - start_time)
+                if r == 0:
+                    masks.append(mask)
+        total_time = sum(latencies)
+        result = {'backend': backend, 'model_filepath': model_filepath, 'load_time': load_time, 'first_image_time': first_time,
+                  'p50_latency': float(np.percentile(latencies, 50)), 'p90_latency': float(np.percentile(latencies, 90)),
+                  'images_per_s': len(latencies) / total_time, 'megapixels_per_s': megapixels * repeats / total_time}
+
+        # agreement with the first backend (the SavedModel by default), per pixel and per image
+        if reference_masks is None:
+            reference_masks = masks
+            result['reference'] = True
+        equal_pixels = sum(int(np.count_nonzero(m == ref)) for m, ref in zip(masks, reference_masks))
+        result['pixel_agreement'] = equal_pixels / sum(m.size for m in masks)
+        result['identical_images'] = sum(1 for m, ref in zip(masks, reference_masks) if np.array_equal(m, ref))
+        results.append(result)
+        del model
+
+    print('{:>12} {:>9} {:>10} {:>9} {:>9} {:>9} {:>8} {:>11} {:>10}'.format('backend', 'load (s)', 'first (s)', 'p50 (s)', 'p90 (s)', 'images/s', 'MP/s', 'agreement', 'identical'))
+    for r in results:
+        print('{:>12} {:>9.2f} {:>10.3f} {:>9.3f} {:>9.3f} {:>9.2f} {:>8.3f} {:>11.4%} {:>6}/{:<3}'.format(r['backend'], r['load_time'], r['first_image_time'], r['p50_latency'], r['p90_latency'], r['images_per_s'], r['megapixels_per_s'], r['pixel_agreement'], r['identical_images'], len(images)))
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump({'image_count': len(images), 'tile_size': tile_size, 'tile_batch_size': tile_batch_size, 'thread_count': thread_count, 'results': results}, fh, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='inference_backends', description='Compare the latency, throughput and output agreement of the inference backends of a model on a folder of images')
+
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel of a trained model (Required)', required=True)
+    parser.add_argument('--exported_folder', dest='exported_folder', type=str, help='folder with the model.tflite and model.onnx written by export_model.py [default: exported/ next to the SavedModel]', default=None)
+    parser.add_argument('--backends', dest='backends', type=str, help='comma separated list of backends, the outputs are compared with the first one', default='saved_model,tflite,onnx')
+    parser.add_argument('--image_folder', dest='image_folder', type=str, help='folder of images to segment', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'images'))
+    parser.add_argument('--image_format', dest='image_format', type=str, default='tif')
+    parser.add_argument('--image_count', dest='image_count', type=int, help='number of images to segment [0 = all]', default=20)
+    parser.add_argument('--tile_size', dest='tile_size', type=int, default=1024)
+    parser.add_argument('--tile_batch_size', dest='tile_batch_size', type=int, default=1)
+    parser.add_argument('--repeats', dest='repeats', type=int, help='number of timed passes over the images', default=1)
+    parser.add_argument('--thread_count', dest='thread_count', type=int, help='threads of the tflite and onnx backends [0 = the runtime default]', default=0)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the results into', default=None)
+
+    args = parser.parse_args()
+    backends = [b.strip() for b in args.backends.split(',') if len(b.strip()) > 0]
+
+    main(args.saved_model_filepath, args.exported_folder, backends, args.image_folder, args.image_format, args.image_count, args.tile_size, args.tile_batch_size, args.repeats, args.thread_count, args.output_filepath)
@@ -0,0 +1,125 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import inference_server
+import imagereader
+
+
+def _client(address, images, request_count, offset, latencies, errors):
+    connection = inference_server.connect(address)
+    try:
+        for r in range(request_count):
+            img = images[(offset + r) % len(images)]
+            start_time = time.time()
+            try:
+                inference_server.segment(connection, img)
+            except Exception as e:
+                errors.append(str(e))
+                connection.close()
+                connection = inference_server.connect(address)
+                continue
+            latencies.append(time.time() - start_time)
+    finally:
+        connection.close()
+
+
+def _run_load(address, images, concurrency, request_count):
+    # request_count requests per client, every client starting at a different image
+    latencies = list()
+    errors = list()
+    clients = [threading.Thread(target=_client, args=(address, images, request_count, c, latencies, errors)) for c in range(concurrency)]
+    start_time = time.time()
+    for t in clients:
+        t.start()
+    for t in clients:
+        t.join()
+    wall_time = time.time() - start_time
+    result = {'concurrency': concurrency, 'requests': len(latencies), 'errors': len(errors), 'wall_time': wall_time, 'images_per_s': len(latencies) / wall_time}
+    if len(latencies) > 0:
+        for p in [50, 90, 99]:
+            result['p{}_latency'.format(p)] = float(np.percentile(latencies, p))
+    return result
+
+
+def main(address, saved_model_filepath, image_folder, image_format, image_count, concurrency_list, request_count, max_batch_size, max_wait_ms, output_filepath):
+    img_filepath_list = sorted([os.path.join(image_folder, fn) for fn in os.listdir(image_folder) if fn.endswith('.{}'.format(image_format))])[0:image_count]
+    images = [imagereader.imread(fp) for fp in img_filepath_list]
+    print('{} images of {}'.format(len(images), images[0].shape))
+
+    tmp_folder = None
+    httpd = None
+    server = None
+    if address is None:
+        # serve in this process on a unix socket, entirely local
+        tmp_folder = tempfile.mkdtemp(prefix='inference_server_')
+        address = os.path.join(tmp_folder, 'inference.sock')
+        warmup_size = (images[0].shape[0], images[0].shape[1])
+        number_channels = images[0].shape[2] if len(images[0].shape) == 3 else 1
+        server = inference_server.InferenceServer(saved_model_filepath, max_batch_size, max_wait_ms, warmup_size=warmup_size, number_channels=number_channels)
+        httpd = inference_server.create_http_server(server, unix_socket=address)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    try:
+        # untimed requests, so the first measurement does not include connection setup and tracing
+        _run_load(address, images, 1, 2)
+        results = list()
+        print('{:>12} {:>9} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('concurrency', 'requests', 'errors', 'images/s', 'p50 (s)', 'p90 (s)', 'p99 (s)'))
+        for concurrency in concurrency_list:
+            r = _run_load(address, images, concurrency, request_count)
+            results.append(r)
+            print('{:>12} {:>9} {:>7} {:>10.2f} {:>10.3f} {:>10.3f} {:>10.3f}'.format(r['concurrency'], r['requests'], r['errors'], r['images_per_s'], r.get('p50_latency', float('nan')), r.get('p90_latency', float('nan')), r.get('p99_latency', float('nan'))))
+
+        connection = inference_server.connect(address)
+        metrics = inference_server.get_metrics(connection)
+        connection.close()
+        print([line for line in metrics.split('\n') if line.startswith('unet_batch_size_sum') or line.startswith('unet_batch_size_count')])
+    finally:
+        if httpd is not None:
+            httpd.shutdown()
+            httpd.server_close()
+            server.shutdown()
+        if tmp_folder is not None:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump({'image_shape': list(images[0].shape), 'results': results}, fh, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='inference_server_load', description='Measure the latency and throughput of an inference server under concurrent clients')
+
+    parser.add_argument('--address', dest='address', type=str, help='host:port or unix socket of a running inference_server.py [default: start one in this process on a unix socket]', default=None)
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel to serve when no address is given', default=None)
+    parser.add_argument('--image_folder', dest='image_folder', type=str, help='folder of images to send', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'images'))
+    parser.add_argument('--image_format', dest='image_format', type=str, default='tif')
+    parser.add_argument('--image_count', dest='image_count', type=int, help='number of distinct images to send', default=16)
+    parser.add_argument('--concurrency', dest='concurrency', type=str, help='comma separated list of concurrent client counts', default='1,2,4,8')
+    parser.add_argument('--requests', dest='request_count', type=int, help='requests per client', default=16)
+    parser.add_argument('--max_batch_size', dest='max_batch_size', type=int, help='max_batch_size of the server started in this process', default=8)
+    parser.add_argument('--max_wait_ms', dest='max_wait_ms', type=float, help='max_wait_ms of the server started in this process', default=10)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the results into', default=None)
+
+    args = parser.parse_args()
+    if args.address is None and args.saved_model_filepath is None:
+        parser.error('either --address or --saved_model_filepath is required')
+    concurrency_list = [int(c) for c in args.concurrency.split(',')]
+
+    main(args.address, args.saved_model_filepath, args.image_folder, args.image_format, args.image_count, concurrency_list, args.request_count, args.max_batch_size, args.max_wait_ms, args.output_filepath)
@@ -0,0 +1,263 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import augment
+import build_lmdb
+import imagereader
+import memory_probe
+from isg_ai_pb2 import ImageMaskPair
+
+import lmdb
+
+
+SECTIONS = ['build_lmdb', 'lmdb_read', 'augment', 'image_reader', 'unet']
+DEFAULT_DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+
+
+def _augmentation_configs():
+    # each transform in isolation, with the severities the ImageReader trains with, plus the full ImageReader set
+    r = imagereader.ImageReader
+    configs = dict()
+    configs['none'] = dict()
+    configs['reflection'] = {'reflection_flag': True}
+    configs['rotation'] = {'rotation_flag': True}
+    configs['jitter'] = {'jitter_augmentation_severity': r._jitter_augmentation_severity}
+    configs['noise'] = {'noise_augmentation_severity': r._noise_augmentation_severity}
+    configs['scale'] = {'scale_augmentation_severity': r._scale_augmentation_severity}
+    configs['blur'] = {'blur_augmentation_max_sigma': r._blur_max_sigma}
+    configs['intensity'] = {'intensity_augmentation_severity': r._intensity_augmentation_severity if r._intensity_augmentation_severity is not None else 0.05}
+    configs['all'] = {'reflection_flag': r._reflection_flag, 'rotation_flag': r._rotation_flag,
+                      'jitter_augmentation_severity': r._jitter_augmentation_severity,
+                      'noise_augmentation_severity': r._noise_augmentation_severity,
+                      'scale_augmentation_severity': r._scale_augmentation_severity,
+                      'blur_augmentation_max_sigma': r._blur_max_sigma,
+                      'intensity_augmentation_severity': r._intensity_augmentation_severity}
+    return configs
+
+
+def _read_samples(lmdb_filepath, sample_count):
+    # decode up to sample_count image mask pairs from the database
+    samples = list()
+    datum = ImageMaskPair()
+    env = lmdb.open(lmdb_filepath, readonly=True, lock=False)
+    with env.begin(write=False) as txn:
+        for key, value in txn.cursor():
+            datum.ParseFromString(value)
+            img = np.frombuffer(datum.image, dtype=datum.img_type).reshape((datum.img_height, datum.img_width, datum.channels))
+            msk = np.frombuffer(datum.mask, dtype=datum.mask_type).reshape((datum.img_height, datum.img_width))
+            samples.append((img, msk))
+            if len(samples) >= sample_count:
+                break
+    env.close()
+    return samples
+
+
+def bench_build_lmdb(image_folder, mask_folder, working_folder):
+    img_files = sorted([f for f in os.listdir(mask_folder) if f.endswith('.tif')])
+    start_time = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):  # silence the per image progress
+        build_lmdb.generate_database(img_files, 'benchmark.lmdb', image_folder, mask_folder, working_folder, 0)
+    elapsed = time.time() - start_time
+    return {'build_lmdb.images_per_s': len(img_files) / elapsed}
+
+
+def bench_lmdb_read(lmdb_filepath, sample_count):
+    # raw read and protobuf decode, no augmentation or normalization
+    env = lmdb.open(lmdb_filepath, readonly=True, lock=False)
+    with env.begin(write=False) as txn:
+        keys = [key for key in txn.cursor().iternext(keys=True, values=False)]
+    env.close()
+
+    datum = ImageMaskPair()
+    env = lmdb.open(lmdb_filepath, readonly=True, lock=False)
+    start_time = time.time()
+    with env.begin(write=False) as txn:
+        for i in range(sample_count):
+            datum.ParseFromString(txn.get(keys[np.random.randint(len(keys))]))
+            img = np.frombuffer(datum.image, dtype=datum.img_type).reshape((datum.img_height, datum.img_width, datum.channels))
+            msk = np.frombuffer(datum.mask, dtype=datum.mask_type).reshape((datum.img_height, datum.img_width))
+    elapsed = time.time() - start_time
+    env.close()
+    return {'lmdb_read.samples_per_s': sample_count / elapsed}
+
+
+def bench_augment(lmdb_filepath, sample_count):
+    samples = _read_samples(lmdb_filepath, sample_count)
+    results = dict()
+    for name, config in _augmentation_configs().items():
+        start_time = time.time()
+        for img, msk in samples:
+            augment.augment_image(img.astype(np.float32), msk, **config)
+        elapsed = time.time() - start_time
+        results['augment.{}.ms_per_sample'.format(name)] = 1000.0 * elapsed / len(samples)
+    return results
+
+
+def bench_image_reader(lmdb_filepath, worker_counts, sample_count, number_classes, samples_per_decode=1):
+    # end to end ImageReader throughput (read, augment, normalize, one-hot) as seen by the training loop
+    results = dict()
+    for worker_count in worker_counts:
+        with contextlib.redirect_stdout(io.StringIO()):
+            reader = imagereader.ImageReader(lmdb_filepath, use_augmentation=True, shuffle=True, num_workers=worker_count, balance_classes=False, number_classes=number_classes, samples_per_decode=samples_per_decode)
+        reader.startup()
+        try:
+            # let every worker produce its first sample before timing
+            for i in range(worker_count):
+                reader.get_example()
+            start_time = time.time()
+            for i in range(sample_count):
+                reader.get_example()
+            elapsed = time.time() - start_time
+        finally:
+            reader.shutdown()
+            reader.lmdb_env.close()  # lmdb allows the database to be opened only once per process
+        results['image_reader.workers_{}.samples_per_s'.format(worker_count)] = sample_count / elapsed
+    return results
+
+
+def bench_unet(tile_size, number_channels, batch_size, number_classes, step_count):
+    # synthetic in memory tensors, no I/O
+    img_size = [tile_size, tile_size, number_channels]
+    results = dict()
+    train = memory_probe.measure_train_step(img_size, batch_size, number_classes, step_count=step_count)
+    if train['step_time'] is not None:
+        results['unet.train_step.s'] = train['step_time']
+        results['unet.train.images_per_s'] = batch_size / train['step_time']
+    inference = memory_probe.measure_inference_step(img_size, batch_size, number_classes, step_count=step_count)
+    if inference['step_time'] is not None:
+        results['unet.inference_step.s'] = inference['step_time']
+        results['unet.inference.images_per_s'] = batch_size / inference['step_time']
+    return results
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_s')
+
+
+def compare_to_baseline(metrics, baseline_metrics, tolerance):
+    # returns the list of (metric, baseline, current, relative change) which are worse than the baseline by more than
+    # the tolerance (a fraction). The relative change is signed so that negative means slower.
+    regressions = list()
+    print('{:<45} {:>14} {:>14} {:>9}'.format('metric', 'baseline', 'current', 'change'))
+    for metric in sorted(metrics.keys()):
+        if metric not in baseline_metrics:
+            continue
+        baseline = baseline_metrics[metric]
+        current = metrics[metric]
+        if baseline == 0:
+            continue
+        change = (current - baseline) / baseline
+        if not higher_is_better(metric):
+            change = -change
+        flag = ''
+        if change < -tolerance:
+            flag = ' REGRESSION'
+            regressions.append((metric, baseline, current, change))
+        print('{:<45} {:>14.4f} {:>14.4f} {:>8.1f}%{}'.format(metric, baseline, current, 100 * change, flag))
+    return regressions
+
+
+def main(sections, data_folder, sample_count, worker_counts, tile_size, number_channels, batch_size, number_classes, step_count, output_filepath, baseline_filepath, save_baseline, tolerance, samples_per_decode=1):
+    np.random.seed(0)
+    working_folder = tempfile.mkdtemp(prefix='unet_benchmark_')
+    metrics = dict()
+    try:
+        image_folder = os.path.join(data_folder, 'images')
+        mask_folder = os.path.join(data_folder, 'masks')
+        # every database benchmark runs on the database built from the sample data
+        lmdb_filepath = os.path.join(working_folder, 'benchmark.lmdb')
+        needs_lmdb = any([s in sections for s in ['build_lmdb', 'lmdb_read', 'augment', 'image_reader']])
+        if needs_lmdb:
+            print('Running build_lmdb benchmark')
+            result = bench_build_lmdb(image_folder, mask_folder, working_folder)
+            if 'build_lmdb' in sections:
+                metrics.update(result)
+        if 'lmdb_read' in sections:
+            print('Running lmdb_read benchmark')
+            metrics.update(bench_lmdb_read(lmdb_filepath, sample_count))
+        if 'augment' in sections:
+            print('Running augment benchmark')
+            metrics.update(bench_augment(lmdb_filepath, sample_count))
+        if 'image_reader' in sections:
+            print('Running image_reader benchmark')
+            metrics.update(bench_image_reader(lmdb_filepath, worker_counts, sample_count, number_classes, samples_per_decode))
+        if 'unet' in sections:
+            print('Running unet benchmark')
+            metrics.update(bench_unet(tile_size, number_channels, batch_size, number_classes, step_count))
+    finally:
+        shutil.rmtree(working_folder, ignore_errors=True)
+
+    report = dict()
+    report['environment'] = {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': multiprocessing.cpu_count(), 'numpy': np.__version__}
+    report['config'] = {'sections': sections, 'sample_count': sample_count, 'worker_counts': worker_counts, 'tile_size': tile_size, 'number_channels': number_channels, 'batch_size': batch_size, 'number_classes': number_classes, 'step_count': step_count, 'samples_per_decode': samples_per_decode}
+    report['metrics'] = metrics
+
+    print(json.dumps(report, indent=2))
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump(report, fh, indent=2)
+
+    regressions = list()
+    if baseline_filepath is not None:
+        if save_baseline:
+            with open(baseline_filepath, 'w') as fh:
+                json.dump(report, fh, indent=2)
+            print('Saved baseline: {}'.format(baseline_filepath))
+        elif not os.path.exists(baseline_filepath):
+            print('Baseline {} does not exist, run with --save_baseline=1 to create it'.format(baseline_filepath))
+        else:
+            with open(baseline_filepath, 'r') as fh:
+                baseline = json.load(fh)
+            regressions = compare_to_baseline(metrics, baseline['metrics'], tolerance)
+            if len(regressions) > 0:
+                print('{} metrics regressed by more than {}% against the baseline'.format(len(regressions), 100 * tolerance))
+    return report, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='run_benchmarks', description='Measure the throughput of the data pipeline components and the UNet model to locate the training bottleneck')
+
+    parser.add_argument('--sections', dest='sections', type=str, help='comma separated list of the benchmarks to run [{}]'.format(','.join(SECTIONS)), default=','.join(SECTIONS))
+    parser.add_argument('--data_folder', dest='data_folder', type=str, help='folder with images/ and masks/ sub-folders to build the benchmark database from', default=DEFAULT_DATA_FOLDER)
+    parser.add_argument('--sample_count', dest='sample_count', type=int, help='number of samples to time for the database, augmentation and reader benchmarks', default=200)
+    parser.add_argument('--worker_counts', dest='worker_counts', type=str, help='comma separated list of ImageReader worker counts', default='1,2,4')
+    parser.add_argument('--samples_per_decode', dest='samples_per_decode', type=int, help='ImageReader samples_per_decode for the image_reader benchmark', default=1)
+    parser.add_argument('--tile_size', dest='tile_size', type=int, help='tile size (multiple of 16) for the synthetic UNet benchmark', default=256)
+    parser.add_argument('--number_channels', dest='number_channels', type=int, default=1)
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=4)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--step_count', dest='step_count', type=int, help='number of timed UNet steps', default=5)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the report into', default=None)
+    parser.add_argument('--baseline', dest='baseline_filepath', type=str, help='json report of a previous run to compare against', default=None)
+    parser.add_argument('--save_baseline', dest='save_baseline', type=int, help='whether to store this report as the baseline instead of comparing against it [0 = false, 1 = true]', default=0)
+    parser.add_argument('--tolerance', dest='tolerance', type=float, help='fraction a metric may be worse than the baseline before it is flagged as a regression', default=0.2)
+
+    args = parser.parse_args()
+    sections = [s for s in args.sections.split(',') if len(s) > 0]
+    for s in sections:
+        if s not in SECTIONS:
+            parser.error('unknown benchmark section: {}'.format(s))
+    worker_counts = [int(w) for w in args.worker_counts.split(',')]
+
+    report, regressions = main(sections, args.data_folder, args.sample_count, worker_counts, args.tile_size, args.number_channels, args.batch_size, args.number_classes, args.step_count, args.output_filepath, args.baseline_filepath, args.save_baseline, args.tolerance, args.samples_per_decode)
+    if len(regressions) > 0:
+        sys.exit(1)
@@ -0,0 +1,127 @@
+# NIST-developed software is provided by NIST as a public service. You may use, copy and distribute copies of the software in any medium, provided that you keep intact this entire notice. You may improve, modify and create derivative works of the software or any portion of the software, and you may copy and distribute such modifications or works. Modified works should carry a notice stating that you changed the software and should note the date and nature of any such change. Please explicitly acknowledge the National Institute of Standards and Technology as the source of the software.
+# NIST-developed software is expressly provided "AS IS." NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED, IN FACT OR ARISING BY OPERATION OF LAW, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT AND DATA ACCURACY. NIST NEITHER REPRESENTS NOR WARRANTS THAT THE OPERATION OF THE SOFTWARE WILL BE UNINTERRUPTED OR ERROR-FREE, OR THAT ANY DEFECTS WILL BE CORRECTED. NIST DOES NOT WARRANT OR MAKE ANY REPRESENTATIONS REGARDING THE USE OF THE SOFTWARE OR THE RESULTS THEREOF, INCLUDING BUT NOT LIMITED TO THE CORRECTNESS, ACCURACY, RELIABILITY, OR USEFULNESS OF THE SOFTWARE.
+# You are solely responsible for determining the appropriateness of using and distributing the software and you assume all risks associated with its use, including but not limited to the risks and costs of program errors, compliance with applicable laws, damage to or loss of data, programs or equipment, and the unavailability or interruption of operation. This software is not intended to be used in any situation where a failure could cause risk of injury or damage to property. The software developed by NIST employees is not subject to copyright protection within the United States.
+
+import sys
+if sys.version_info[0] < 3:
+    raise Exception('Python3 required')
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'UNet'))
+import inference
+import unet_model
+
+
+def _reference_tiling(img, model, tile_size):
+    # the original tiling, one (border clipped) tile per model call, for the pixel identity check
+    height, width = img.shape[0], img.shape[1]
+    mask = np.zeros((height, width), dtype=np.int32)
+    radius = unet_model.UNet.RADIUS
+    zone_of_responsibility_size = tile_size - 2 * radius
+    for i in range(0, height, zone_of_responsibility_size):
+        for j in range(0, width, zone_of_responsibility_size):
+            x_st_z, y_st_z = j, i
+            x_end_z, y_end_z = x_st_z + zone_of_responsibility_size, y_st_z + zone_of_responsibility_size
+            x_st, y_st, x_end, y_end = x_st_z - radius, y_st_z - radius, x_end_z + radius, y_end_z + radius
+            radius_pre_x = radius_pre_y = radius_post_x = radius_post_y = radius
+            if x_st < 0:
+                x_st, radius_pre_x = 0, 0
+            if y_st < 0:
+                y_st, radius_pre_y = 0, 0
+            if x_end > width:
+                x_end, x_end_z, radius_post_x = width, width, 0
+            if y_end > height:
+                y_end, y_end_z, radius_post_y = height, height, 0
+
+            tile = img[y_st:y_end, x_st:x_end]
+            batch_data = tile.transpose((2, 0, 1))[np.newaxis]
+            pred = np.argmax(np.squeeze(model(batch_data)), axis=-1).astype(np.int32)
+            pred = pred[radius_pre_y:pred.shape[0] - radius_post_y, radius_pre_x:pred.shape[1] - radius_post_x]
+            mask[y_st_z:y_end_z, x_st_z:x_end_z] = pred
+    return mask
+
+
+def _time(fn, repeats):
+    # the first call includes tracing the model for each new tile shape, the following calls are steady state
+    start_time = time.time()
+    result = fn()
+    cold_time = time.time() - start_time
+    start_time = time.time()
+    for r in range(repeats):
+        fn()
+    warm_time = (time.time() - start_time) / repeats
+    return result, cold_time, warm_time
+
+
+def main(saved_model_filepath, image_size, tile_size, batch_sizes, number_channels, number_classes, repeats, output_filepath):
+    tmp_folder = None
+    if saved_model_filepath is None:
+        # a randomly initialized model, saved and loaded the way inference.py uses it
+        tmp_folder = tempfile.mkdtemp(prefix='tiled_inference_')
+        saved_model_filepath = os.path.join(tmp_folder, 'saved_model')
+        model = unet_model.UNet(number_classes, 1, [tile_size, tile_size, number_channels])
+        tf.saved_model.save(model.get_keras_model(), saved_model_filepath)
+    try:
+        model = tf.saved_model.load(saved_model_filepath)
+
+        rng = np.random.default_rng(0)
+        img = rng.standard_normal((image_size[0], image_size[1], number_channels)).astype(np.float32)
+        assert image_size[0] % unet_model.UNet.SIZE_FACTOR == 0 and image_size[1] % unet_model.UNet.SIZE_FACTOR == 0
+
+        zone_of_responsibility_size = tile_size - 2 * unet_model.UNet.RADIUS
+        tile_count = int(np.ceil(image_size[0] / zone_of_responsibility_size) * np.ceil(image_size[1] / zone_of_responsibility_size))
+        megapixels = image_size[0] * image_size[1] / 1e6
+        print('image {}x{} ({} tiles of {})'.format(image_size[0], image_size[1], tile_count, tile_size))
+
+        results = list()
+        reference, cold_time, warm_time = _time(lambda: _reference_tiling(img, model, tile_size), repeats)
+        results.append({'method': 'per_tile', 'batch_size': 1, 'cold_time': cold_time, 'warm_time': warm_time, 'identical': True})
+        for batch_size in batch_sizes:
+            mask, cold_time, warm_time = _time(lambda: inference._inference_tiling(img, model, tile_size, batch_size), repeats)
+            results.append({'method': 'batched', 'batch_size': batch_size, 'cold_time': cold_time, 'warm_time': warm_time, 'identical': bool(np.array_equal(mask, reference))})
+
+        print('{:>10} {:>11} {:>13} {:>13} {:>10} {:>9} {:>10}'.format('method', 'batch_size', 'cold (s)', 'warm (s)', 'tiles/s', 'MP/s', 'identical'))
+        for r in results:
+            r['tiles_per_s'] = tile_count / r['warm_time']
+            r['megapixels_per_s'] = megapixels / r['warm_time']
+            r['speedup'] = results[0]['warm_time'] / r['warm_time']
+            print('{:>10} {:>11} {:>13.3f} {:>13.3f} {:>10.2f} {:>9.3f} {:>10}'.format(r['method'], r['batch_size'], r['cold_time'], r['warm_time'], r['tiles_per_s'], r['megapixels_per_s'], str(r['identical'])))
+    finally:
+        if tmp_folder is not None:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    if output_filepath is not None:
+        with open(output_filepath, 'w') as fh:
+            json.dump({'image_size': image_size, 'tile_size': tile_size, 'tile_count': tile_count, 'results': results}, fh, indent=2)
+    if not all(r['identical'] for r in results):
+        print('Batched tiling output differs from the per tile output')
+        sys.exit(1)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='tiled_inference', description='Compare the throughput of batched tile inference against one tile per model call on a large image, and check the outputs are pixel identical')
+
+    parser.add_argument('--saved_model_filepath', dest='saved_model_filepath', type=str, help='SavedModel to benchmark [default: a randomly initialized UNet]', default=None)
+    parser.add_argument('--image_size', dest='image_size', type=str, help='HxW of the synthetic image (multiples of 16)', default='4096x4096')
+    parser.add_argument('--tile_size', dest='tile_size', type=int, default=1024)
+    parser.add_argument('--batch_sizes', dest='batch_sizes', type=str, help='comma separated list of tile batch sizes', default='1,2,4,8')
+    parser.add_argument('--number_channels', dest='number_channels', type=int, default=1)
+    parser.add_argument('--number_classes', dest='number_classes', type=int, default=2)
+    parser.add_argument('--repeats', dest='repeats', type=int, help='number of timed passes after the first (tracing) pass', default=1)
+    parser.add_argument('--output_file', dest='output_filepath', type=str, help='optional json file to write the results into', default=None)
+
+    args = parser.parse_args()
+    image_size = [int(v) for v in args.image_size.split('x')]
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',')]
+
+    main(args.saved_model_filepath, image_size, args.tile_size, batch_sizes, args.number_channels, args.number_classes, args.repeats, args.output_filepath)